@@ -0,0 +1,75 @@
+"""
+Multi-fidelity prediction cascade: every sequence is first predicted cheaply
+(one model, few recycles) and only the promising ones get a full prediction.
+"""
+
+import math
+
+def cascade_job(w, fidelity):
+    """work list entry for af2_cascade workers (read back by utils.distributor.split_job)"""
+    return (fidelity, w)
+
+def run_cascade(num_jobs, job_seqs, predict_and_score, combine, keep=0.5, threshold=None):
+    """
+    predict_and_score(job_indices, fidelity) returns the scores of those jobs and
+    the number of predictions it made, and job_seqs[i] is the index of the
+    sequence job i belongs to. All jobs are predicted cheaply, sequences are
+    ranked by combine(scores of their jobs) (lower is better), and the jobs of
+    the best keep fraction of sequences (or of all sequences scoring at most
+    threshold, if given) are predicted again at full fidelity.
+    Returns the score of every job, the fidelity of every sequence, and the
+    number of predictions made.
+    """
+    job_inds = list(range(num_jobs))
+    if not job_inds:
+        return [], [], 0
+    scores, num_predicted = predict_and_score(job_inds, "cheap")
+
+    num_seqs = max(job_seqs) + 1
+    seq_scores = [[] for _ in range(num_seqs)]
+    for i, s in zip(job_inds, job_seqs):
+        seq_scores[s].append(scores[i])
+    overall = [combine(x) for x in seq_scores]
+
+    if threshold is not None:
+        promoted = set([s for s in range(num_seqs) if overall[s] <= threshold])
+    else:
+        order = sorted(range(num_seqs), key=lambda s: overall[s])
+        promoted = set(order[:math.ceil(keep*num_seqs)])
+    print("cascade: promoting", len(promoted), "of", num_seqs, "sequences to full fidelity")
+
+    full_inds = [i for i in job_inds if job_seqs[i] in promoted]
+    if full_inds:
+        full_scores, num_full = predict_and_score(full_inds, "full")
+        num_predicted += num_full
+        for i, score in zip(full_inds, full_scores):
+            scores[i] = score
+
+    fidelities = ["full" if s in promoted else "cheap" for s in range(num_seqs)]
+    return scores, fidelities, num_predicted
+
+def merge_fidelity(scored_seqs, key_seq, fidelity, repeat_scheduler=None):
+    """
+    Call before adding a new score of key_seq to scored_seqs, so scores of
+    different fidelity are never averaged together: a full score replaces
+    earlier cheap ones, and a cheap score is dropped if full ones exist.
+    Returns False if the new score should be dropped.
+    """
+    if key_seq not in scored_seqs:
+        return True
+    old_fidelity = scored_seqs[key_seq].get("fidelity", "full")
+    if old_fidelity == fidelity:
+        return True
+    if old_fidelity == "full":
+        return False
+    del scored_seqs[key_seq]
+    if repeat_scheduler:
+        repeat_scheduler.reset(key_seq)
+    return True
+
+def selection_key(scored_seqs):
+    """sort key for (key_seq, average) pairs that ranks all full-fidelity sequences before cheap ones"""
+    return lambda x: (scored_seqs[x[0]].get("fidelity", "full") == "cheap", x[1][0])
+
+if __name__=="__main__":
+    print("no main functionality")
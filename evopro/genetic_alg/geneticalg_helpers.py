@@ -1,6 +1,7 @@
 #import standard packages
 import multiprocessing as mp
 import collections
+import copy
 import random
 import string
 import time
@@ -10,9 +11,11 @@ import json
 from typing import Sequence, Union
 
 #import custom packages
-from evopro.utils.distributor import Distributor
+from evopro.utils.distributor import Distributor, split_job
 from evopro.genetic_alg.DesignSeq import DesignSeq, DesignSeqMSD
 from evopro.utils.pdb_parser import get_coordinates_pdb, change_chainid_pdb, append_pdbs
+from evopro.utils.campaign import campaign_gpus
+from evopro.utils.jax_cache import init_compilation_cache, read_compile_log, update_compile_log, compile_log_key, StartupTimer, TimedFirstCall
 
 sys.path.append('/proj/kuhl_lab/alphafold/run')
 from functools import partial
@@ -43,20 +46,104 @@ def of_init(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[s
 
     return of_partial
 
-def af2_init(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[str]]]):
-    from run_af2 import af2
+def _compile_runner(model_name, num_recycle, args, query_features, proc_id, timer=None, compile_log=None):
+    """
+    creates a model runner and compiles it by predicting each of query_features it applies to.
+    Load and compile times go to timer, and the compiled shapes to the compile_log dict.
+    """
+    from model import (getModelRunner, predictStructure)
+
+    t = time.time()
+    model_runner = getModelRunner(
+        model_name=model_name,
+        num_ensemble=args.num_ensemble,
+        is_training=args.is_training,
+        num_recycle=num_recycle,
+        recycle_tol=args.recycle_tol,
+        params_dir=args.params_dir)
+    if timer:
+        timer.add("param_load", time.time()-t)
+
+    run_multimer = False
+    if 'multimer' in model_name:
+        run_multimer = True
+
+    for query in query_features:
+        sequences = query[0]
+
+        if len(sequences) > 1 and not run_multimer:
+            continue
+        elif len(sequences) == 1 and run_multimer:
+            continue
+
+        input_features = query[1]
+
+        t = time.time()
+        result = predictStructure(
+            model_name=model_name,
+            model_runner=model_runner,
+            feature_dict=input_features,
+            run_multimer=run_multimer,
+            use_templates=args.use_templates)
+        compile_time = time.time()-t
+        print(f'Model {model_name} with {num_recycle} recycles took {compile_time} sec on GPU {proc_id}.')
+
+        lengths = [len(seq) for seq in sequences]
+        if compile_log is not None:
+            key = compile_log_key(model_name, lengths, num_recycle)
+            if timer:
+                timer.add_compile(model_name, lengths, num_recycle, compile_time, key in compile_log)
+            compile_log[key] = {"model_name": model_name, "lengths": lengths, "num_recycle": num_recycle,
+                             "compile_seconds": compile_time, "last_used": time.time()}
+        elif timer:
+            timer.add_compile(model_name, lengths, num_recycle, compile_time, False)
+
+    return model_runner
+
+def worker_device(proc_id):
+    """
+    GPU of worker proc_id: the proc_id-th of the GPUs a campaign scheduler gave
+    this run, or else of CUDA_VISIBLE_DEVICES, or GPU proc_id if none were given
+    """
+    devices = campaign_gpus()
+    if devices is None:
+        devices = [x for x in os.environ.get('CUDA_VISIBLE_DEVICES', '').split(",") if x.strip()]
+    if not devices:
+        return str(proc_id)
+    if proc_id >= len(devices):
+        raise ValueError("Worker " + str(proc_id) + " has no GPU, only " + str(len(devices)) + " were given to this run (" + ",".join(devices) + ").")
+    return devices[proc_id]
+
+def _af2_compile(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[str]]], cheap_recycles=None, jax_cache_dir=None):
+    """
+    parses the AF2 flags and compiles the model runners for lengths on this worker's GPU.
+    With cheap_recycles, also compiles low-recycle runners for cascade predictions.
+    With jax_cache_dir, compiled programs are kept in a persistent cache shared by
+    workers and runs, and recorded in its compile log. Startup timings are written
+    next to arg_file.
+    """
     print('initialization of process', proc_id)
+    timer = StartupTimer(proc_id, os.path.dirname(os.path.abspath(arg_file)))
 
     os.environ['TF_FORCE_UNITED_MEMORY'] = '1'
     os.environ['XLA_PYTHON_CLIENT_MEM_FRACTION'] = '2.0'
     os.environ['TF_XLA_FLAGS'] = '--tf_xla_cpu_global_jit'
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(proc_id)
+    os.environ['CUDA_VISIBLE_DEVICES'] = worker_device(proc_id)
 
+    t = time.time()
     import jax
     from features import (getRawInputs, getChainFeatures, getInputFeatures)
     from run.setup import (getAF2Parser, QueryManager, getOutputDir)
     from model import (getModelNames, getModelRunner, predictStructure, getRandomSeeds)
     from utils.query_utils import generate_random_sequences
+    timer.add("import", time.time()-t)
+
+    cache_dir = None
+    compile_log = None
+    if jax_cache_dir:
+        cache_dir = init_compilation_cache(jax_cache_dir)
+        compile_log = read_compile_log(cache_dir)
+        print(f'JAX compilation cache {cache_dir} with {len(compile_log)} compiled shapes')
 
     parser = getAF2Parser()
     args = parser.parse_args([f'@{arg_file}'])
@@ -126,45 +213,221 @@ def af2_init(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[
 
         query_features.append( (sequences, input_features) )
 
-    results_list = []
     models = []
     for model_name in model_names:
-        model_runner = getModelRunner(
-            model_name=model_name,
-            num_ensemble=args.num_ensemble,
-            is_training=args.is_training,
-            num_recycle=args.max_recycle,
-            recycle_tol=args.recycle_tol,
-            params_dir=args.params_dir)
+        model_runner = _compile_runner(model_name, args.max_recycle, args, query_features, proc_id, timer=timer, compile_log=compile_log)
+        models.append((model_name, model_runner))
+
+    #one model with few recycles per model type, for cheap predictions in a fidelity cascade
+    cheap_models = []
+    if cheap_recycles is not None:
+        cheap_names = [name for name in model_names if 'multimer' not in name][:1] + [name for name in model_names if 'multimer' in name][:1]
+        for model_name in cheap_names:
+            model_runner = _compile_runner(model_name, cheap_recycles, args, query_features, proc_id, timer=timer, compile_log=compile_log)
+            cheap_models.append((model_name, model_runner))
+
+    if cache_dir:
+        update_compile_log(cache_dir, compile_log)
+    timer.write()
+
+    return args, output_dir, models, cheap_models, timer
+
+def af2_init_compiled(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[str]]], jax_cache_dir=None):
+    from run_af2 import af2
+
+    args, output_dir, models, cheap_models, timer = _af2_compile(proc_id, arg_file, lengths, jax_cache_dir=jax_cache_dir)
+    af2_partial = partial(af2, arg_file=arg_file, proc_id=proc_id, compiled_runners=models)
+
+    return TimedFirstCall(af2_partial, timer)
 
-        run_multimer = False
-        if 'multimer' in model_name:
-            run_multimer = True
+class ChainFeatureCache:
+    """
+    Per-worker cache of AF2 chain features (raw inputs, MSA and template features)
+    keyed by chain sequence and feature settings. Input features of a query are
+    assembled from the cached chains, so fixed chains (e.g. the target of a binder
+    design) are only featurized once per worker. Chains are featurized unpaired.
+    """
 
-        for query in query_features:
-            sequences = query[0]
+    def __init__(self, args, output_dir, proc_id, max_chains=64):
+        self.args = args
+        self.output_dir = output_dir
+        self.proc_id = proc_id
+        self.max_chains = max_chains
+        self.chains = collections.OrderedDict()
+
+    def _key(self, sequence):
+        return (sequence, self.args.msa_mode, self.args.use_templates)
+
+    def _featurize(self, sequences):
+        from features import (getRawInputs, getChainFeatures)
+        from run.setup import QueryManager
+
+        qm = QueryManager(
+            sequences=sequences,
+            min_length=self.args.min_length,
+            max_length=self.args.max_length,
+            max_multimer_length=self.args.max_multimer_length)
+        qm.parse_files()
+        qm.parse_sequences()
+        raw_inputs = getRawInputs(
+            queries=qm.queries,
+            msa_mode=self.args.msa_mode,
+            use_templates=self.args.use_templates,
+            output_dir=self.output_dir,
+            proc_id=self.proc_id)
+
+        for sequence in sequences:
+            features_for_chain = getChainFeatures(
+                sequences=[sequence],
+                raw_inputs=raw_inputs,
+                use_templates=self.args.use_templates,
+                proc_id=self.proc_id)
+            self.chains[self._key(sequence)] = list(features_for_chain.values())[0]
+            while len(self.chains) > self.max_chains:
+                self.chains.popitem(last=False)
+
+    def get_input_features(self, sequences):
+        """returns the input features of a query and the number of its chains that came from the cache"""
+        from features import getInputFeatures
+
+        missing = []
+        num_cached = 0
+        for sequence in sequences:
+            if self._key(sequence) in self.chains:
+                self.chains.move_to_end(self._key(sequence))
+                num_cached += 1
+            elif sequence not in missing:
+                missing.append(sequence)
+        if missing:
+            self._featurize(missing)
+
+        chain_features = {}
+        for chain, sequence in zip(chain_names, sequences):
+            #input feature assembly may modify chain features in place
+            chain_features[chain] = copy.deepcopy(self.chains[self._key(sequence)])
+
+        input_features = getInputFeatures(
+            sequences=sequences,
+            chain_features=chain_features)
+        return input_features, num_cached
+
+def af2_cached_features(queries, feature_cache=None, proc_id=0, compiled_runners=None):
+    """
+    Predicts each query (list of chain sequences) with every compiled model
+    runner that fits it, using feature_cache for the chain features.
+    Returns one list of model results per query.
+    """
+    from model import predictStructure
+
+    results = []
+    for sequences in queries:
+        if type(sequences) is str:
+            sequences = [sequences]
+
+        t = time.time()
+        input_features, num_cached = feature_cache.get_input_features(sequences)
+        print(f'Features took {time.time()-t} sec on GPU {proc_id}, {num_cached} of {len(sequences)} chains cached.')
+
+        query_results = []
+        for model_name, model_runner in compiled_runners:
+            run_multimer = False
+            if 'multimer' in model_name:
+                run_multimer = True
 
             if len(sequences) > 1 and not run_multimer:
                 continue
             elif len(sequences) == 1 and run_multimer:
                 continue
 
-            input_features = query[1]
-
             t = time.time()
             result = predictStructure(
                 model_name=model_name,
                 model_runner=model_runner,
                 feature_dict=input_features,
                 run_multimer=run_multimer,
-                use_templates=args.use_templates)
+                use_templates=feature_cache.args.use_templates)
             print(f'Model {model_name} took {time.time()-t} sec on GPU {proc_id}.')
+            query_results.append(result)
+        results.append(query_results)
 
-        models.append((model_name, model_runner))
-
-    af2_partial = partial(af2, arg_file=arg_file, proc_id=proc_id, compiled_runners=models)
+    return results
 
-    return af2_partial
+def af2_cached_features_batch(jobs, feature_cache=None, proc_id=0, compiled_runners=None):
+    """
+    predict_batch of af2_cached_features: the queries of all jobs (work list
+    entries) are predicted one after another in one call, sharing the feature
+    cache and the compiled runners. Returns the output of each job.
+    """
+    results = af2_cached_features([queries for job in jobs for queries in job], feature_cache=feature_cache,
+                                  proc_id=proc_id, compiled_runners=compiled_runners)
+    outputs = []
+    start = 0
+    for job in jobs:
+        outputs.append(results[start:start+len(job)])
+        start += len(job)
+    return outputs
+
+def af2_init_cached_features(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[str]]], jax_cache_dir=None):
+    """same as af2_init_compiled, but the worker keeps a ChainFeatureCache across predictions"""
+    args, output_dir, models, cheap_models, timer = _af2_compile(proc_id, arg_file, lengths, jax_cache_dir=jax_cache_dir)
+    feature_cache = ChainFeatureCache(args, output_dir, proc_id)
+    af2_partial = partial(af2_cached_features, feature_cache=feature_cache, proc_id=proc_id, compiled_runners=models)
+    af2_partial.predict_batch = partial(af2_cached_features_batch, feature_cache=feature_cache, proc_id=proc_id, compiled_runners=models)
+
+    return TimedFirstCall(af2_partial, timer)
+
+def af2_each(jobs, predict=None, compiled_runners=None):
+    """predict_batch for worker functions without one: the jobs are predicted one after another"""
+    return [predict(job, compiled_runners=compiled_runners) for job in jobs]
+
+def af2_cascade(job, predict=None, compiled_runners=None, cheap_runners=None):
+    """
+    Worker function for fidelity cascades. job is either a plain work list entry
+    (full fidelity) or a tuple (fidelity, work list entry) with fidelity "cheap" or "full".
+    """
+    fidelity, queries = split_job(job)
+
+    runners = compiled_runners
+    if fidelity == "cheap":
+        runners = cheap_runners
+    return predict(queries, compiled_runners=runners)
+
+def af2_cascade_batch(jobs, predict_batch=None, compiled_runners=None, cheap_runners=None):
+    """predict_batch of af2_cascade, one predict_batch call per fidelity"""
+    by_fidelity = collections.OrderedDict()
+    for i, job in enumerate(jobs):
+        fidelity, queries = split_job(job)
+        by_fidelity.setdefault(fidelity, []).append((i, queries))
+
+    outputs = [None]*len(jobs)
+    for fidelity, members in by_fidelity.items():
+        runners = compiled_runners
+        if fidelity == "cheap":
+            runners = cheap_runners
+        for (i, queries), output in zip(members, predict_batch([queries for i, queries in members], compiled_runners=runners)):
+            outputs[i] = output
+    return outputs
+
+def af2_init_cascade(proc_id: int, arg_file: str, lengths: Sequence[Union[str, Sequence[str]]], cheap_recycles=1, jax_cache_dir=None,
+                     cache_chain_features=False):
+    """
+    same as af2_init_compiled, but the worker can also make cheap (one model, cheap_recycles) predictions.
+    Both fidelities use the normal AF2 feature pipeline, or a ChainFeatureCache with cache_chain_features.
+    """
+    args, output_dir, models, cheap_models, timer = _af2_compile(proc_id, arg_file, lengths, cheap_recycles=cheap_recycles, jax_cache_dir=jax_cache_dir)
+    if cache_chain_features:
+        feature_cache = ChainFeatureCache(args, output_dir, proc_id)
+        predict = partial(af2_cached_features, feature_cache=feature_cache, proc_id=proc_id)
+        predict_batch = partial(af2_cached_features_batch, feature_cache=feature_cache, proc_id=proc_id)
+    else:
+        from run_af2 import af2
+        predict = partial(af2, arg_file=arg_file, proc_id=proc_id)
+        predict_batch = partial(af2_each, predict=predict)
+    af2_partial = partial(af2_cascade, predict=predict, compiled_runners=models, cheap_runners=cheap_models)
+    af2_partial.predict_batch = partial(af2_cascade_batch, predict_batch=predict_batch, compiled_runners=models,
+                                        cheap_runners=cheap_models)
+
+    return TimedFirstCall(af2_partial, timer)
 
 #NEEDS REWRITE
 def generate_random_seqs(num_seqs, lengths):
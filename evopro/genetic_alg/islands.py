@@ -0,0 +1,103 @@
+"""
+Island model: several GA populations (processes or nodes) run at the same time
+and periodically exchange their best sequences through a shared directory.
+"""
+
+import os
+import random
+
+from evopro.utils.utils import compressed_pickle, decompress_pickle
+
+TOPOLOGIES = ("ring", "all", "random")
+
+class MigrationChannel:
+    """
+    File-based migration between num_islands islands. Every island writes its
+    emigrants to island_<id>.pbz2 in migration_dir and reads the files of the
+    islands it receives from (topology ring: the previous island, all: every
+    other island, random: one other island per migration). Islands never wait
+    for each other; a file is taken in once per generation it was written in.
+    """
+
+    def __init__(self, migration_dir, island_id, num_islands, topology="ring"):
+        if topology not in TOPOLOGIES:
+            raise ValueError("Unknown migration topology " + str(topology) + ", choose one of " + ", ".join(TOPOLOGIES))
+        self.migration_dir = migration_dir
+        self.island_id = island_id
+        self.num_islands = num_islands
+        self.topology = topology
+        self.received = {}
+        if not os.path.isdir(migration_dir):
+            os.makedirs(migration_dir, exist_ok=True)
+
+    def _path(self, island_id):
+        return os.path.join(self.migration_dir, "island_" + str(island_id))
+
+    def sources(self):
+        others = [i for i in range(self.num_islands) if i != self.island_id]
+        if not others:
+            return []
+        if self.topology == "ring":
+            return [(self.island_id - 1) % self.num_islands]
+        if self.topology == "random":
+            return [random.choice(others)]
+        return others
+
+    def emigrate(self, generation, scored_seqs, key_seqs):
+        """publishes the scored_seqs entries of key_seqs (predictions included) as this island's emigrants"""
+        migrants = []
+        for key_seq in key_seqs:
+            entry = scored_seqs[key_seq]
+            #spilled predictions are read back so the file is self-contained
+            data = [{"score": d["score"], "pdb": d["pdb"], "result": d["result"]} for d in entry["data"]]
+            migrants.append((key_seq, {"dsobj": entry["dsobj"], "data": data, "average": entry["average"],
+                                       "fidelity": entry.get("fidelity", "full")}))
+
+        tmp_path = self._path(self.island_id) + "_tmp"
+        compressed_pickle(tmp_path, {"generation": generation, "island": self.island_id, "migrants": migrants})
+        os.replace(tmp_path + ".pbz2", self._path(self.island_id) + ".pbz2")
+
+    def immigrate(self):
+        """returns (key_seq, scored_seqs entry) of migrants from source islands that were not taken in yet"""
+        migrants = []
+        for source in self.sources():
+            path = self._path(source) + ".pbz2"
+            if not os.path.isfile(path):
+                continue
+            sent = decompress_pickle(path)
+            if self.received.get(source) == sent["generation"]:
+                continue
+            self.received[source] = sent["generation"]
+            print("island", self.island_id, "received", len(sent["migrants"]), "migrants from island", source,
+                  "generation", sent["generation"])
+            migrants = migrants + sent["migrants"]
+        return migrants
+
+def migrate(channel, generation, scored_seqs, newpool_seqs, top_k, repeat_scheduler=None):
+    """
+    Sends the top_k of newpool_seqs (sorted best first) and replaces the worst
+    members of newpool_seqs with the migrants received. Migrants are added to
+    scored_seqs with their scores, and their predictions are counted by
+    repeat_scheduler (with repeat_af2), so they are not predicted again more
+    often than local sequences. Returns the new list of pool sequences.
+    """
+    channel.emigrate(generation, scored_seqs, newpool_seqs[:top_k])
+    incoming = []
+    for key_seq, entry in channel.immigrate():
+        if key_seq in newpool_seqs or key_seq in incoming:
+            continue
+        if key_seq not in scored_seqs:
+            scored_seqs[key_seq] = entry
+            if repeat_scheduler:
+                for d in entry["data"]:
+                    repeat_scheduler.add(key_seq, d["score"][0][0])
+        incoming.append(key_seq)
+
+    #the best local sequences always stay
+    incoming = incoming[:max(len(newpool_seqs) - top_k, 0)]
+    if not incoming:
+        return newpool_seqs
+    return newpool_seqs[:len(newpool_seqs) - len(incoming)] + incoming
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -0,0 +1,66 @@
+"""
+Decides when a sequence has been predicted often enough with repeat_af2 on.
+"""
+
+import math
+from statistics import NormalDist
+
+class RepeatScheduler:
+    """
+    Keeps the overall scores of every sequence. A sequence stops being
+    re-predicted when it reaches max_repeats, or, if confidence is set, as
+    soon as its ranking score is far enough from the selection cutoff that
+    another prediction is unlikely to move it to the other side. The ranking
+    score is the mean of the top_k best (lowest) scores, or of all of them if
+    top_k is None, the same statistic the run ranks its pool by.
+    """
+
+    def __init__(self, max_repeats=5, confidence=None, min_repeats=2, top_k=None):
+        self.max_repeats = max_repeats
+        self.confidence = confidence
+        self.min_repeats = min_repeats
+        self.top_k = top_k
+        self.stats = {}
+        self.z = None
+        if confidence:
+            #two-sided interval around the mean
+            self.z = NormalDist().inv_cdf(0.5 + confidence/2)
+
+    def add(self, key_seq, value):
+        self.stats.setdefault(key_seq, []).append(value)
+
+    def reset(self, key_seq):
+        self.stats.pop(key_seq, None)
+
+    def count(self, key_seq):
+        return len(self.stats.get(key_seq, []))
+
+    def mean_std(self, key_seq):
+        """ranking score (mean of the top_k best scores) and the standard deviation of all scores"""
+        values = sorted(self.stats[key_seq])
+        top = values[:self.top_k] if self.top_k else values
+        n = len(values)
+        mean = sum(values)/n
+        std = math.sqrt(sum([(x - mean)**2 for x in values])/(n-1)) if n > 1 else float("inf")
+        return sum(top)/len(top), std
+
+    def settled(self, key_seq, cutoff=None):
+        """True if key_seq does not need to be predicted again"""
+        n = self.count(key_seq)
+        if n >= self.max_repeats:
+            return True
+        if self.z is None or cutoff is None or n < self.min_repeats:
+            return False
+        score, std = self.mean_std(key_seq)
+        #standard error of the mean of the scores the ranking score averages
+        k = min(n, self.top_k) if self.top_k else n
+        return abs(score - cutoff) > self.z*std/math.sqrt(k)
+
+def selection_cutoff(sorted_scored_pool, newpool_size):
+    """score halfway between the last kept and the first dropped sequence"""
+    if not sorted_scored_pool or newpool_size <= 0 or newpool_size >= len(sorted_scored_pool):
+        return None
+    return (sorted_scored_pool[newpool_size-1][1][0] + sorted_scored_pool[newpool_size][1][0])/2
+
+if __name__=="__main__":
+    print("no main functionality")
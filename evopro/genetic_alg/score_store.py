@@ -0,0 +1,117 @@
+"""
+Keeps the memory used by scored_seqs bounded by spilling the heavy parts of
+old predictions (pdb strings and AF2 result dictionaries) to disk.
+"""
+
+import os
+import shutil
+import numpy as np
+
+from evopro.utils.utils import compressed_pickle, decompress_pickle
+
+#keys of a scored_seqs[key_seq]["data"] entry that are moved to disk
+HEAVY_KEYS = ("pdb", "result")
+
+def payload_nbytes(obj):
+    """rough size in bytes of the arrays and strings in obj"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        return sum(payload_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(payload_nbytes(v) for v in obj)
+    if hasattr(obj, "__dict__"):
+        return payload_nbytes(vars(obj))
+    return 0
+
+class SpilledPrediction(dict):
+    """
+    Entry of scored_seqs[key_seq]["data"] whose pdb and result were written to
+    disk. The score stays in memory; entry["pdb"], entry.get("result") etc. read
+    them back from the file. The payload of the most recently read entry stays
+    loaded, so reading its pdb and then its result decompresses the file once,
+    while at most one spilled payload is held in memory.
+    """
+
+    #(path, payload) of the most recently read spilled entry
+    _loaded = (None, None)
+
+    def __init__(self, entry, path):
+        super().__init__({k: v for k, v in entry.items() if k not in HEAVY_KEYS})
+        self.spilled_keys = tuple([k for k in HEAVY_KEYS if k in entry])
+        self.path = path
+
+    def _payload(self):
+        path, payload = SpilledPrediction._loaded
+        if path != self.path:
+            payload = decompress_pickle(self.path)
+            SpilledPrediction._loaded = (self.path, payload)
+        return payload
+
+    def __missing__(self, key):
+        if key in self.spilled_keys:
+            return self._payload()[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self.spilled_keys or dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+class ScoreStore:
+    """
+    Call trim() once per iteration. If the pdbs and results held in scored_seqs
+    take more than memory_budget bytes, entries are spilled to spill_dir, oldest
+    sequences first, and sequences in keep (e.g. the next pool) last.
+    """
+
+    def __init__(self, spill_dir, memory_budget):
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.num_spilled = 0
+        if not os.path.isdir(spill_dir):
+            os.makedirs(spill_dir)
+
+    def _spill(self, entry):
+        path = os.path.join(self.spill_dir, "prediction_" + str(self.num_spilled))
+        compressed_pickle(path, {k: entry[k] for k in HEAVY_KEYS if k in entry})
+        self.num_spilled += 1
+        return SpilledPrediction(entry, path + ".pbz2")
+
+    def trim(self, scored_seqs, keep=()):
+        resident = []
+        total = 0
+        keep = set(keep)
+        for key_seq in scored_seqs:
+            for i, entry in enumerate(scored_seqs[key_seq]["data"]):
+                if isinstance(entry, SpilledPrediction):
+                    continue
+                nbytes = payload_nbytes([entry.get(k) for k in HEAVY_KEYS])
+                resident.append((key_seq in keep, key_seq, i, nbytes))
+                total += nbytes
+
+        if total <= self.memory_budget:
+            return total
+
+        #stable sort: sequences not in keep first, each in the order they were first scored
+        resident.sort(key=lambda x: x[0])
+        for in_keep, key_seq, i, nbytes in resident:
+            if total <= self.memory_budget:
+                break
+            data = scored_seqs[key_seq]["data"]
+            data[i] = self._spill(data[i])
+            total -= nbytes
+        print("spilled predictions to disk:", self.num_spilled, "in memory:", round(total/1e9, 3), "GB")
+        return total
+
+    def cleanup(self):
+        SpilledPrediction._loaded = (None, None)
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -0,0 +1,102 @@
+"""
+Sizes each generation's scoring pool so the last round of AF2 jobs keeps all
+GPUs busy, instead of leaving all but a few of them idle.
+"""
+
+import heapq
+
+def job_cost(w):
+    """predicted relative duration of a work list entry, AF2 time grows about quadratically with length"""
+    cost = 0
+    for query in w:
+        if type(query) is str:
+            query = [query]
+        cost += sum([len(seq) for seq in query])**2
+    return cost
+
+def lpt_loads(costs, n_workers):
+    """per-worker loads when jobs are handed out longest first to the least loaded worker"""
+    loads = [0]*n_workers
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return loads
+
+def fill_slots(costs, n_workers, extra_costs=(), removable=(), trim_fraction=0.5):
+    """
+    costs[i] and extra_costs[j] are the job costs of scoring unit i (one
+    sequence) and of spare unit j, spares in order of preference. removable
+    lists units that may be dropped, least wanted first.
+    Spares are added while they fit in the idle time before the current
+    makespan. If the idle time left is still more than trim_fraction of an
+    average unit per worker, removable units are dropped as long as that
+    shortens the makespan.
+    Returns the indices of the units to keep and of the spares to add.
+    """
+    keep = list(range(len(costs)))
+    jobs = [c for unit in costs for c in unit]
+    if not jobs or n_workers < 2:
+        return keep, []
+
+    makespan = max(lpt_loads(jobs, n_workers))
+    added = []
+    for j, unit in enumerate(extra_costs):
+        if sum(jobs) + sum(unit) > n_workers*makespan:
+            continue
+        if max(lpt_loads(jobs + list(unit), n_workers)) <= makespan:
+            jobs = jobs + list(unit)
+            added.append(j)
+
+    avg_unit = sum([sum(unit) for unit in costs])/len(costs)
+    idle = n_workers*makespan - sum(jobs)
+    if idle > trim_fraction*avg_unit*n_workers:
+        for i in removable:
+            kept_jobs = [c for k in keep if k != i for c in costs[k]] + [c for j in added for c in extra_costs[j]]
+            if not kept_jobs:
+                break
+            new_makespan = max(lpt_loads(kept_jobs, n_workers))
+            if new_makespan >= makespan:
+                break
+            keep.remove(i)
+            jobs = kept_jobs
+            makespan = new_makespan
+
+    print("slot filling:", len(added), "spare sequences added,", len(costs)-len(keep), "dropped, predicted GPU use",
+          round(sum(jobs)/(n_workers*makespan), 3) if makespan else 1.0)
+    return keep, added
+
+def fill_scoring_pool(scoring_pool, spares, n_workers, jobs_of, is_new, trim_fraction=0.5):
+    """
+    Tops up or trims scoring_pool for n_workers GPUs. jobs_of(dsobj) gives the
+    work list entries predicted for a sequence, spares are candidate sequences
+    in order of preference, and only sequences with is_new(dsobj) (not scored
+    before) are dropped, last ones first.
+    """
+    seen = set([dsobj.get_sequence_string() for dsobj in scoring_pool])
+    unique_spares = []
+    for s in spares:
+        if s.get_sequence_string() not in seen:
+            seen.add(s.get_sequence_string())
+            unique_spares.append(s)
+    spares = unique_spares
+    costs = [[job_cost(w) for w in jobs_of(dsobj)] for dsobj in scoring_pool]
+    extra_costs = [[job_cost(w) for w in jobs_of(dsobj)] for dsobj in spares]
+    removable = [i for i in reversed(range(len(scoring_pool))) if is_new(scoring_pool[i])]
+    keep, added = fill_slots(costs, n_workers, extra_costs, removable, trim_fraction=trim_fraction)
+    return [scoring_pool[i] for i in keep] + [spares[j] for j in added]
+
+def fill_pools(pool, scoring_pool, spares, n_workers, jobs_of, is_new, trim_fraction=0.5):
+    """
+    fill_scoring_pool, keeping pool consistent with it: sequences dropped from
+    scoring_pool leave pool too and added spares join it, so every member of
+    pool is scored and can be selected. Returns (pool, scoring_pool).
+    """
+    filled = fill_scoring_pool(scoring_pool, spares, n_workers, jobs_of, is_new, trim_fraction=trim_fraction)
+    filled_seqs = set([dsobj.get_sequence_string() for dsobj in filled])
+    dropped = set([dsobj.get_sequence_string() for dsobj in scoring_pool]) - filled_seqs
+    new_pool = [dsobj for dsobj in pool if dsobj.get_sequence_string() not in dropped]
+    pool_seqs = set([dsobj.get_sequence_string() for dsobj in new_pool])
+    new_pool = new_pool + [dsobj for dsobj in filled if dsobj.get_sequence_string() not in pool_seqs]
+    return new_pool, filled
+
+if __name__=="__main__":
+    print("no main functionality")
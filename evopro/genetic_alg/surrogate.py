@@ -0,0 +1,105 @@
+"""
+Cheap CPU surrogate of the AF2 score, trained on the sequences already in
+scored_seqs, used to pre-screen mutation/crossover children before they are
+sent to AF2.
+"""
+
+import random
+import numpy as np
+
+ALL_AAS = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L", "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]
+AA_INDEX = {aa: i for i, aa in enumerate(ALL_AAS)}
+#per designable position: 20 amino acids, deletion, number of inserted residues
+FEATS_PER_POS = len(ALL_AAS) + 2
+
+class SurrogateModel:
+    """
+    Ridge regression on one-hot features of the designable positions of a
+    DesignSeq. Features are computed once per sequence and kept, so refitting
+    every iteration only costs one small linear solve.
+    """
+
+    def __init__(self, alpha=1.0, min_train=20):
+        self.alpha = alpha
+        self.min_train = min_train
+        self.positions = None
+        self.features = {}
+        self.weights = None
+        self.bias = 0.0
+        self.num_train = 0
+
+    def featurize(self, dsobj):
+        key_seq = dsobj.get_sequence_string()
+        if key_seq in self.features:
+            return self.features[key_seq]
+
+        if self.positions is None:
+            self.positions = list(dsobj.mutable.keys())
+        x = np.zeros(len(self.positions)*FEATS_PER_POS)
+        for i, resid in enumerate(self.positions):
+            #read from mutable, DesignSeq.sequence can be shared between objects
+            aas = "".join([res["resid"][3] for res in dsobj.mutable.get(resid, [])])
+            offset = i*FEATS_PER_POS
+            if not aas:
+                x[offset + len(ALL_AAS)] = 1
+            else:
+                if aas[0] in AA_INDEX:
+                    x[offset + AA_INDEX[aas[0]]] = 1
+                x[offset + len(ALL_AAS) + 1] = len(aas) - 1
+        self.features[key_seq] = x
+        return x
+
+    def update(self, scored_seqs):
+        """refit on the current average score of every sequence in scored_seqs"""
+        X = []
+        y = []
+        for key_seq in scored_seqs:
+            X.append(self.featurize(scored_seqs[key_seq]["dsobj"]))
+            y.append(scored_seqs[key_seq]["average"][0])
+        self.num_train = len(y)
+        if not self.ready():
+            return
+
+        X = np.array(X)
+        y = np.array(y, dtype=float)
+        x_mean = X.mean(axis=0)
+        y_mean = y.mean()
+        Xc = X - x_mean
+        yc = y - y_mean
+        n, d = Xc.shape
+        #solve in whichever of sample or feature space is smaller
+        if n < d:
+            self.weights = Xc.T @ np.linalg.solve(Xc @ Xc.T + self.alpha*np.eye(n), yc)
+        else:
+            self.weights = np.linalg.solve(Xc.T @ Xc + self.alpha*np.eye(d), Xc.T @ yc)
+        self.bias = y_mean - x_mean @ self.weights
+
+    def ready(self):
+        return self.num_train >= self.min_train
+
+    def predict(self, dsobjs):
+        X = np.array([self.featurize(dsobj) for dsobj in dsobjs])
+        return X @ self.weights + self.bias
+
+def screen_children(parents, candidates, num_keep, surrogate, explore=0.1):
+    """
+    Keeps the parents and num_keep of the candidate children: the children with
+    the lowest (best) predicted score, plus a fraction explore picked at random
+    from the rest so the surrogate does not only see sequences it already likes.
+    """
+    children = [c for c in candidates if c not in parents]
+    if len(children) <= num_keep:
+        return parents + children
+
+    predicted = surrogate.predict(children)
+    order = list(np.argsort(predicted, kind="stable"))
+    num_explore = min(int(round(num_keep*explore)), num_keep)
+    num_top = num_keep - num_explore
+
+    keep = order[:num_top]
+    if num_explore > 0:
+        keep = keep + random.sample(order[num_top:], num_explore)
+    return parents + [children[i] for i in keep]
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -6,6 +6,7 @@ sys.path.append("/proj/kuhl_lab/evopro/")
 from evopro.user_inputs.inputs import FileArgumentParser
 from evopro.utils.aa_utils import three_to_one, one_to_three
 from evopro.utils.pdb_parser import get_coordinates_pdb, get_coordinates_pdb_old
+from evopro.utils.selection import ResidueIndex
 import math
 
 def parse_seqfile(filename):
@@ -58,6 +59,9 @@ def generate_json(filename, mut_res, opf, default, symmetric_res, seqfile=False)
         for chain in chains:
             chain_seqs[chain] = "".join([x for x in chain_seqs[chain] if x is not None])
         
+    #chain and number lookup of every residue, for "<" specs
+    index = ResidueIndex.from_resids(list(pdbids))
+
     mutable = []
     for resind in mut_res:
         if "*" in resind:
@@ -73,11 +77,8 @@ def generate_json(filename, mut_res, opf, default, symmetric_res, seqfile=False)
                 residue = resind.split("<")[0]
                 chain = re.split('(\d+)', residue)[0]
                 num_id = int(re.split('(\d+)', residue)[1])
-                for pdbid in pdbids:
-                    chain_compare = re.split('(\d+)', pdbid)[0]
-                    num_id_compare = int(re.split('(\d+)', pdbid)[1])
-                    if chain == chain_compare and num_id<=num_id_compare:
-                        mutable.append({"chain":pdbids[pdbid][1], "resid": pdbids[pdbid][2], "WTAA": three_to_one(pdbids[pdbid][0].split("_")[1]), "MutTo": default})
+                for pdbid in index.keys(index.range(chain, start=num_id)):
+                    mutable.append({"chain":pdbids[pdbid][1], "resid": pdbids[pdbid][2], "WTAA": three_to_one(pdbids[pdbid][0].split("_")[1]), "MutTo": default})
             except:
                 raise ValueError("Invalid specification. Try using the less than sign after the residue ID.")
             
@@ -7,6 +7,7 @@ sys.path.append("/proj/kuhl_lab/evopro/")
 from evopro.user_inputs.inputs import FileArgumentParser
 from evopro.utils.aa_utils import three_to_one, one_to_three
 from evopro.utils.pdb_parser import get_coordinates_pdb, get_coordinates_pdb_old
+from evopro.utils.selection import ResidueIndex
 import math
 
 import numpy as np
@@ -43,6 +44,7 @@ class MultiStateProteinDesignInputFormatter:
         
         # combine all PDBs into one shared object
         self.msd_pdb = ''
+        self.msd_index = None
         self.chain_dict = self.combine_pdbs(gap)
 
         # update residue specifications to match new chain IDs
@@ -73,46 +75,16 @@ class MultiStateProteinDesignInputFormatter:
             self.apply_bidirectional()
 
 
-    def _get_cluster_neighbors(self, center: str, cluster_radius: float) -> Sequence[str]:
-        
-        # Chain and residue number for center
-        center_ch, center_res = center
-        pdb_id = self.msd_pdb[:-4]
-        pdb_file = os.path.join(self.pdb_dir, pdb_id + '.pdb')
-        pdb_struct = self.parser.get_structure(id=pdb_id, file=pdb_file)
-        
-        # Get list of chains
-        chains = list(pdb_struct.get_chains())
-        # Determine cluster location
-        for chain in chains:
-            # Find correct chain
-            if chain.id == center_ch:
-                for residue in chain.get_residues():
-                    # Find correct residue
-                    if residue.id[1] == center_res:
-                        for atom in residue.get_atoms():
-                            # Find the CA atom and get its coords
-                            if atom.get_name() == 'CA':
-                                center_pos = atom.get_coord()
-                                break
-                        break
-                break
+    def _residue_index(self) -> ResidueIndex:
+        """Residue index of the MSD PDB, parsed the first time it is needed"""
+        if self.msd_index is None:
+            self.msd_index = ResidueIndex.from_pdb(self.msd_pdb, fil=True)
+        return self.msd_index
 
-        # Determine neighbors using cluster radius        
-        neighbors = []
-        for chain in chains:
-            for residue in chain.get_residues():
-                # Residue chain and number
-                res_ch, res_num = chain.id, residue.id[1]
-                
-                for atom in residue.get_atoms():
-                    # Find the CA atom and compute distance from center
-                    if atom.get_name() == 'CA':
-                        dist2center = np.sqrt(np.sum((atom.get_coord() - center_pos) ** 2) + 1e-12)
-                        # If distance is less than radius, then add to neighbor list
-                        if dist2center <= cluster_radius:
-                            neighbors.append( (res_ch, res_num) )
-        return neighbors
+    def _get_cluster_neighbors(self, centers: Sequence[Tuple[str, int]], cluster_radius: float) -> Sequence[Tuple[str, int]]:
+        """Residues with a CA within cluster_radius of the CA of any of the centers (chain, number)"""
+        index = self._residue_index()
+        return index.tuples(index.sphere(centers, cluster_radius))
 
     def _check_res_validity(self, res_item: str) -> Tuple[str, int]:
         split_item = [item for item in re.split('(\d+)', res_item) if item]
@@ -176,25 +148,33 @@ class MultiStateProteinDesignInputFormatter:
         if len(chains) > 62:
             raise ValueError('MSD intermediate is too big for PDB format - try reducing number of states used at once')
 
-    def _check_for_clashes(self, target: Structure, chain_dict: dict) -> float:
-        """Calculates minimum distance between the selected chain and the other states in the multi-state"""
-        min_dist = 1E8
-        for _, values in chain_dict.items():
-            # pull out the chains for each state and check them against all other chains - keep min distance
-            values = values.values()
-            for model in target:
-                all_chains = [c for c in model.get_chains()]
-                sel_chains = [c for c in all_chains if c.id in values]
-                other_chains = [c for c in all_chains if c not in sel_chains]
-                for sc in sel_chains:
-                    for ot in other_chains:
-                        for sel_atom in sc.get_atoms():
-                            for ot_atom in ot.get_atoms():
-                                dist = sel_atom - ot_atom
-                                if dist < min_dist:
-                                    min_dist = dist
-
-        return min_dist
+    @staticmethod
+    def _min_state_distance(state_coords: Sequence[np.ndarray], offsets: Sequence[np.ndarray], cutoff: float = 100.) -> float:
+        """
+        Minimum atom-atom distance between any two states, each shifted by its offset. Pairs of states whose
+        bounding boxes are at least cutoff apart are not compared atom by atom, and the KD-tree search stops at
+        cutoff, so if no atoms are closer than cutoff a value >= cutoff (not the exact distance) is returned.
+        """
+        from scipy.spatial import cKDTree
+        coords = [c + o for c, o in zip(state_coords, offsets)]
+        boxes = [(c.min(axis=0), c.max(axis=0)) if len(c) else None for c in coords]
+        trees = {}
+        min_dist = np.inf
+        for i, j in itertools.combinations(range(len(coords)), 2):
+            if boxes[i] is None or boxes[j] is None:
+                continue
+            # gap between axis-aligned bounding boxes, a lower bound of the atom distances
+            box_gap = np.sqrt((np.maximum(0, np.maximum(boxes[i][0] - boxes[j][1], boxes[j][0] - boxes[i][1]))**2).sum())
+            if box_gap >= min(cutoff, min_dist):
+                min_dist = min(min_dist, box_gap)
+                continue
+            if j not in trees:
+                trees[j] = cKDTree(coords[j])
+            bound = min(cutoff, min_dist)
+            dists, _ = trees[j].query(coords[i], k=1, distance_upper_bound=bound)
+            # nothing found within the bound: the states are at least bound apart
+            min_dist = min(min_dist, dists.min() if np.isfinite(dists.min()) else bound)
+        return float(min_dist)
 
     def apply_bidirectional(self):
         """Check to see if other specs are compatible with bidirectional - if so, reorder symmetry_res to reflect this; if not, ignore them"""
@@ -224,6 +204,22 @@ class MultiStateProteinDesignInputFormatter:
         self.design_res = sorted(sorted(self.design_res, key=lambda x: x[1]), key=lambda x: x[0])
         return
 
+    def _load_states(self):
+        """Parses every state PDB once, resolving disordered atoms of the states added to the first one"""
+        states = []
+        for inc, pdb in enumerate(self.pdb_list):
+            structure = self.parser.get_structure('main' if inc == 0 else 'mobile', os.path.join(self.pdb_dir, pdb))
+            if inc > 0:
+                for atom in structure.get_atoms():
+                    if atom.is_disordered():
+                        try:
+                            atom.disordered_select("A")
+                        except KeyError:
+                            raise ValueError('Failed to resolve disordered residues')
+            coords = np.array([a.get_coord() for a in structure.get_atoms()], dtype=float).reshape(-1, 3)
+            states.append((structure, coords))
+        return states
+
     def combine_pdbs(self, gap):
         """ Combines list of PDBs into one shared PDB file as needed by MPNN (separated by 1000A each). """
         min_dist = 0.
@@ -232,54 +228,19 @@ class MultiStateProteinDesignInputFormatter:
         combos = sorted(itertools.product([0, 1, 2, 3, 4, 5], repeat=3), key=lambda x: (sum(x), x))
         rand = Random(0)  # make seeded random shuffler
 
+        # each state is parsed once; offset combinations are tested on its coordinate array
+        states = self._load_states()
+        state_coords = [coords for _, coords in states]
         while min_dist < 100.:
-            # use first listed PDB as starting structure
-            initial_pdb = self.pdb_list[0]
-            target = self.parser.get_structure('main', os.path.join(self.pdb_dir, initial_pdb))
-
-            init_ch = [c.id for c in target.get_chains()]
-            init_dict = {}
-            for a, b in zip(init_ch, init_ch):
-                init_dict[a] = b
-
-            chain_dict = {initial_pdb[:-4]: init_dict}
-            no_duplicates = [c.id for c in target.get_chains()]
-            io = PDBIO()
-            chain_inc = 0
-            for model in target:  # iterate over model in target pdb
-                for inc, pdb in enumerate(self.pdb_list[1:]):
-                    mobile = self.parser.get_structure('mobile', os.path.join(self.pdb_dir, pdb))
-                    mobile_dict = {}
-                    for m in mobile:  # iterate over model in mobile pdb
-                        for chain in m:  # iterate over chain in mobile pdb
-                            # rename chains to avoid conflicts b/w files
-                            tmp = chain.id
-                            while chain.id in no_duplicates:
-                                chain.id = self.CHAIN_IDS[chain_inc]
-                                chain_inc += 1
-                            mobile_dict[tmp] = chain.id
-                            no_duplicates.append(chain.id)
-                            # add chain to target structure
-                            model.add(chain)
-                            # increment chain to be far away from other chains
-                            inc_3d = np.array(combos[inc + 1]) * gap
-                            for residue in chain:
-                                for atom in residue:
-                                    if atom.is_disordered():
-                                        try:
-                                            atom.disordered_select("A")
-                                        except KeyError:
-                                            raise ValueError('Failed to resolve disordered residues')
-                                    atom.set_coord(atom.get_coord() + inc_3d)
-
-                    chain_dict[pdb[:-4]] = mobile_dict
-            
+            # first listed PDB stays in place, the others are moved by their combo
+            offsets = [np.zeros(3)] + [np.array(combos[inc + 1]) * gap for inc in range(len(states) - 1)]
+
             # if validation is disabled, just continue outside of loop
             if self.validate == 0:
                 print('Skipping validation - Multi-state integration complete!')
                 break
             # check to see if MSD combination was successful - are all states suitably far apart?
-            min_dist = self._check_for_clashes(target, chain_dict)
+            min_dist = self._min_state_distance(state_coords, offsets, cutoff=100.)
             # randomly reorder distance spread combos if min_dist check fails
             if min_dist < 100.:
                 rand.shuffle(combos)
@@ -288,6 +249,41 @@ class MultiStateProteinDesignInputFormatter:
                     raise RuntimeError('Multi-state integration failed all attempts due to clashes between states.')
                 print('Multi-state integration failed due to clashes between states - retrying...')
 
+        # assemble the chosen combination once
+        initial_pdb = self.pdb_list[0]
+        target = states[0][0]
+
+        init_ch = [c.id for c in target.get_chains()]
+        init_dict = {}
+        for a, b in zip(init_ch, init_ch):
+            init_dict[a] = b
+
+        chain_dict = {initial_pdb[:-4]: init_dict}
+        no_duplicates = [c.id for c in target.get_chains()]
+        io = PDBIO()
+        chain_inc = 0
+        for model in target:  # iterate over model in target pdb
+            for inc, pdb in enumerate(self.pdb_list[1:]):
+                mobile = states[inc + 1][0]
+                mobile_dict = {}
+                for m in mobile:  # iterate over model in mobile pdb
+                    for chain in list(m):  # iterate over chain in mobile pdb
+                        # rename chains to avoid conflicts b/w files
+                        tmp = chain.id
+                        while chain.id in no_duplicates:
+                            chain.id = self.CHAIN_IDS[chain_inc]
+                            chain_inc += 1
+                        mobile_dict[tmp] = chain.id
+                        no_duplicates.append(chain.id)
+                        # add chain to target structure
+                        model.add(chain)
+                        # increment chain to be far away from other chains
+                        inc_3d = offsets[inc + 1]
+                        for residue in chain:
+                            for atom in residue:
+                                atom.set_coord(atom.get_coord() + inc_3d)
+
+                chain_dict[pdb[:-4]] = mobile_dict
 
         # saving modified PDB for future use
         msd_dir = os.path.join(self.pdb_dir, 'msd')
@@ -340,9 +336,8 @@ class MultiStateProteinDesignInputFormatter:
                     range_res = self._check_range_validity(item, pdb_name)
                     centers += range_res
 
-        design_res = []    
-        for center in centers:
-            design_res += self._get_cluster_neighbors(center, cluster_radius)
+        # all centers in one query
+        design_res = self._get_cluster_neighbors(centers, cluster_radius) if centers else []
         # remove duplicate chain-position pairs
         return [*set(design_res)]
 
@@ -0,0 +1,71 @@
+import os
+import sys
+sys.path.append("/proj/kuhl_lab/evopro/")
+from evopro.user_inputs.inputs import FileArgumentParser
+from evopro.utils.campaign import find_runs, SuccessiveHalving, LocalBackend, Campaign
+
+def getCampaignParser() -> FileArgumentParser:
+    """Gets an FileArgumentParser with necessary arguments to run a campaign of EvoPro runs under one controller"""
+
+    parser = FileArgumentParser(description='Runs all pairN/runM directories (from create_dirs_largerun.py) under one '
+                                'controller, stopping runs that fall behind using successive halving.',
+                                fromfile_prefix_chars='@')
+
+    parser.add_argument('--main_dir',
+                        default='./',
+                        type=str,
+                        help='Directory with the pairN/runM run directories. Default is ./')
+
+    parser.add_argument('--command',
+                        default='./run_evopro.sh',
+                        type=str,
+                        help='Command that starts EvoPro inside a run directory. Default is ./run_evopro.sh')
+
+    parser.add_argument('--gpus',
+                        default='0',
+                        type=str,
+                        help='GPUs the campaign may use, separated by commas. Default is 0.')
+
+    parser.add_argument('--gpus_per_run',
+                        default=1,
+                        type=int,
+                        help='GPUs given to each run (should match --num_gpus in its flags). Default is 1.')
+
+    parser.add_argument('--min_iters',
+                        default=10,
+                        type=int,
+                        help='Iterations before runs are first ranked. Default is 10.')
+
+    parser.add_argument('--eta',
+                        default=2,
+                        type=int,
+                        help='At each ranking only the best 1/eta of the runs continue, and the next ranking is after'
+                        ' eta times as many iterations. Default is 2.')
+
+    parser.add_argument('--poll_interval',
+                        default=60,
+                        type=float,
+                        help='Seconds between checks of run progress. Default is 60.')
+    return parser
+
+if __name__=="__main__":
+    parser = getCampaignParser()
+    args = parser.parse_args(sys.argv[1:])
+
+    main_dir = os.path.abspath(args.main_dir)
+    run_dirs = find_runs(main_dir)
+    if not run_dirs:
+        raise ValueError("No pairN/runM directories found in " + main_dir)
+    print("campaign of", len(run_dirs), "runs")
+
+    gpus = [x.strip() for x in args.gpus.split(",") if x.strip()]
+    if len(gpus) < args.gpus_per_run:
+        raise ValueError("Need at least " + str(args.gpus_per_run) + " GPUs per run.")
+    backend = LocalBackend(gpus, gpus_per_run=args.gpus_per_run)
+    scheduler = SuccessiveHalving(min_iters=args.min_iters, eta=args.eta)
+
+    campaign = Campaign(run_dirs, backend, scheduler, args.command,
+                        status_file=os.path.join(main_dir, "campaign_status.json"), poll_interval=args.poll_interval)
+    states = campaign.run()
+    for state in ["finished", "stopped", "failed"]:
+        print(state + ":", len([r for r in states if states[r] == state]))
@@ -6,12 +6,23 @@ from typing import Sequence, Union
 sys.path.append("/proj/kuhl_lab/evopro/")
 from evopro.genetic_alg.DesignSeq import DesignSeq
 from evopro.utils.distributor import Distributor
+from evopro.utils.prediction_server import PredictionClient
+from evopro.utils.campaign import campaign_gpus
 from evopro.utils.plot_scores import plot_scores_stabilize_monomer_top, plot_scores_stabilize_monomer_avg, plot_scores_stabilize_monomer_median
 from evopro.run.generate_json import parse_mutres_input
-from evopro.genetic_alg.geneticalg_helpers import read_starting_seqs, create_new_seqs, create_new_seqs_mpnn
+from evopro.genetic_alg.geneticalg_helpers import read_starting_seqs, create_new_seqs, create_new_seqs_mpnn, af2_init_compiled, af2_init_cached_features, af2_init_cascade
+from evopro.genetic_alg.cascade import cascade_job, run_cascade, merge_fidelity, selection_key
 from evopro.user_inputs.inputs import getEvoProParser
 from evopro.utils.plots import get_chain_lengths, plot_pae, plot_plddt
 from evopro.utils.utils import compressed_pickle
+from evopro.utils.scoring import score_in_worker, ParallelScorer, score_generation
+from evopro.genetic_alg.surrogate import SurrogateModel, screen_children
+from evopro.genetic_alg.slot_fill import fill_pools
+from evopro.genetic_alg.islands import MigrationChannel, migrate
+from evopro.genetic_alg.repeat_policy import RepeatScheduler, selection_cutoff
+from evopro.genetic_alg.score_store import ScoreStore
+from evopro.utils.prediction_cache import PredictionCache, SharedPredictionCache, churn_deduplicated
+from evopro.score_funcs.score_spec import compile_spec
 
 sys.path.append('/proj/kuhl_lab/alphafold/run')
 from run_af2 import af2_init
@@ -23,7 +34,14 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                                rmsd_func=None, rmsd_to_starting_func=None, rmsd_to_starting_pdb=None,
                                mpnn_temp="0.1", mpnn_version="s_48_020", skip_mpnn=[], mpnn_iters=None, 
                                repeat_af2=True, af2_preds_extra=[], crossover_percent=0.2, vary_length=0, 
-                               write_pdbs=False, plot=[], conf_plot=False, write_compressed_data=True):
+                               write_pdbs=False, plot=[], conf_plot=False, write_compressed_data=True, prediction_server=None,
+                               mmap_results=False, drop_result_keys=None, score_in_workers=False, scoring_cpus=0,
+                               surrogate_oversample=1, surrogate_explore=0.1,
+                               repeat_af2_max=5, repeat_af2_confidence=None, memory_budget=None,
+                               prediction_cache_size=0, cache_chain_features=False, cascade=False, cascade_recycles=1,
+                               cascade_keep=0.5, cascade_threshold=None, jax_cache_dir=None, batch_jobs=1, fill_gpu_slots=False,
+                               island_id=None, num_islands=1, migration_dir=None, migration_interval=5, migration_top_k=2,
+                               migration_topology="ring"):
 
     num_af2=0
     
@@ -36,12 +54,63 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
 
     print(lengths)
 
-    print("initializing distributor")
-    dist = Distributor(n_workers, af2_init, af2_flags_file, lengths)
+    if prediction_server:
+        if cascade or cache_chain_features:
+            #server workers are started with the plain AF2 init and cannot run cascade jobs or cache chain features
+            raise ValueError("--cascade and --cache_chain_features need evopro's own AF2 workers and cannot be used with --prediction_server.")
+        print("connecting to prediction server at", prediction_server)
+        dist = PredictionClient(prediction_server)
+        if score_in_workers:
+            print("scoring in the driver, prediction server workers do not run score functions")
+            score_in_workers = False
+    else:
+        post_func = None
+        if score_in_workers:
+            post_func = partial(score_in_worker, score_func=score_func, contacts=contacts, distance_cutoffs=distance_cutoffs)
+        print("initializing distributor")
+        f_init = af2_init
+        init_kwargs = {}
+        if jax_cache_dir or campaign_gpus() is not None:
+            #compiles through evopro, which uses the persistent compilation cache and stays on the GPUs a campaign gave this run
+            f_init = af2_init_compiled
+        if jax_cache_dir:
+            init_kwargs["jax_cache_dir"] = jax_cache_dir
+        if cache_chain_features:
+            f_init = af2_init_cached_features
+        if cascade:
+            f_init = af2_init_cascade
+            init_kwargs["cheap_recycles"] = cascade_recycles
+            init_kwargs["cache_chain_features"] = cache_chain_features
+        if init_kwargs:
+            f_init = partial(f_init, **init_kwargs)
+        dist = Distributor(n_workers, f_init, af2_flags_file, lengths, mmap_results=mmap_results, drop_keys=drop_result_keys,
+                           post_func=post_func, batch_size=batch_jobs)
+
+    parallel_scorer = None
+    if scoring_cpus > 1 and not score_in_workers:
+        print("scoring on", scoring_cpus, "cpus")
+        parallel_scorer = ParallelScorer(scoring_cpus)
+
+    surrogate = None
+    if surrogate_oversample > 1:
+        print("pre-screening", surrogate_oversample, "x children with a surrogate model")
+        surrogate = SurrogateModel()
+
+    prediction_cache = None
+    if prediction_cache_size > 0 and not repeat_af2:
+        #with repeat_af2 the same prediction is meant to be repeated, so only dedupe within an iteration
+        if island_id is not None and migration_dir:
+            #islands share their predictions through the migration directory
+            prediction_cache = SharedPredictionCache(os.path.join(migration_dir, "prediction_cache"), prediction_cache_size)
+        else:
+            prediction_cache = PredictionCache(prediction_cache_size)
 
     scored_seqs = {}
+    repeat_scheduler = None
     if repeat_af2:
         repeat_af2_seqs = {}
+        #the pool is ranked by the mean of the best 3 predictions of each sequence
+        repeat_scheduler = RepeatScheduler(max_repeats=repeat_af2_max, confidence=repeat_af2_confidence, top_k=3)
     curr_iter = 1
     seqs_per_iteration = []
     newpool = startingseqs
@@ -59,6 +128,50 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         if not os.path.isdir(pdb_folder):
             os.makedirs(pdb_folder)
 
+    score_store = None
+    if memory_budget:
+        #pdbs and AF2 results beyond the budget are kept on disk until the end of the run
+        score_store = ScoreStore(output_dir + "spilled_predictions/", memory_budget*1e9)
+
+    migration = None
+    if island_id is not None and migration_dir:
+        print("running as island", island_id, "of", num_islands, "migrating through", migration_dir)
+        migration = MigrationChannel(migration_dir, island_id, num_islands, topology=migration_topology)
+
+    def jobs_of(dsobj):
+        """work list entries predicted for dsobj"""
+        jobs = [[[dsobj.jsondata["sequence"][chain] for chain in dsobj.jsondata["sequence"]]]]
+        for chains in af2_preds_extra:
+            jobs.append([[dsobj.jsondata["sequence"][chain] for chain in list(chains)]])
+        return jobs
+
+    def predict_and_score(work_list, dsobjs):
+        """predicts and scores each entry of work_list, returns the scores and the number of predictions made"""
+        if score_in_workers:
+            #workers already scored each prediction right after making it
+            all_scores = dist.churn(work_list, job_args=[(dsobj,) for dsobj in dsobjs])
+            print("done churning and scoring")
+            return all_scores, len(work_list)
+
+        #predictions shared between sequences (e.g. an unchanged binder alone) are only made once
+        results, num_predicted = churn_deduplicated(dist, work_list, cache=prediction_cache)
+        print("done churning, predicted", num_predicted, "of", len(work_list), "jobs")
+
+        #score the af2 results, as one batch if the score function has a batch version
+        results_unpacked = []
+        for result in results:
+            while type(result) is list:
+                result = result[0]
+            results_unpacked.append(result)
+        score_kwargs = {}
+        if contacts is not None:
+            score_kwargs = {"contacts": contacts, "distance_cutoffs": distance_cutoffs}
+        if parallel_scorer:
+            all_scores = parallel_scorer.score(score_func, results_unpacked, dsobjs, **score_kwargs)
+        else:
+            all_scores = score_generation(score_func, results_unpacked, dsobjs, **score_kwargs)
+        return all_scores, num_predicted
+
     #start genetic algorithm iteration
     while curr_iter <= num_iter:
         all_seqs = []
@@ -78,12 +191,36 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         #otherwise refilling pool with just mutations and crossovers
         else:
             print("Iteration " + str(curr_iter) + ": refilling with mutation and " + str(crossover_percent*100) + "% crossover.")
-            pool = create_new_seqs(pool, poolsizes[curr_iter-1], crossover_percent=crossover_percent, mut_percent=mut_percents[curr_iter-1], all_seqs = list(scored_seqs.keys()), vary_length=vary_length)
+            num_children = poolsizes[curr_iter-1] - len(pool)
+            num_seqs = poolsizes[curr_iter-1]
+            if surrogate and surrogate.ready():
+                #oversample children and only send the ones the surrogate ranks best to AF2
+                num_seqs = len(pool) + surrogate_oversample*num_children
+            candidates = create_new_seqs(pool, num_seqs, crossover_percent=crossover_percent, mut_percent=mut_percents[curr_iter-1], all_seqs = list(scored_seqs.keys()), vary_length=vary_length)
+            if surrogate and surrogate.ready():
+                pool = screen_children(pool, candidates, num_children, surrogate, explore=surrogate_explore)
+            else:
+                pool = candidates
         
         if repeat_af2:
             scoring_pool = [p for p in pool if p.get_sequence_string() not in repeat_af2_seqs]
         else:
             scoring_pool = [p for p in pool if p.get_sequence_string() not in scored_seqs]
+
+        if fill_gpu_slots and not prediction_server:
+            #top up or trim the work so the last round of AF2 jobs keeps every GPU busy
+            spares = []
+            if repeat_af2:
+                #repeat predictions of the best sequences that are not settled yet
+                unsettled = sorted([k for k in scored_seqs if k not in repeat_af2_seqs], key=lambda k: scored_seqs[k]["average"][0])
+                spares = [scored_seqs[k]["dsobj"] for k in unsettled]
+            new_seqs = create_new_seqs(pool, len(pool) + n_workers, crossover_percent=0, mut_percent=mut_percents[curr_iter-1],
+                                       all_seqs = list(scored_seqs.keys()), vary_length=vary_length)
+            pool_seqs = set([p.get_sequence_string() for p in pool])
+            spares = spares + [s for s in new_seqs if s.get_sequence_string() not in pool_seqs]
+            #dropped sequences also leave the pool and added spares join it, so all of pool gets scored
+            pool, scoring_pool = fill_pools(pool, scoring_pool, spares, n_workers, jobs_of,
+                                            lambda dsobj: dsobj.get_sequence_string() not in scored_seqs)
         
         work_list = [[[dsobj.jsondata["sequence"][chain] for chain in dsobj.jsondata["sequence"]]] for dsobj in scoring_pool]
 
@@ -99,10 +236,6 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
             work_list_all = work_list
 
         print("work list", work_list_all)
-        num_af2 += len(work_list_all)
-
-        results = dist.churn(work_list_all)
-        print("done churning")
 
         if af2_preds_extra:
             num_lists = 1 + len(af2_preds_extra)
@@ -113,15 +246,16 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         for n in range(num_lists):
             scoring_dsobjs = scoring_dsobjs + scoring_pool
 
-        all_scores = []
-        #score the af2 results
-        for seq, result, dsobj in zip(work_list_all, results, scoring_dsobjs):
-            while type(result) is list:
-                result = result[0]
-            if contacts is not None:
-                all_scores.append(score_func(result, dsobj, contacts=contacts, distance_cutoffs=distance_cutoffs))
-            else:
-                all_scores.append(score_func(result, dsobj))
+        if cascade:
+            #cheap prediction of every sequence first, full prediction only for the best ones
+            job_seqs = [i % len(scoring_pool) for i in range(len(work_list_all))]
+            all_scores, fidelities, num_predicted = run_cascade(len(work_list_all), job_seqs,
+                                                                lambda inds, fidelity: predict_and_score([cascade_job(work_list_all[i], fidelity) for i in inds], [scoring_dsobjs[i] for i in inds]),
+                                                                lambda x: sum([score[0] for score in x]), keep=cascade_keep, threshold=cascade_threshold)
+        else:
+            all_scores, num_predicted = predict_and_score(work_list_all, scoring_dsobjs)
+            fidelities = ["full" for dsobj in scoring_pool]
+        num_af2 += num_predicted
 
         #separating complex and binder sequences, if needed
         complex_seqs = []
@@ -170,8 +304,10 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         #adding sequences and scores into the dictionary
         if af2_preds_extra:
             print("adding sequences and scores into the dictionary, with af2_preds_extra")
-            for dsobj, seq, cscore, bscores in zip(scoring_pool, complex_seqs, complex_scores, binder_scores):
+            for dsobj, seq, cscore, bscores, fidelity in zip(scoring_pool, complex_seqs, complex_scores, binder_scores, fidelities):
                 key_seq = dsobj.get_sequence_string()
+                if not merge_fidelity(scored_seqs, key_seq, fidelity, repeat_scheduler):
+                    continue
                 print(key_seq)
                 if key_seq != ",".join(seq[0]):
                     print(key_seq, str(seq[0]))
@@ -195,6 +331,7 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                 pdb = (cscore[-2], [bscore[-2] for bscore in bscores])
                 result = (cscore[-1], [bscore[-1] for bscore in bscores])
                 if repeat_af2:
+                    repeat_scheduler.add(key_seq, score[0][0])
                     if key_seq in scored_seqs:
                         scored_seqs[key_seq]["data"].append({"score": score, "pdb": pdb, "result": result})
                         scored_seqs[key_seq]["data"].sort(key=lambda x: x["score"][0][0])
@@ -214,10 +351,13 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                 else:
                     scored_seqs[key_seq] = {"dsobj": dsobj, "data": [{"score": score, "pdb": pdb, "result": result}]}
                     scored_seqs[key_seq]["average"] = score[0]
+                scored_seqs[key_seq]["fidelity"] = fidelity
         else:
             print("adding sequences and scores into the dictionary, no extra af2 preds")
-            for dsobj, seq, cscore in zip(scoring_pool, complex_seqs, complex_scores):
+            for dsobj, seq, cscore, fidelity in zip(scoring_pool, complex_seqs, complex_scores, fidelities):
                 key_seq = dsobj.get_sequence_string()
+                if not merge_fidelity(scored_seqs, key_seq, fidelity, repeat_scheduler):
+                    continue
                 print(key_seq)
                 if rmsd_to_starting_func:
                     rmsd_score = rmsd_to_starting_func(bscore[-2], rmsd_to_starting_pdb, dsobj=dsobj)
@@ -226,6 +366,7 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                 pdb = (cscore[-2], None)
                 result = (cscore[-1], )
                 if repeat_af2:
+                    repeat_scheduler.add(key_seq, score[0][0])
                     if key_seq in scored_seqs:
                         scored_seqs[key_seq]["data"].append({"score": score, "pdb": pdb, "result": result})
                         print("before sorting")
@@ -249,12 +390,16 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                 else:
                     scored_seqs[key_seq] = {"dsobj": dsobj, "data": [{"score": score, "pdb": pdb, "result": result}]}
                     scored_seqs[key_seq]["average"] = score[0]
+                scored_seqs[key_seq]["fidelity"] = fidelity
 
         if repeat_af2:
             for key_seq in scored_seqs:
-                if len(scored_seqs[key_seq]["data"]) >=5:
+                if repeat_scheduler.settled(key_seq):
                     repeat_af2_seqs[key_seq] = scored_seqs[key_seq]["average"]
             print("repeat_af2_seqs", repeat_af2_seqs)
+
+        if surrogate:
+            surrogate.update(scored_seqs)
         
         #creating sorted list version of sequences and scores in the pool
         sorted_scored_pool = []
@@ -284,7 +429,8 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                                 pdbf.write(str(pdbs[0]))
         
         print("before sorting", sorted_scored_pool)
-        sorted_scored_pool.sort(key = lambda x: x[1][0])
+        #cheap cascade scores are never ranked above full-fidelity ones
+        sorted_scored_pool.sort(key=selection_key(scored_seqs))
         print("after sorting", sorted_scored_pool)
         seqs_per_iteration.append(sorted_scored_pool)
 
@@ -306,17 +452,33 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
             newpool_size = round(poolsizes[curr_iter]/2)
         else:
             pass
+
+        if repeat_af2 and repeat_af2_confidence:
+            #stop repeating sequences that are confidently above or below the selection cutoff
+            cutoff = selection_cutoff(sorted_scored_pool, newpool_size)
+            for key_seq, avg in sorted_scored_pool:
+                if key_seq not in repeat_af2_seqs and repeat_scheduler.settled(key_seq, cutoff):
+                    repeat_af2_seqs[key_seq] = scored_seqs[key_seq]["average"]
+
         newpool_seqs = []
         for sp in sorted_scored_pool[:newpool_size]:
             newpool_seqs.append(sp[0])
         print("newpool", newpool_seqs)
 
+        if migration and curr_iter % migration_interval == 0:
+            #exchange the best sequences with other islands
+            newpool_seqs = migrate(migration, curr_iter, scored_seqs, newpool_seqs, migration_top_k, repeat_scheduler=repeat_scheduler)
+            print("newpool after migration", newpool_seqs)
+
         newpool = []
         #pulling back DS objects for each sequence in new pool
         for key_seq, j in zip(newpool_seqs, range(len(newpool_seqs))):
             newpool.append(scored_seqs[key_seq]["dsobj"])
             #pdbs = scored_seqs[key_seq]["data"][0]["pdb"]
 
+        if score_store:
+            score_store.trim(scored_seqs, keep=newpool_seqs)
+
         curr_iter+=1
 
     with open(output_dir+"seqs_and_scores.log", "w") as logf:
@@ -384,6 +546,10 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                         pdbf.write(str(pdbs[0]))
 
     print("Number of AlphaFold2 predictions: ", num_af2)
+    if score_store:
+        score_store.cleanup()
+    if parallel_scorer:
+        parallel_scorer.shutdown()
     dist.spin_down()
 
 if __name__ == "__main__":
@@ -446,16 +612,25 @@ if __name__ == "__main__":
 
 
     #get score function from flags file
-    try:
-        scorefile = args.score_file.rsplit("/", 1)
-        scorepath = scorefile[0]
-        scorefilename = scorefile[1].split(".")[0]
+    if args.score_file.endswith((".json", ".yaml", ".yml")):
+        #declarative score spec, compiled into a score function
+        scorefunc = compile_spec(args.score_file)
+        mod = None
+    else:
+        try:
+            scorefile = args.score_file.rsplit("/", 1)
+            scorepath = scorefile[0]
+            scorefilename = scorefile[1].split(".")[0]
 
-        sys.path.append(scorepath)
-        mod = importlib.import_module(scorefilename)
-        scorefunc = getattr(mod, args.score_func)
-    except:
-        raise ValueError("Invalid score function")
+            sys.path.append(scorepath)
+            mod = importlib.import_module(scorefilename)
+            scorefunc = getattr(mod, args.score_func)
+        except:
+            raise ValueError("Invalid score function")
+
+    if mod is None and (args.rmsd_func or args.rmsd_to_starting):
+        raise ValueError("--rmsd_func and --rmsd_to_starting need a python score file. With a score spec ("
+                         + args.score_file + "), use a rmsd_to_reference term in the spec for RMSDs to a starting structure.")
 
     if args.rmsd_func:
         rmsdfunc = getattr(mod, args.rmsd_func)
@@ -548,12 +723,26 @@ if __name__ == "__main__":
     if args.af2_preds_extra:
         af2_preds_extra = args.af2_preds_extra.strip().split(",")
                                    
+    drop_result_keys = None
+    if args.drop_result_keys:
+        drop_result_keys = [x.strip() for x in args.drop_result_keys.split(",")]
+
     run_genetic_alg_multistate(input_dir, input_dir + flagsfile, scorefunc, starting_seqs, poolsizes=pool_sizes, 
         num_iter = args.num_iter, n_workers=args.num_gpus, mut_percents=mut_percents, contacts=contacts, distance_cutoffs=distance_cutoffs,
         rmsd_func=rmsdfunc, rmsd_to_starting_func=rmsd_to_starting_func, rmsd_to_starting_pdb=path_to_starting,
         mpnn_temp=args.mpnn_temp, mpnn_version=args.mpnn_version, skip_mpnn=mpnn_skips, mpnn_iters=mpnn_iters, 
         repeat_af2=not args.no_repeat_af2, af2_preds_extra = af2_preds_extra, crossover_percent=args.crossover_percent, vary_length=args.vary_length, 
-        write_pdbs=args.write_pdbs, plot=plot_style, conf_plot=args.plot_confidences, write_compressed_data=not args.dont_write_compressed_data)
+        write_pdbs=args.write_pdbs, plot=plot_style, conf_plot=args.plot_confidences, write_compressed_data=not args.dont_write_compressed_data,
+        prediction_server=args.prediction_server, mmap_results=args.mmap_results, drop_result_keys=drop_result_keys,
+        score_in_workers=args.score_in_workers, scoring_cpus=args.scoring_cpus,
+        surrogate_oversample=args.surrogate_oversample, surrogate_explore=args.surrogate_explore,
+        repeat_af2_max=args.repeat_af2_max, repeat_af2_confidence=args.repeat_af2_confidence,
+        memory_budget=args.memory_budget, prediction_cache_size=args.prediction_cache_size,
+        cache_chain_features=args.cache_chain_features, cascade=args.cascade, cascade_recycles=args.cascade_recycles,
+        cascade_keep=args.cascade_keep, cascade_threshold=args.cascade_threshold, jax_cache_dir=args.jax_cache_dir,
+        batch_jobs=args.batch_jobs, fill_gpu_slots=args.fill_gpu_slots, island_id=args.island_id, num_islands=args.num_islands,
+        migration_dir=args.migration_dir, migration_interval=args.migration_interval, migration_top_k=args.migration_top_k,
+        migration_topology=args.migration_topology)
         
         
         
@@ -6,22 +6,41 @@ from typing import Sequence, Union
 sys.path.append("/proj/kuhl_lab/evopro/")
 from evopro.genetic_alg.DesignSeq import DesignSeq
 from evopro.utils.distributor import Distributor
+from evopro.utils.prediction_server import PredictionClient
+from evopro.utils.campaign import campaign_gpus
 from evopro.utils.plot_scores import plot_scores_general_dev
 from evopro.run.generate_json import parse_mutres_input
-from evopro.genetic_alg.geneticalg_helpers import read_starting_seqs, create_new_seqs, create_new_seqs_mpnn
+from evopro.genetic_alg.geneticalg_helpers import read_starting_seqs, create_new_seqs, create_new_seqs_mpnn, af2_init_compiled, af2_init_cached_features, af2_init_cascade
+from evopro.genetic_alg.cascade import cascade_job, run_cascade, merge_fidelity, selection_key
 from evopro.user_inputs.inputs import getEvoProParser
 from evopro.utils.plots import get_chain_lengths, plot_pae, plot_plddt
 from evopro.utils.utils import compressed_pickle
 from evopro.utils.pdb_parser import change_chainid_pdb, append_pdbs
+from evopro.utils.scoring import ParallelScorer, score_generation
+from evopro.genetic_alg.surrogate import SurrogateModel, screen_children
+from evopro.genetic_alg.slot_fill import fill_pools
+from evopro.genetic_alg.islands import MigrationChannel, migrate
+from evopro.genetic_alg.repeat_policy import RepeatScheduler, selection_cutoff
+from evopro.genetic_alg.score_store import ScoreStore
+from evopro.utils.prediction_cache import PredictionCache, SharedPredictionCache, churn_deduplicated
+from evopro.score_funcs.score_spec import compile_spec
 
 sys.path.append('/proj/kuhl_lab/alphafold/run')
 from run_af2 import af2_init
+from functools import partial
 
 def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs, poolsizes = [], 
                                num_iter = 50, n_workers=1, mut_percents=None, contacts=None, 
                                mpnn_temp="0.1", mpnn_version="s_48_020", skip_mpnn=[], mpnn_iters=None, mpnn_chains=None,
                                repeat_af2=True, af2_preds=[], crossover_percent=0.2, vary_length=0, 
-                               write_pdbs=False, plot=[], conf_plot=False, write_compressed_data=True):
+                               write_pdbs=False, plot=[], conf_plot=False, write_compressed_data=True, prediction_server=None,
+                               mmap_results=False, drop_result_keys=None, scoring_cpus=0,
+                               surrogate_oversample=1, surrogate_explore=0.1,
+                               repeat_af2_max=5, repeat_af2_confidence=None, memory_budget=None,
+                               prediction_cache_size=0, cache_chain_features=False, cascade=False, cascade_recycles=1,
+                               cascade_keep=0.5, cascade_threshold=None, jax_cache_dir=None, batch_jobs=1, fill_gpu_slots=False,
+                               island_id=None, num_islands=1, migration_dir=None, migration_interval=5, migration_top_k=2,
+                               migration_topology="ring"):
 
     num_af2=0
     
@@ -34,12 +53,56 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
 
     print("Compiling AF2 models for lengths:", lengths)
 
-    print("Initializing distributor")
-    dist = Distributor(n_workers, af2_init, af2_flags_file, lengths)
+    if prediction_server:
+        if cascade or cache_chain_features:
+            #server workers are started with the plain AF2 init and cannot run cascade jobs or cache chain features
+            raise ValueError("--cascade and --cache_chain_features need evopro's own AF2 workers and cannot be used with --prediction_server.")
+        print("Connecting to prediction server at", prediction_server)
+        dist = PredictionClient(prediction_server)
+    else:
+        print("Initializing distributor")
+        f_init = af2_init
+        init_kwargs = {}
+        if jax_cache_dir or campaign_gpus() is not None:
+            #compiles through evopro, which uses the persistent compilation cache and stays on the GPUs a campaign gave this run
+            f_init = af2_init_compiled
+        if jax_cache_dir:
+            init_kwargs["jax_cache_dir"] = jax_cache_dir
+        if cache_chain_features:
+            f_init = af2_init_cached_features
+        if cascade:
+            f_init = af2_init_cascade
+            init_kwargs["cheap_recycles"] = cascade_recycles
+            init_kwargs["cache_chain_features"] = cache_chain_features
+        if init_kwargs:
+            f_init = partial(f_init, **init_kwargs)
+        dist = Distributor(n_workers, f_init, af2_flags_file, lengths, mmap_results=mmap_results, drop_keys=drop_result_keys,
+                           batch_size=batch_jobs)
+
+    parallel_scorer = None
+    if scoring_cpus > 1:
+        print("Scoring on", scoring_cpus, "cpus")
+        parallel_scorer = ParallelScorer(scoring_cpus)
+
+    surrogate = None
+    if surrogate_oversample > 1:
+        print("Pre-screening", surrogate_oversample, "x children with a surrogate model")
+        surrogate = SurrogateModel()
+
+    prediction_cache = None
+    if prediction_cache_size > 0 and not repeat_af2:
+        #with repeat_af2 the same state is meant to be predicted again, so only dedupe within an iteration
+        if island_id is not None and migration_dir:
+            #islands share their predictions through the migration directory
+            prediction_cache = SharedPredictionCache(os.path.join(migration_dir, "prediction_cache"), prediction_cache_size)
+        else:
+            prediction_cache = PredictionCache(prediction_cache_size)
 
     scored_seqs = {}
+    repeat_scheduler = None
     if repeat_af2:
         repeat_af2_seqs = {}
+        repeat_scheduler = RepeatScheduler(max_repeats=repeat_af2_max, confidence=repeat_af2_confidence)
     curr_iter = 1
     seqs_per_iteration = []
     newpool = startingseqs
@@ -57,10 +120,65 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         pdb_folder = output_dir + "pdbs_per_iter/"
         if not os.path.isdir(pdb_folder):
             os.makedirs(pdb_folder)
+
+    score_store = None
+    if memory_budget:
+        #pdbs and AF2 results beyond the budget are kept on disk until the end of the run
+        score_store = ScoreStore(output_dir + "spilled_predictions/", memory_budget*1e9)
+
+    migration = None
+    if island_id is not None and migration_dir:
+        print("running as island", island_id, "of", num_islands, "migrating through", migration_dir)
+        migration = MigrationChannel(migration_dir, island_id, num_islands, topology=migration_topology)
             
     if not mpnn_chains:
         mpnn_chains = [af2_preds[0]]
 
+    if not contacts:
+        contacts=(None, None, None)
+
+    def jobs_of(dsobj):
+        """work list entries predicted for dsobj"""
+        return [[[dsobj.jsondata["sequence"][chain] for chain in c]] for c in af2_preds]
+
+    def predict_and_score(dsobjs, fidelity=None):
+        """
+        predicts every state in af2_preds of each sequence in dsobjs and scores them.
+        Returns (score, state results) per sequence and the number of predictions made.
+        """
+        work_list_all = []
+        for p in dsobjs:
+            for c in af2_preds:
+                w = [[p.jsondata["sequence"][chain] for chain in c]]
+                if fidelity:
+                    w = cascade_job(w, fidelity)
+                work_list_all.append(w)
+        
+        print("work list", work_list_all)
+
+        #states shared between sequences (e.g. an unchanged chain) are only predicted once
+        results, num_predicted = churn_deduplicated(dist, work_list_all, cache=prediction_cache)
+        print("predicted", num_predicted, "of", len(work_list_all), "states")
+        results_all = []
+        for result in results:
+            while type(result) == list:
+                result = result[0]
+            results_all.append(result)
+            
+        print("done churning")
+        
+        seqs_packed = [work_list_all[i:i+num_preds] for i in range(0, len(work_list_all), num_preds)]
+        results_packed = [results_all[i:i+num_preds] for i in range(0, len(results_all), num_preds)]
+
+        print("These should be equal", len(work_list_all), len(results_all), num_preds*len(results_packed))
+        
+        #as one batch if the score function has a batch version
+        if parallel_scorer:
+            scores = parallel_scorer.score(score_func, results_packed, dsobjs, contacts=contacts)
+        else:
+            scores = score_generation(score_func, results_packed, dsobjs, contacts=contacts)
+        return list(zip(scores, results_packed)), num_predicted
+
     #start genetic algorithm iteration
     while curr_iter <= num_iter:
         all_seqs = []
@@ -95,49 +213,57 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
         #otherwise refilling pool with just mutations and crossovers
         else:
             print("\nIteration " + str(curr_iter) + ": refilling with mutation and " + str(crossover_percent*100) + "% crossover.")
-            pool = create_new_seqs(pool, 
-                                   poolsizes[curr_iter-1], 
+            num_children = poolsizes[curr_iter-1] - len(pool)
+            num_seqs = poolsizes[curr_iter-1]
+            if surrogate and surrogate.ready():
+                #oversample children and only send the ones the surrogate ranks best to AF2
+                num_seqs = len(pool) + surrogate_oversample*num_children
+            candidates = create_new_seqs(pool, 
+                                   num_seqs, 
                                    crossover_percent=crossover_percent, 
                                    mut_percent=mut_percents[curr_iter-1], 
                                    all_seqs = list(scored_seqs.keys()), 
                                    vary_length=vary_length)
+            if surrogate and surrogate.ready():
+                pool = screen_children(pool, candidates, num_children, surrogate, explore=surrogate_explore)
+            else:
+                pool = candidates
 
         if repeat_af2:
             scoring_pool = [p for p in pool if p.get_sequence_string() not in repeat_af2_seqs]
         else:
             scoring_pool = [p for p in pool if p.get_sequence_string() not in scored_seqs]
-        
-        work_list_all = []
-        for p in scoring_pool:
-            for c in af2_preds:
-                work_list_all.append([[p.jsondata["sequence"][chain] for chain in c]])
-        
-        print("work list", work_list_all)
-        num_af2 += len(work_list_all)
-
-        results = dist.churn(work_list_all)
-        results_all = []
-        for result in results:
-            while type(result) == list:
-                result = result[0]
-            results_all.append(result)
-            
-        print("done churning")
-        
-        seqs_packed = [work_list_all[i:i+num_preds] for i in range(0, len(work_list_all), num_preds)]
-        results_packed = [results_all[i:i+num_preds] for i in range(0, len(results_all), num_preds)]
 
-        print("These should be equal", len(work_list_all), len(results_all), num_preds*len(results_packed))
+        if fill_gpu_slots and not prediction_server:
+            #top up or trim the work so the last round of AF2 jobs keeps every GPU busy
+            spares = []
+            if repeat_af2:
+                #repeat predictions of the best sequences that are not settled yet
+                unsettled = sorted([k for k in scored_seqs if k not in repeat_af2_seqs], key=lambda k: scored_seqs[k]["average"][0])
+                spares = [scored_seqs[k]["dsobj"] for k in unsettled]
+            new_seqs = create_new_seqs(pool, len(pool) + n_workers, crossover_percent=0, mut_percent=mut_percents[curr_iter-1],
+                                       all_seqs = list(scored_seqs.keys()), vary_length=vary_length)
+            pool_seqs = set([p.get_sequence_string() for p in pool])
+            spares = spares + [s for s in new_seqs if s.get_sequence_string() not in pool_seqs]
+            #dropped sequences also leave the pool and added spares join it, so all of pool gets scored
+            pool, scoring_pool = fill_pools(pool, scoring_pool, spares, n_workers, jobs_of,
+                                            lambda dsobj: dsobj.get_sequence_string() not in scored_seqs)
         
-        scores = []
-        if not contacts:
-            contacts=(None, None, None)
-        for seqs, results, dsobj in zip(seqs_packed, results_packed, scoring_pool):
-            scores.append(score_func(results, dsobj, contacts=contacts))
+        if cascade:
+            #cheap prediction of every sequence first, full prediction only for the best ones
+            scored, fidelities, num_predicted = run_cascade(len(scoring_pool), list(range(len(scoring_pool))),
+                                                            lambda inds, fidelity: predict_and_score([scoring_pool[i] for i in inds], fidelity),
+                                                            lambda x: x[0][0][0], keep=cascade_keep, threshold=cascade_threshold)
+        else:
+            scored, num_predicted = predict_and_score(scoring_pool)
+            fidelities = ["full" for p in scoring_pool]
+        num_af2 += num_predicted
         
         #adding sequences and scores into the dictionary
-        for score, seqs, results, dsobj in zip(scores, seqs_packed, results_packed, scoring_pool):
+        for (score, results), dsobj, fidelity in zip(scored, scoring_pool, fidelities):
             key_seq = dsobj.get_sequence_string()
+            if not merge_fidelity(scored_seqs, key_seq, fidelity, repeat_scheduler):
+                continue
             #print(seqs)
             #if key_seq != ",".join(seqs[0]):
             #        print(key_seq, str(seqs[0]))
@@ -151,8 +277,11 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
             print(key_seq, overall_scores, score_split)
             #print(score_all)
             
+            if repeat_af2:
+                repeat_scheduler.add(key_seq, overall_scores[0])
+
             if key_seq in scored_seqs and repeat_af2:
-                scored_seqs[key_seq]["data"].append({"score": score_all, "pdb": pdbs, "result": result})
+                scored_seqs[key_seq]["data"].append({"score": score_all, "pdb": pdbs, "result": results[0]})
                 #don't need to sort when using all 5 for average score
                 #scored_seqs[key_seq]["data"].sort(key=lambda x: x["score"][0][0])
                 #print(scored_seqs[key_seq]["data"])
@@ -167,17 +296,21 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                 #print("After", sum_score, avg_score)
                 scored_seqs[key_seq]["average"] = avg_score
             else:
-                scored_seqs[key_seq] = {"data": [{"score": score_all, "pdb": pdbs, "result": result}]}
+                scored_seqs[key_seq] = {"data": [{"score": score_all, "pdb": pdbs, "result": results[0]}]}
                 scored_seqs[key_seq]["dsobj"] =  dsobj
                 
                 #set average score here
                 scored_seqs[key_seq]["average"] = overall_scores
+            scored_seqs[key_seq]["fidelity"] = fidelity
        
         if repeat_af2:
             for key_seq in scored_seqs:
-                if len(scored_seqs[key_seq]["data"]) >=5:
+                if repeat_scheduler.settled(key_seq):
                     repeat_af2_seqs[key_seq] = scored_seqs[key_seq]["average"]
             print("repeat_af2_seqs", repeat_af2_seqs)
+
+        if surrogate:
+            surrogate.update(scored_seqs)
         
         #creating sorted list version of sequences and scores in the pool
         sorted_scored_pool = []
@@ -205,7 +338,8 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
                                 pdbf.write(str(pdb))
         
         print("before sorting", sorted_scored_pool)
-        sorted_scored_pool.sort(key = lambda x: x[1][0])
+        #cheap cascade scores are never ranked above full-fidelity ones
+        sorted_scored_pool.sort(key=selection_key(scored_seqs))
         print("after sorting", sorted_scored_pool)
         seqs_per_iteration.append(sorted_scored_pool)
 
@@ -222,17 +356,33 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
             newpool_size = round(poolsizes[curr_iter]/2)
         else:
             pass
+
+        if repeat_af2 and repeat_af2_confidence:
+            #stop repeating sequences that are confidently above or below the selection cutoff
+            cutoff = selection_cutoff(sorted_scored_pool, newpool_size)
+            for key_seq, avg in sorted_scored_pool:
+                if key_seq not in repeat_af2_seqs and repeat_scheduler.settled(key_seq, cutoff):
+                    repeat_af2_seqs[key_seq] = scored_seqs[key_seq]["average"]
+
         newpool_seqs = []
         for sp in sorted_scored_pool[:newpool_size]:
             newpool_seqs.append(sp[0])
         print("newpool", newpool_seqs)
 
+        if migration and curr_iter % migration_interval == 0:
+            #exchange the best sequences with other islands
+            newpool_seqs = migrate(migration, curr_iter, scored_seqs, newpool_seqs, migration_top_k, repeat_scheduler=repeat_scheduler)
+            print("newpool after migration", newpool_seqs)
+
         newpool = []
         #pulling back DS objects for each sequence in new pool
         for key_seq, j in zip(newpool_seqs, range(len(newpool_seqs))):
             newpool.append(scored_seqs[key_seq]["dsobj"])
             #pdbs = scored_seqs[key_seq]["data"][0]["pdb"]
 
+        if score_store:
+            score_store.trim(scored_seqs, keep=newpool_seqs)
+
         curr_iter+=1
 
     with open(output_dir+"seqs_and_scores.log", "w") as logf:
@@ -288,6 +438,10 @@ def run_genetic_alg_multistate(run_dir, af2_flags_file, score_func, startingseqs
     except:
         print("plotting failed")
     
+    if score_store:
+        score_store.cleanup()
+    if parallel_scorer:
+        parallel_scorer.shutdown()
     dist.spin_down()
 
 if __name__ == "__main__":
@@ -350,16 +504,25 @@ if __name__ == "__main__":
 
 
     #get score function from flags file
-    try:
-        scorefile = args.score_file.rsplit("/", 1)
-        scorepath = scorefile[0]
-        scorefilename = scorefile[1].split(".")[0]
+    if args.score_file.endswith((".json", ".yaml", ".yml")):
+        #declarative score spec, compiled into a score function
+        scorefunc = compile_spec(args.score_file)
+        mod = None
+    else:
+        try:
+            scorefile = args.score_file.rsplit("/", 1)
+            scorepath = scorefile[0]
+            scorefilename = scorefile[1].split(".")[0]
 
-        sys.path.append(scorepath)
-        mod = importlib.import_module(scorefilename)
-        scorefunc = getattr(mod, args.score_func)
-    except:
-        raise ValueError("Invalid score function")
+            sys.path.append(scorepath)
+            mod = importlib.import_module(scorefilename)
+            scorefunc = getattr(mod, args.score_func)
+        except:
+            raise ValueError("Invalid score function")
+
+    if mod is None and (args.rmsd_func or args.rmsd_to_starting):
+        raise ValueError("--rmsd_func and --rmsd_to_starting need a python score file. With a score spec ("
+                         + args.score_file + "), use a rmsd_to_reference term in the spec for RMSDs to a starting structure.")
 
     if args.rmsd_func:
         rmsdfunc = getattr(mod, args.rmsd_func)
@@ -445,11 +608,24 @@ if __name__ == "__main__":
     else:
         mpnn_chains = None
                                    
+    drop_result_keys = None
+    if args.drop_result_keys:
+        drop_result_keys = [x.strip() for x in args.drop_result_keys.split(",")]
+
     run_genetic_alg_multistate(input_dir, input_dir + flagsfile, scorefunc, starting_seqs, poolsizes=pool_sizes, 
         num_iter = args.num_iter, n_workers=args.num_gpus, mut_percents=mut_percents, contacts=contacts, 
         mpnn_temp=args.mpnn_temp, mpnn_version=args.mpnn_version, skip_mpnn=mpnn_skips, mpnn_iters=mpnn_iters, mpnn_chains=mpnn_chains,
         repeat_af2=not args.no_repeat_af2, af2_preds = af2_preds, crossover_percent=args.crossover_percent, vary_length=args.vary_length, 
-        write_pdbs=args.write_pdbs, plot=plot_style, conf_plot=args.plot_confidences, write_compressed_data=not args.dont_write_compressed_data)
+        write_pdbs=args.write_pdbs, plot=plot_style, conf_plot=args.plot_confidences, write_compressed_data=not args.dont_write_compressed_data,
+        prediction_server=args.prediction_server, mmap_results=args.mmap_results, drop_result_keys=drop_result_keys,
+        scoring_cpus=args.scoring_cpus, surrogate_oversample=args.surrogate_oversample, surrogate_explore=args.surrogate_explore,
+        repeat_af2_max=args.repeat_af2_max, repeat_af2_confidence=args.repeat_af2_confidence,
+        memory_budget=args.memory_budget, prediction_cache_size=args.prediction_cache_size,
+        cache_chain_features=args.cache_chain_features, cascade=args.cascade, cascade_recycles=args.cascade_recycles,
+        cascade_keep=args.cascade_keep, cascade_threshold=args.cascade_threshold, jax_cache_dir=args.jax_cache_dir,
+        batch_jobs=args.batch_jobs, fill_gpu_slots=args.fill_gpu_slots, island_id=args.island_id, num_islands=args.num_islands,
+        migration_dir=args.migration_dir, migration_interval=args.migration_interval, migration_top_k=args.migration_top_k,
+        migration_topology=args.migration_topology)
         
         
         
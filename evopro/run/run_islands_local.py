@@ -0,0 +1,100 @@
+import os
+import sys
+import shutil
+import subprocess
+sys.path.append("/proj/kuhl_lab/evopro/")
+from evopro.user_inputs.inputs import FileArgumentParser
+from evopro.genetic_alg.islands import TOPOLOGIES
+
+def getIslandsParser() -> FileArgumentParser:
+    """Gets an FileArgumentParser with necessary arguments to run an island-model campaign on this machine"""
+
+    parser = FileArgumentParser(description='Runs several EvoPro islands as local processes that exchange their best '
+                                'sequences through a shared migration directory.',
+                                fromfile_prefix_chars='@')
+
+    #provide af2.flags, evopro.flags, residue specs json and other input files in this directory
+    parser.add_argument('--representative_directory',
+                        default='./',
+                        type=str,
+                        help='Path to directory with the files needed to run EvoPro, copied into one directory per island.')
+
+    parser.add_argument('--evopro_script',
+                        default='/proj/kuhl_lab/evopro/evopro/run/run_evopro_multistate.py',
+                        type=str,
+                        help='EvoPro run script each island runs.')
+
+    parser.add_argument('--evopro_flags',
+                        default='evopro.flags',
+                        type=str,
+                        help='Name of the EvoPro flags file in the representative directory.')
+
+    parser.add_argument('--num_islands',
+                        default=2,
+                        type=int,
+                        help='Number of islands. Default is 2.')
+
+    parser.add_argument('--migration_interval',
+                        default=5,
+                        type=int,
+                        help='Number of iterations between migrations. Default is 5.')
+
+    parser.add_argument('--migration_top_k',
+                        default=2,
+                        type=int,
+                        help='Number of best sequences each island sends per migration. Default is 2.')
+
+    parser.add_argument('--migration_topology',
+                        default='ring',
+                        type=str,
+                        help='One of ' + ", ".join(TOPOLOGIES) + '. Default is ring.')
+
+    parser.add_argument('--prediction_server',
+                        default=None,
+                        type=str,
+                        help='Address of a prediction server (see run_prediction_server.py) shared by all islands, so '
+                        'islands on one node share its GPUs. Default is None (each island starts its own workers).')
+    return parser
+
+if __name__=="__main__":
+    parser = getIslandsParser()
+    args = parser.parse_args(sys.argv[1:])
+
+    main_dir = os.getcwd()
+    migration_dir = os.path.join(main_dir, "migration")
+    if os.path.exists(migration_dir):
+        shutil.rmtree(migration_dir)
+    os.makedirs(migration_dir)
+
+    processes = []
+    for i in range(args.num_islands):
+        island_dir = os.path.join(main_dir, "island" + str(i))
+        if os.path.exists(island_dir):
+            shutil.rmtree(island_dir)
+        shutil.copytree(args.representative_directory, island_dir)
+
+        command = [sys.executable, args.evopro_script, "@" + args.evopro_flags,
+                   "--input_dir", island_dir + "/",
+                   "--island_id", str(i),
+                   "--num_islands", str(args.num_islands),
+                   "--migration_dir", migration_dir,
+                   "--migration_interval", str(args.migration_interval),
+                   "--migration_top_k", str(args.migration_top_k),
+                   "--migration_topology", args.migration_topology]
+        if args.prediction_server:
+            command = command + ["--prediction_server", args.prediction_server]
+
+        print("starting island", i, "in", island_dir)
+        logf = open(os.path.join(island_dir, "island.log"), "w")
+        processes.append((subprocess.Popen(command, cwd=island_dir, stdout=logf, stderr=subprocess.STDOUT), logf))
+
+    failed = []
+    for i, (proc, logf) in enumerate(processes):
+        proc.wait()
+        logf.close()
+        if proc.returncode != 0:
+            failed.append(i)
+    if failed:
+        print("islands that failed:", failed)
+        sys.exit(1)
+    print("all islands finished")
@@ -0,0 +1,87 @@
+import sys
+sys.path.append("/proj/kuhl_lab/evopro/")
+from evopro.user_inputs.inputs import FileArgumentParser
+from evopro.utils.prediction_server import PredictionServer, PredictionClient
+from evopro.utils.campaign import campaign_gpus
+
+sys.path.append('/proj/kuhl_lab/alphafold/run')
+
+def getServerParser() -> FileArgumentParser:
+    """Gets an FileArgumentParser with necessary arguments to run a node-wide prediction server"""
+
+    parser = FileArgumentParser(description='Long-lived AF2 prediction server shared by several EvoPro runs on one node. '
+                                'Point each run at it with --prediction_server <address>.',
+                                fromfile_prefix_chars='@')
+
+    parser.add_argument('--address',
+                        default='./evopro_predictions.sock',
+                        type=str,
+                        help='Path of the local (unix) socket the server listens on. Default is ./evopro_predictions.sock')
+
+    parser.add_argument('--af2_flags_file',
+                        default='af2.flags',
+                        type=str,
+                        help='Flags file for Alphafold runs, shared by all connected EvoPro runs.')
+
+    parser.add_argument('--num_gpus',
+                        default='1',
+                        type=int,
+                        help='Number of gpus available. Default is 1.')
+
+    parser.add_argument('--lengths',
+                        default='',
+                        type=str,
+                        help='Prediction shapes to compile AF2 for, separated by spaces, with chain lengths of each '
+                        'shape separated by commas. Example: 120,60 60')
+
+    parser.add_argument('--mmap_results',
+                         action='store_true',
+                         help='Workers hand large result arrays back through memory-mapped files, which are passed on to the'
+                         ' clients unread. Clients must run as the same user on this node. Default is False.')
+
+    parser.add_argument('--drop_result_keys',
+                        default=None,
+                        type=str,
+                        help='AF2 result keys dropped by the workers, separated by commas. Default is None.')
+
+    parser.add_argument('--jax_cache_dir',
+                        default=None,
+                        type=str,
+                        help='Directory of a persistent JAX compilation cache, so restarting the server skips compilation. Default is None.')
+
+    parser.add_argument('--shutdown',
+                        action='store_true',
+                        help='Connect to a running server at --address and ask it to shut down once its queued work is done.')
+    return parser
+
+def parse_lengths(lengths_str):
+    lengths = []
+    for shape in lengths_str.strip().split(" "):
+        if shape:
+            lengths.append([int(x) for x in shape.split(",")])
+    return lengths
+
+if __name__=="__main__":
+    parser = getServerParser()
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.shutdown:
+        client = PredictionClient(args.address)
+        client.shutdown_server()
+        print("asked prediction server at", args.address, "to shut down")
+    else:
+        from run_af2 import af2_init
+        if args.jax_cache_dir or campaign_gpus() is not None:
+            #evopro's init uses the persistent compilation cache and stays on the GPUs a campaign gave this server
+            from functools import partial
+            from evopro.genetic_alg.geneticalg_helpers import af2_init_compiled
+            af2_init = partial(af2_init_compiled, jax_cache_dir=args.jax_cache_dir)
+        lengths = parse_lengths(args.lengths)
+        print("Compiling AF2 models for lengths:", lengths)
+        drop_result_keys = None
+        if args.drop_result_keys:
+            drop_result_keys = [x.strip() for x in args.drop_result_keys.split(",")]
+        server = PredictionServer(args.address, args.num_gpus, af2_init, args.af2_flags_file, lengths,
+                                  mmap_results=args.mmap_results, drop_keys=drop_result_keys)
+        print("prediction server listening at", args.address)
+        server.serve_forever()
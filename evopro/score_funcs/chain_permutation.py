@@ -0,0 +1,151 @@
+"""
+RMSD of homo-oligomers independent of chain labelling. Chains with the same
+key (e.g. the same sequence) are interchangeable; the chain assignment minimizing the RMSD
+after superposition is found by Hungarian matching on chain pairs instead of
+enumerating permutations.
+"""
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from evopro.score_funcs.calculate_rmsd import kabsch
+
+def _superposition_ssd(P, Q):
+    """
+    minimum sum of squared deviations after superposition of every P[i] onto
+    every Q[j], for stacks of equally long chains P (n, L, 3) and Q (m, L, 3)
+    """
+    P = P - P.mean(axis=1, keepdims=True)
+    Q = Q - Q.mean(axis=1, keepdims=True)
+    H = np.einsum("ila,jlb->ijab", P, Q)
+    U, S, Vt = np.linalg.svd(H)
+    d = np.sign(np.linalg.det(U)*np.linalg.det(Vt))
+    trace = S[..., 0] + S[..., 1] + d*S[..., 2]
+    ssd = (P**2).sum(axis=(1, 2))[:, None] + (Q**2).sum(axis=(1, 2))[None, :] - 2*trace
+    return np.maximum(ssd, 0)
+
+def _fit(P, Q):
+    """rotation U and centroids so that (X - p_center) @ U + q_center superimposes P onto Q"""
+    p_center = P.mean(axis=0)
+    q_center = Q.mean(axis=0)
+    return kabsch(P - p_center, Q - q_center), p_center, q_center
+
+def _assign(cost, fixed=None):
+    """optimal assignment of rows to columns of cost, with row fixed[0] forced onto column fixed[1]"""
+    if fixed is not None:
+        cost = cost.copy()
+        cost[fixed[0], :] = np.inf
+        cost[:, fixed[1]] = np.inf
+        cost[fixed[0], fixed[1]] = 0
+    rows, cols = linear_sum_assignment(cost)
+    return cols
+
+def chain_groups(keys):
+    """lists of the indices of interchangeable chains (same key)"""
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+def chain_permutation_rmsd(ref_chains, model_chains, ref_keys=None, model_keys=None, refine_iters=3, tol=1e-6):
+    """
+    Minimum RMSD over assignments of interchangeable model chains to reference chains.
+    ref_chains and model_chains are lists of (N_i, 3) coordinate arrays.
+    Reference chain i can only be matched to model chain j if ref_keys[i] == model_keys[j]
+    (by default the keys are the chain lengths).
+    Returns (rmsd, assignment), where model chain assignment[i] is matched to reference chain i.
+
+    One chain of the largest group is used as anchor: for each model chain it
+    could be matched to, the model is superimposed on the anchor, the other
+    chains are pre-assigned by Hungarian matching of chain centroids, and the
+    assignment is refined by Hungarian matching on chain-pair deviations after
+    superposition of the whole complex. Anchors whose lower bound (deviation of
+    the anchor pair alone plus the best possible matching of the other chains)
+    cannot beat the best RMSD found are skipped, and the search stops once the
+    best RMSD reaches the lower bound over all assignments.
+    """
+    if ref_keys is None:
+        ref_keys = [len(x) for x in ref_chains]
+    if model_keys is None:
+        model_keys = [len(x) for x in model_chains]
+    groups = chain_groups(ref_keys)
+    model_by_key = {}
+    for j, key in enumerate(model_keys):
+        model_by_key.setdefault(key, []).append(j)
+    for group in groups:
+        cands = model_by_key.get(ref_keys[group[0]], [])
+        if len(cands) != len(group) or len(set([len(ref_chains[i]) for i in group] + [len(model_chains[j]) for j in cands])) > 1:
+            raise ValueError("Reference and model chains do not have matching lengths.")
+
+    ref_all = np.concatenate(ref_chains)
+    n_atoms = len(ref_all)
+    ref_centroids = np.array([c.mean(axis=0) for c in ref_chains])
+
+    #per group, deviation of every reference chain from every model chain after superposing that pair alone
+    pair_ssd = []
+    members = []
+    for group in groups:
+        cands = model_by_key[ref_keys[group[0]]]
+        members.append(cands)
+        pair_ssd.append(_superposition_ssd(np.stack([ref_chains[i] for i in group]), np.stack([model_chains[j] for j in cands])))
+
+    def group_lower_bound(k, fixed=None):
+        cols = _assign(pair_ssd[k], fixed)
+        return pair_ssd[k][np.arange(len(cols)), cols].sum()
+    lower_bounds = [group_lower_bound(k) for k in range(len(groups))]
+    global_lower_bound = sum(lower_bounds)
+
+    def total_ssd(assignment):
+        model_all = np.concatenate([model_chains[assignment[i]] for i in range(len(ref_chains))])
+        U, p_center, q_center = _fit(model_all, ref_all)
+        moved = (model_all - p_center) @ U + q_center
+        return ((moved - ref_all)**2).sum(), U, p_center, q_center
+
+    anchor_group = max(range(len(groups)), key=lambda k: (len(groups[k]), len(ref_chains[groups[k][0]])))
+    anchor = 0
+    best_ssd = np.inf
+    best_assignment = None
+    order = np.argsort(pair_ssd[anchor_group][anchor])
+    for c in order:
+        #lower bound of any assignment matching the anchor to model chain members[anchor_group][c]
+        bound = global_lower_bound - lower_bounds[anchor_group] + group_lower_bound(anchor_group, fixed=(anchor, c))
+        if bound >= best_ssd - tol:
+            continue
+
+        a_ref = ref_chains[groups[anchor_group][anchor]]
+        a_model = model_chains[members[anchor_group][c]]
+        U, p_center, q_center = _fit(a_model, a_ref)
+        model_centroids = (np.array([m.mean(axis=0) for m in model_chains]) - p_center) @ U + q_center
+
+        assignment = {}
+        for k, group in enumerate(groups):
+            cost = ((ref_centroids[group][:, None, :] - model_centroids[members[k]][None, :, :])**2).sum(axis=-1)
+            cols = _assign(cost, fixed=(anchor, c) if k == anchor_group else None)
+            for i, col in zip(group, cols):
+                assignment[i] = members[k][col]
+
+        ssd, U, p_center, q_center = total_ssd(assignment)
+        for it in range(refine_iters):
+            refined = {}
+            for k, group in enumerate(groups):
+                moved = [(model_chains[j] - p_center) @ U + q_center for j in members[k]]
+                cost = np.array([[((ref_chains[i] - m)**2).sum() for m in moved] for i in group])
+                for i, col in zip(group, _assign(cost)):
+                    refined[i] = members[k][col]
+            if refined == assignment:
+                break
+            new_ssd, new_U, new_p, new_q = total_ssd(refined)
+            if new_ssd >= ssd:
+                break
+            assignment, ssd, U, p_center, q_center = refined, new_ssd, new_U, new_p, new_q
+
+        if ssd < best_ssd:
+            best_ssd = ssd
+            best_assignment = assignment
+        if best_ssd <= global_lower_bound + tol:
+            break
+
+    return np.sqrt(best_ssd/n_atoms), [best_assignment[i] for i in range(len(ref_chains))]
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -0,0 +1,97 @@
+"""
+Confidence metrics from AF2 PAE and pLDDT arrays, computed with integer index
+arrays instead of loops over residue ids. Every metric takes the arrays of one
+prediction (pae (L, L), plddt (L,)) or of a stacked batch (pae (B, L, L),
+plddt (B, L), see utils.scoring.stack_results) and returns one value per prediction.
+
+Sums are accumulated left to right (np.cumsum) in the order the original
+score_funcs loops used, so the wrappers in score_funcs.py return identical values.
+"""
+
+import pickle
+import numpy as np
+
+def load_confidences(resultsfile, fil=False):
+    """(pae, plddt) of an AF2 results dictionary, or of a pickled one if fil is True"""
+    if fil:
+        with open(resultsfile, 'rb') as f:
+            resultsfile = pickle.load(f)
+    pae = resultsfile['pae_output'][0] if 'pae_output' in resultsfile else None
+    plddt = resultsfile['plddt'] if 'plddt' in resultsfile else None
+    return pae, plddt
+
+def residue_indices(reslist, resindices):
+    """integer index array of the residues in reslist (resindices as from get_coordinates_pdb)"""
+    return np.array([resindices[res] for res in reslist], dtype=int)
+
+def chain_indices(resids, chain):
+    """integer index array of the residues of chain, for resids in model order"""
+    return np.array([i for i, res in enumerate(resids) if res.startswith(chain)], dtype=int)
+
+def sequential_sum(values):
+    """sum over the last axis added left to right, 0 if it is empty"""
+    if values.shape[-1] == 0:
+        return 0 if values.ndim == 1 else np.zeros(values.shape[:-1], dtype=values.dtype)
+    #[()] makes a scalar of the total of a single prediction
+    return np.cumsum(values, axis=-1)[..., -1][()]
+
+def pae_pair_sum(pae, idx1, idx2):
+    """sum of pae[i, j] + pae[j, i] over the residue pairs (idx1[k], idx2[k])"""
+    pae = np.asarray(pae)
+    #interleaved as pae[i1, j1], pae[j1, i1], pae[i2, j2], ...
+    values = np.stack([pae[..., idx1, idx2], pae[..., idx2, idx1]], axis=-1)
+    return sequential_sum(values.reshape(values.shape[:-2] + (-1,)))
+
+def pae_block_sum(pae, idx1, idx2):
+    """sum of pae[i, j] over every i in idx1 and j in idx2"""
+    pae = np.asarray(pae)
+    block = pae[..., idx1[:, None], idx2[None, :]]
+    return sequential_sum(block.reshape(block.shape[:-2] + (-1,)))
+
+def interface_pae(pae, idx1, idx2):
+    """mean PAE between two residue selections, in both directions"""
+    pae = np.asarray(pae)
+    block = pae[..., idx1[:, None], idx2[None, :]]
+    block_rev = pae[..., idx2[:, None], idx1[None, :]]
+    return (block.mean(axis=(-2, -1)) + block_rev.mean(axis=(-2, -1)))/2
+
+def chain_pair_pae(pae, resids, chains=None):
+    """{(chain1, chain2): mean pae[chain1 residues, chain2 residues]} for every ordered pair of chains"""
+    pae = np.asarray(pae)
+    if chains is None:
+        chains = list(dict.fromkeys([res[0] for res in resids]))
+    inds = {chain: chain_indices(resids, chain) for chain in chains}
+    means = {}
+    for c1 in chains:
+        for c2 in chains:
+            means[(c1, c2)] = pae[..., inds[c1][:, None], inds[c2][None, :]].mean(axis=(-2, -1))
+    return means
+
+def mean_plddt(plddt, idx):
+    """mean pLDDT of a residue selection"""
+    plddt = np.asarray(plddt)
+    return sequential_sum(plddt[..., idx])/len(idx)
+
+def pae_weighted_contact_sum(pae, idx1, idx2, max_pae=70):
+    """sum over contacts (idx1[k], idx2[k]) of (max_pae - pae[i, j] - pae[j, i])/max_pae"""
+    pae = np.asarray(pae)
+    weights = (max_pae - (pae[..., idx1, idx2] + pae[..., idx2, idx1]))/max_pae
+    return sequential_sum(weights)
+
+def pae_iptm(pae, idx1, idx2):
+    """
+    ipTM-style interface score from the expected PAE: TM-score transform of the
+    PAE from each residue of either selection to the other one, averaged per
+    aligned residue and maximized over aligned residues (as ipTM does with the
+    PAE distribution). Between 0 and 1, higher is better.
+    """
+    pae = np.asarray(pae)
+    num_res = max(len(idx1) + len(idx2), 19)
+    d0 = 1.24*(num_res - 15)**(1.0/3) - 1.8
+    tm = 1.0/(1 + (pae/d0)**2)
+    per_res1 = tm[..., idx1[:, None], idx2[None, :]].mean(axis=-1)
+    per_res2 = tm[..., idx2[:, None], idx1[None, :]].mean(axis=-1)
+    return np.maximum(per_res1.max(axis=-1), per_res2.max(axis=-1))
+
+if __name__=="__main__":
+    print("no main functionality")
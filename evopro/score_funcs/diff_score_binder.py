@@ -1,5 +1,6 @@
 from evopro.utils.pdb_parser import get_coordinates_pdb
-from evopro.score_funcs.score_funcs import score_plddt_confidence, get_rmsd, get_rmsd_superimposeall
+from evopro.utils.structure import Structure, load_reference
+from evopro.score_funcs.score_funcs import score_plddt_confidence, get_rmsd, get_rmsd_superimposeall, get_rmsd_to_reference, get_rmsd_superimposeall_to_reference
 
 def score_seq_diff_monomers(results, diff_backbone):
     from alphafold.common import protein
@@ -74,32 +75,28 @@ def score_seq_diff_binderA(results, diff_backbone):
 
 def score_rmsd_to_starting_binder(pdb, path_to_starting, dsobj=None, binder_chain="A"):
 
-    with open(path_to_starting, 'r') as f:
-        pdb_string_starting = f.read()
-    chains0, residues0, resindices0 = get_coordinates_pdb(pdb_string_starting)
-    reslist1 = [x for x in residues0.keys()]
-    reslist1_2 = [x for x in residues0.keys() if x.startswith(binder_chain)]
+    reference = load_reference(path_to_starting)
+    reslist1 = [x for x in reference.resids]
+    reslist1_2 = [x for x in reference.resids if x.startswith(binder_chain)]
 
-    chains, residues, resindices = get_coordinates_pdb(pdb)
-    reslist2 = [x for x in residues.keys()]
-    reslist2_2 = [x for x in residues.keys() if x.startswith(binder_chain)]
+    structure = Structure(pdb)
+    reslist2 = [x for x in structure.resids]
+    reslist2_2 = [x for x in structure.resids if x.startswith(binder_chain)]
 
     #rmsd_to_starting = get_rmsd(reslist1, pdb_string_starting, reslist2, pdb, ca_only=True, dsobj=dsobj)
-    rmsd_to_starting = get_rmsd_superimposeall(reslist1, reslist1_2, pdb_string_starting, reslist2, reslist2_2, pdb, ca_only=True, translate=True)
+    rmsd_to_starting = get_rmsd_superimposeall_to_reference(reference, reslist1, reslist1_2, structure, reslist2, reslist2_2, ca_only=True, translate=True)
 
     return rmsd_to_starting
 
 def score_rmsd_to_starting(pdb, path_to_starting, dsobj=None):
 
-    with open(path_to_starting, 'r') as f:
-        pdb_string_starting = f.read()
-    chains0, residues0, resindices0 = get_coordinates_pdb(pdb_string_starting)
-    reslist1 = [x for x in residues0.keys()]
+    reference = load_reference(path_to_starting)
+    reslist1 = [x for x in reference.resids]
 
-    chains, residues, resindices = get_coordinates_pdb(pdb)
-    reslist2 = [x for x in residues.keys()]
+    structure = Structure(pdb)
+    reslist2 = [x for x in structure.resids]
 
-    rmsd_to_starting = get_rmsd(reslist1, pdb_string_starting, reslist2, pdb, ca_only=True, dsobj=dsobj)
+    rmsd_to_starting = get_rmsd_to_reference(reference, reslist1, structure, reslist2, ca_only=True, dsobj=dsobj)
 
     return rmsd_to_starting
 
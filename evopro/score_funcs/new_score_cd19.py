@@ -1,5 +1,6 @@
 from evopro.utils.pdb_parser import get_coordinates_pdb
-from evopro.score_funcs.score_funcs import score_contacts, score_contacts_pae_weighted, score_pae_confidence_pairs, score_pae_confidence_lists, score_plddt_confidence, get_rmsd, orientation_score
+from evopro.utils.structure import Structure, load_reference
+from evopro.score_funcs.score_funcs import score_contacts, score_contacts_pae_weighted, score_pae_confidence_pairs, score_pae_confidence_lists, score_plddt_confidence, get_rmsd, orientation_score, get_rmsd_to_reference
 import os
 import subprocess
 import shutil
@@ -321,15 +322,13 @@ def score_binder_rmsd_to_starting(pdb, path_to_starting, dsobj=None):
     spring_constant = 10.0 
     rmsd_cutoff = 4.0
 
-    with open(path_to_starting, 'r') as f:
-        pdb_string_starting = f.read()
-    chains0, residues0, resindices0 = get_coordinates_pdb(pdb_string_starting)
-    reslist1 = [x for x in residues0.keys()]
+    reference = load_reference(path_to_starting)
+    reslist1 = [x for x in reference.resids]
 
-    chains, residues, resindices = get_coordinates_pdb(pdb)
-    reslist2 = [x for x in residues.keys()]
+    structure = Structure(pdb)
+    reslist2 = [x for x in structure.resids]
 
-    rmsd_to_starting = get_rmsd(reslist1, pdb_string_starting, reslist2, pdb, ca_only=True, dsobj=dsobj)
+    rmsd_to_starting = get_rmsd_to_reference(reference, reslist1, structure, reslist2, ca_only=True, dsobj=dsobj)
 
     # apply flat-bottom quadratic-shaped potential function
     rmsd_potential = 0
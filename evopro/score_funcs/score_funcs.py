@@ -4,7 +4,11 @@ sys.path.append("/proj/kuhl_lab/evopro/")
 from evopro.utils.pdb_parser import get_coordinates_pdb
 from evopro.utils.write_pdb import PDBio
 from evopro.utils.calc_rmsd import RMSDcalculator
+from evopro.utils.structure import Structure
+from evopro.utils.neighbors import neighbor_search, contact_pairs
 from evopro.score_funcs.calculate_rmsd import kabsch_rmsd, kabsch_rmsd_superimposeall
+from evopro.score_funcs.chain_permutation import chain_permutation_rmsd
+from evopro.score_funcs.confidence import load_confidences, residue_indices, pae_pair_sum, pae_block_sum, mean_plddt, pae_weighted_contact_sum
 import math
 import pickle
 import numpy as np
@@ -52,54 +56,23 @@ def score_contacts_pae_weighted(results, pdb, reslist1, reslist2, dist=4, contac
         reslist1 = get_seq_indices(dsobj, reslist1, first_only=first_only)
         reslist2 = get_seq_indices(dsobj, reslist2, first_only=first_only)
 
-    chains, residues, resindices = get_coordinates_pdb(pdb)
+    search = neighbor_search(pdb)
+    resindices = search.structure.resindices
     pae = results['pae_output'][0]
 
-    score = 0
-    pairs = []
-    for res1 in reslist1:
-        for res2 in reslist2:
-            contact = 0
-            weight = 0
-            for atom1 in residues[res1]:
-                for atom2 in residues[res2]:
-                    if distance(atom1[2], atom2[2])<=dist:
-                        pair = (res1, res2)
-                        pair_rev = (res2, res1)
-                        if pair not in pairs and pair_rev not in pairs:
-                            if len(pairs)<contact_cap:
-                                contact=1
-                                res1_id = resindices[res1]
-                                res2_id = resindices[res2]
-                                pae_contact = pae[res1_id][res2_id] + pae[res2_id][res1_id]
-                                weight = (70-pae_contact)/70
-                                pairs.append(pair)
-
-            score = score + contact*weight
-    
+    pairs = contact_pairs(search.contact_matrix(reslist1, reslist2, dist), reslist1, reslist2, cap=contact_cap)
+    score = pae_weighted_contact_sum(pae, residue_indices([p[0] for p in pairs], resindices),
+                                     residue_indices([p[1] for p in pairs], resindices))
     return pairs, score
 
 def score_contacts(pdbfile, reslist1, reslist2, dist=4, score_cap=36, dsobj=None, first_only=False):
     """returns a list of pairs of residues that are making contacts, and the contact score"""
-    chains, residues, resindices = get_coordinates_pdb(pdbfile)
+    search = neighbor_search(pdbfile)
     if dsobj:
         reslist1 = get_seq_indices(dsobj, reslist1, first_only=first_only)
         reslist2 = get_seq_indices(dsobj, reslist2, first_only=first_only)
-    score = 0
-    pairs = []
-    for res1 in reslist1:
-        for res2 in reslist2:
-            contact = 0
-            for atom1 in residues[res1]:
-                for atom2 in residues[res2]:
-                    if distance(atom1[2], atom2[2])<=dist:
-                        pair = (res1, res2)
-                        pair_rev = (res2, res1)
-                        if pair not in pairs and pair_rev not in pairs:
-                            pairs.append(pair)
-                            contact=1
-
-            score = score+contact
+    pairs = contact_pairs(search.contact_matrix(reslist1, reslist2, dist), reslist1, reslist2)
+    score = len(pairs)
     if score>score_cap:
         score=score_cap
 
@@ -107,17 +80,11 @@ def score_contacts(pdbfile, reslist1, reslist2, dist=4, score_cap=36, dsobj=None
 
 def orientation_score(pdb, pairs, orient_dist = 10, penalty = 10, dsobj=None, first_only=True):
     corrects = []
-    chains, residues, resindices = get_coordinates_pdb(pdb)
+    search = neighbor_search(pdb)
     for tup in pairs:
-        correct = 0
         if dsobj:
             tup = get_seq_indices(dsobj, [tup[0],tup[1]], first_only=first_only)
-        for atom1 in residues[tup[0]]:
-            for atom2 in residues[tup[1]]:
-                if distance(atom1[2], atom2[2])<=orient_dist:
-                    correct = 1
-        
-        corrects.append(correct)
+        corrects.append(1 if search.any_within(tup[0], tup[1], orient_dist) else 0)
 
     orientation_score = sum([penalty for x in corrects if x==0])
 
@@ -125,7 +92,6 @@ def orientation_score(pdb, pairs, orient_dist = 10, penalty = 10, dsobj=None, fi
 
 def score_pae_confidence_pairs(resultsfile, pairs, resindices, fil = False, dsobj=None, first_only=True):
     """calculates confidence score of all pairwise residue interactions"""
-    score = 0
     reslist1 = []
     reslist2 = []
     for pair in pairs:
@@ -135,61 +101,26 @@ def score_pae_confidence_pairs(resultsfile, pairs, resindices, fil = False, dsob
     if dsobj:
         reslist1 = get_seq_indices(dsobj, reslist1, first_only=first_only)
         reslist2 = get_seq_indices(dsobj, reslist2, first_only=first_only)
-    if fil:
-        with open(resultsfile,'rb') as f:
-            p = pickle.load(f)
-            pae = p['pae_output'][0]
-            for res1,res2 in zip(reslist1,reslist2):
-                res1_id = resindices[res1]
-                res2_id = resindices[res2]
-                score = score + pae[res1_id][res2_id] + pae[res2_id][res1_id]
-    else:
-        pae = resultsfile['pae_output'][0]
-        score = 0
-        for res1,res2 in zip(reslist1,reslist2):
-            res1_id = resindices[res1]
-            res2_id = resindices[res2]
-            score = score + pae[res1_id][res2_id] + pae[res2_id][res1_id]
-    return score
+    pae, plddt = load_confidences(resultsfile, fil=fil)
+
+    num_pairs = min(len(reslist1), len(reslist2))
+    return pae_pair_sum(pae, residue_indices(reslist1[:num_pairs], resindices), residue_indices(reslist2[:num_pairs], resindices))
 
 def score_pae_confidence_lists(resultsfile, reslist1, reslist2, resindices, fil = False, dsobj=None, first_only=False):
     """calculates confidence score of all permutations of pairwise interactions between two lists of residues"""
-    pae = {}
-    score = 0
     if dsobj:
         reslist1 = get_seq_indices(dsobj, reslist1, first_only=first_only)
         reslist2 = get_seq_indices(dsobj, reslist2, first_only=first_only)
-    if fil:
-        with open(resultsfile, 'rb') as f:
-            p = pickle.load(f)
-            pae = p['pae_output'][0]
-    else:
-        pae = resultsfile['pae_output'][0]
-
-    for res1 in reslist1:
-        res1_id = resindices[res1]
-        for res2 in reslist2:
-            res2_id = resindices[res2]
-            score = score + pae[res1_id][res2_id]
-    return score
+    pae, plddt = load_confidences(resultsfile, fil=fil)
+
+    return pae_block_sum(pae, residue_indices(reslist1, resindices), residue_indices(reslist2, resindices))
 
 def score_plddt_confidence(resultsfile, reslist, resindices, fil = False, dsobj=None, first_only=False):
-    score = 0
     if dsobj:
         reslist = get_seq_indices(dsobj, reslist, first_only=first_only)
+    pae, plddt = load_confidences(resultsfile, fil=fil)
 
-    if fil:
-        with open(resultsfile, 'rb') as f:
-            p = pickle.load(f)
-            plddt = p['plddt']
-    else:
-        plddt = resultsfile['plddt']
-
-    for res in reslist:
-        resid = resindices[res]
-        score = score + plddt[resid]
-
-    return score/len(reslist)
+    return mean_plddt(plddt, residue_indices(reslist, resindices))
 
 def get_rmsd(reslist1, pdb1, reslist2, pdb2, ca_only=False, translate=True, dsobj=None, first_only=True):
     if dsobj:
@@ -272,41 +203,60 @@ def get_rmsd_superimposeall(reslist1, reslist1_2, pdb1, reslist2, reslist2_2, pd
     rmsd = kabsch_rmsd_superimposeall(A, B, A2, B2, translate=translate)
     return rmsd
 
+def get_rmsd_to_reference(reference, reslist1, pdb2, reslist2, ca_only=False, translate=True, dsobj=None, first_only=True):
+    """
+    Same as get_rmsd, for a reference Structure (see utils.structure.load_reference)
+    whose coordinates are already parsed. pdb2 can be a pdb string or a Structure.
+    """
+    if dsobj:
+        reslist2 = get_seq_indices(dsobj, reslist2, first_only=first_only)
+    if not isinstance(pdb2, Structure):
+        pdb2 = Structure(pdb2)
+
+    A = reference.get_coords(reslist1, ca_only=ca_only)
+    B = pdb2.get_coords(reslist2, ca_only=ca_only)
+    rmsd = kabsch_rmsd(A, B, translate=translate)
+    return rmsd
+
+def get_rmsd_superimposeall_to_reference(reference, reslist1, reslist1_2, pdb2, reslist2, reslist2_2, ca_only=False, translate=True):
+    """Same as get_rmsd_superimposeall, for a reference Structure. pdb2 can be a pdb string or a Structure."""
+    if not isinstance(pdb2, Structure):
+        pdb2 = Structure(pdb2)
+
+    A = reference.get_coords(reslist1, ca_only=ca_only)
+    A2 = reference.get_coords(reslist1_2, ca_only=ca_only)
+    B = pdb2.get_coords(reslist2, ca_only=ca_only)
+    B2 = pdb2.get_coords(reslist2_2, ca_only=ca_only)
+    rmsd = kabsch_rmsd_superimposeall(A, B, A2, B2, translate=translate)
+    return rmsd
+
+def get_rmsd_chain_permutation_to_reference(reference, pdb2, chains1=None, chains2=None, ca_only=True):
+    """
+    RMSD of pdb2 (pdb string or Structure) to a reference Structure, minimized over
+    relabelings of interchangeable chains, e.g. for homo-oligomers. Chains i and j
+    are interchangeable if chains1[i] and chains1[j] have the same sequence in the
+    reference and chains2[i] and chains2[j] have the same sequence in pdb2.
+    Returns (rmsd, {reference chain: pdb2 chain}).
+    """
+    if not isinstance(pdb2, Structure):
+        pdb2 = Structure(pdb2)
+    chains1 = chains1 or reference.chains
+    chains2 = chains2 or pdb2.chains
+    if len(chains1) != len(chains2):
+        raise ValueError("Reference and model do not have the same number of chains.")
+    A = [reference.get_coords([x for x in reference.resids if x.startswith(chain)], ca_only=ca_only) for chain in chains1]
+    B = [pdb2.get_coords([x for x in pdb2.resids if x.startswith(chain)], ca_only=ca_only) for chain in chains2]
+    seqs1 = [tuple([name for x, name in zip(reference.resids, reference.resnames) if x.startswith(chain)]) for chain in chains1]
+    seqs2 = [tuple([name for x, name in zip(pdb2.resids, pdb2.resnames) if x.startswith(chain)]) for chain in chains2]
+    keys = list(zip(seqs1, seqs2))
+    rmsd, assignment = chain_permutation_rmsd(A, B, ref_keys=keys, model_keys=keys)
+    return rmsd, {chains1[i]: chains2[j] for i, j in enumerate(assignment)}
+
 def radius_of_gyration(pdb, reslist=None):
-    coord = list()
-    mass = list()
-    chains, residues, resindices = get_coordinates_pdb(pdb)
-    pdb = pdb.split("\n")
-    if not reslist:
-        reslist = [x for x in residues.keys()]
-    
-    for line in pdb:
-        try:
-            line = line.split()
-            x = float(line[6])
-            y = float(line[7])
-            z = float(line[8])
-            coord.append([x, y, z])
-            if line[-1] == 'C':
-                mass.append(12.0107)
-            elif line[-1] == 'O':
-                mass.append(15.9994)
-            elif line[-1] == 'N':
-                mass.append(14.0067)
-                
-            elif line[-1] == 'S':
-                mass.append(32.065)
-        except:
-            pass
-    xm = [(m*i, m*j, m*k) for (i, j, k), m in zip(coord, mass)]
-    tmass = sum(mass)
-    rr = sum(mi*i + mj*j + mk*k for (i, j, k), (mi, mj, mk) in zip(coord, xm))
-    mm = sum((sum(i) / tmass)**2 for i in zip(*xm))
-    if tmass-mm == 0:
-        rg = 0
-    else:
-        rg = math.sqrt(rr / tmass-mm)
-    return(round(rg, 3))
+    """mass-weighted radius of gyration of all atoms of pdb (pdb string or Structure), rounded to 3 decimals"""
+    if not isinstance(pdb, Structure):
+        pdb = Structure(pdb)
+    return round(pdb.radius_of_gyration, 3)
 
 def write_raw_plddt(results, filename):
     from alphafold.common import protein
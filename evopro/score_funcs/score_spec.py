@@ -0,0 +1,339 @@
+"""
+Declarative score functions. A score spec (JSON, or YAML if PyYAML is
+installed) lists weighted terms with their residue selections and cutoffs, and
+is compiled into a ScorePlan that can be used as an EvoPro score function.
+The plan parses each prediction once and runs one neighbor search covering the
+residues and cutoffs of all contact-type terms. Plans also score whole
+generations at once (ScorePlan.score_batch, used by utils.scoring.score_generation).
+
+Example (same scores as score_binder.score_binder, see specs/binder.json):
+{
+  "terms": [
+    {"name": "contacts", "type": "pae_weighted_contacts", "selection1": "$contacts.0",
+     "selection2": "chain B", "cutoff": "$distance_cutoffs.0", "weight": -1},
+    {"name": "penalty", "type": "contact_hits", "selection1": "$contacts.2",
+     "selection2": "chain B", "cutoff": "$distance_cutoffs.2", "weight": 3}
+  ],
+  "defaults": {"contacts": [null, null, null], "distance_cutoffs": [4, 4, 8]},
+  "details": ["score", "contacts.count", "contacts.value", "penalty"],
+  "returns": ["score", "details", "$contacts", "pdb", "results"],
+  "monomer": {...spec used for single-chain predictions...}
+}
+
+Selections are "chain X", "all", a list of residue ids, or "$argument.index"
+(an argument of the score function call, e.g. the contacts from the flags).
+A term whose selection is None adds nothing. "details" entries are "score",
+a term name (its weighted contribution) or "term.quantity".
+"""
+
+import json
+import math
+import numpy as np
+
+from evopro.utils.structure import Structure, load_reference
+from evopro.score_funcs.score_funcs import get_seq_indices, get_rmsd_to_reference, get_rmsd_chain_permutation_to_reference
+from evopro.score_funcs.confidence import residue_indices, pae_weighted_contact_sum
+from evopro.utils.scoring import stack_results
+from evopro.utils.neighbors import neighbor_search, contact_pairs
+
+CONTACT_TYPES = ("pae_weighted_contacts", "contacts", "contact_hits")
+TERM_TYPES = CONTACT_TYPES + ("plddt", "rmsd_to_reference", "orientation")
+
+def load_spec(path):
+    """reads a score spec from a .json or .yaml/.yml file"""
+    with open(path, "r") as f:
+        if path.endswith(".yaml") or path.endswith(".yml"):
+            import yaml
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def _resolve(value, kwargs):
+    """replaces "$name.i.j" references with the call arguments they point to"""
+    if isinstance(value, str) and value.startswith("$"):
+        path = value[1:].split(".")
+        value = kwargs.get(path[0])
+        for key in path[1:]:
+            if value is None:
+                return None
+            value = value[int(key)]
+    return value
+
+class ContactSearch:
+    """
+    Minimum atom-atom distance between every residue of rows and every residue
+    of cols up to max_dist, from the neighbor search of the prediction, computed
+    once and shared by all contact terms.
+    """
+
+    def __init__(self, structure, rows, cols, max_dist):
+        self.row_index = {res: i for i, res in enumerate(rows)}
+        self.col_index = {res: i for i, res in enumerate(cols)}
+        self.mindist = neighbor_search(structure).min_distances(rows, cols, max_dist)
+
+    def distance(self, res1, res2):
+        """np.inf beyond max_dist"""
+        return self.mindist[self.row_index[res1], self.col_index[res2]]
+
+    def pairs(self, reslist1, reslist2, cutoff, cap=None):
+        """contacting pairs in the order and with the deduplication of score_contacts(_pae_weighted)"""
+        if not reslist1 or not reslist2:
+            return []
+        mindist = self.mindist[np.ix_([self.row_index[res] for res in reslist1], [self.col_index[res] for res in reslist2])]
+        return contact_pairs(mindist <= cutoff, reslist1, reslist2, cap)
+
+class ScorePlan:
+    """
+    Compiled score spec. Call it like any EvoPro score function:
+    plan(results, dsobj, contacts=..., distance_cutoffs=...).
+    """
+
+    def __init__(self, spec):
+        self.terms = spec["terms"]
+        self.defaults = spec.get("defaults", {})
+        self.details = spec.get("details", ["score"])
+        self.returns = spec.get("returns", ["score", "details", "pdb", "results"])
+        self.monomer = ScorePlan(spec["monomer"]) if spec.get("monomer") else None
+        for term in self.terms:
+            if term.get("type") not in TERM_TYPES:
+                raise ValueError("Unknown score term type " + str(term.get("type")) + ", choose one of " + ", ".join(TERM_TYPES))
+
+    def _selection(self, sel, structure, kwargs):
+        sel = _resolve(sel, kwargs)
+        if sel is None:
+            return None
+        if isinstance(sel, str):
+            if sel == "all":
+                return list(structure.resids)
+            if sel.startswith("chain "):
+                chains = sel.split(" ", 1)[1].replace(",", " ").split()
+                return [x for x in structure.resids if any([x.startswith(c) for c in chains])]
+            return [sel]
+        return list(sel)
+
+    def _renumber(self, reslist, dsobj, first_only):
+        if dsobj and reslist is not None:
+            return get_seq_indices(dsobj, reslist, first_only=first_only)
+        return reslist
+
+    def _prepare(self, structure, dsobj, kwargs):
+        """resolves the selections of every term and the residues and radius the shared contact search needs"""
+        prepared = []
+        rows = {}
+        cols = {}
+        max_dist = 0
+        for term in self.terms:
+            t = dict(term)
+            t["cutoff"] = _resolve(term.get("cutoff", 4), kwargs)
+            if term["type"] in CONTACT_TYPES:
+                raw = self._selection(term.get("selection1"), structure, kwargs)
+                t["raw_selection1"] = raw
+                t["selection1"] = self._renumber(raw, dsobj, False)
+                t["selection2"] = self._renumber(self._selection(term.get("selection2"), structure, kwargs), dsobj, False)
+                if t["selection1"] is not None and t["selection2"] is not None:
+                    rows.update(dict.fromkeys(t["selection1"]))
+                    cols.update(dict.fromkeys(t["selection2"]))
+                    max_dist = max(max_dist, t["cutoff"])
+            elif term["type"] == "orientation":
+                pairs = []
+                for pair in _resolve(term.get("pairs", []), kwargs) or []:
+                    pairs.append(tuple(self._renumber([pair[0], pair[1]], dsobj, True)))
+                t["pairs"] = pairs
+                rows.update(dict.fromkeys([p[0] for p in pairs]))
+                cols.update(dict.fromkeys([p[1] for p in pairs]))
+                if pairs:
+                    max_dist = max(max_dist, t.get("orient_dist", 10))
+            elif term["type"] == "plddt":
+                t["selection"] = self._renumber(self._selection(term.get("selection", "all"), structure, kwargs), dsobj, False)
+            prepared.append(t)
+        return prepared, list(rows), list(cols), max_dist
+
+    def _evaluate(self, t, structure, search, results, dsobj, pdb):
+        """quantities of one term; "value" is the one that is weighted into the score"""
+        kind = t["type"]
+        if kind in CONTACT_TYPES and (t["selection1"] is None or t["selection2"] is None):
+            return {"value": 0, "count": 0, "pairs": [], "pae_per_contact": 0}
+
+        if kind == "pae_weighted_contacts":
+            pairs = search.pairs(t["selection1"], t["selection2"], t["cutoff"], cap=t.get("cap", 36))
+            score = pae_weighted_contact_sum(results['pae_output'][0], residue_indices([p[0] for p in pairs], structure.resindices),
+                                             residue_indices([p[1] for p in pairs], structure.resindices))
+            pae_per_contact = 0
+            if pairs:
+                pae_per_contact = (70.0-(70.0*score)/len(pairs))/2
+            return {"value": score, "count": len(pairs), "pairs": pairs, "pae_per_contact": pae_per_contact}
+
+        if kind == "contacts":
+            pairs = search.pairs(t["selection1"], t["selection2"], t["cutoff"])
+            return {"value": min(len(pairs), t.get("cap", 36)), "count": len(pairs), "pairs": pairs}
+
+        if kind == "contact_hits":
+            #contacting residues of selection1 that are hits: by default, residues of chain "chain" whose number is
+            #in the selection as given (the matching used by the bonus/penalty terms of the original score functions)
+            pairs = search.pairs(t["selection1"], t["selection2"], t["cutoff"], cap=t.get("cap", 36))
+            hits = t.get("hits")
+            if hits is None:
+                hits = t["raw_selection1"]
+            chain = t.get("chain", "A")
+            count = 0
+            for pair in pairs:
+                for res in pair:
+                    if t.get("match", "number") == "resid":
+                        hit = res in hits
+                    else:
+                        hit = res[0:1] == chain and int(res[1:]) in hits
+                    if hit:
+                        count += 1
+            return {"value": count, "count": count, "pairs": pairs}
+
+        if kind == "plddt":
+            if "batch_value" in t:
+                return {"value": t["batch_value"]}
+            plddt = results['plddt']
+            score = 0
+            for res in t["selection"]:
+                score = score + plddt[structure.resindices[res]]
+            return {"value": score/len(t["selection"])}
+
+        if kind == "rmsd_to_reference":
+            reference = load_reference(t["reference"])
+            reslist1 = self._selection(t.get("selection1", "all"), reference, {})
+            reslist2 = self._selection(t.get("selection2", "all"), structure, {})
+            if t.get("chain_permutation"):
+                #homo-oligomers: chains of the reference may be matched to any chain of the prediction with the same sequence
+                rmsd, assignment = get_rmsd_chain_permutation_to_reference(reference, structure, chains1=t.get("chains1"),
+                                                                           chains2=t.get("chains2"), ca_only=t.get("ca_only", True))
+            else:
+                rmsd = get_rmsd_to_reference(reference, reslist1, structure, reslist2, ca_only=t.get("ca_only", False), dsobj=dsobj)
+            value = rmsd
+            if "spring_constant" in t:
+                #flat-bottom quadratic potential
+                value = 0
+                if rmsd > t.get("rmsd_cutoff", 0):
+                    value = t["spring_constant"]*math.pow(rmsd - t.get("rmsd_cutoff", 0), 2)
+            return {"value": value, "rmsd": rmsd}
+
+        if kind == "orientation":
+            corrects = [1 if search.distance(a, b) <= t.get("orient_dist", 10) else 0 for a, b in t["pairs"]]
+            penalty = t.get("penalty", 10)
+            return {"value": sum([penalty for x in corrects if x==0]), "corrects": corrects}
+
+    def __call__(self, results, dsobj, **kwargs):
+        from alphafold.common import protein
+        pdb = protein.to_pdb(results['unrelaxed_protein'])
+        return self.score_pdb(pdb, results, dsobj, **kwargs)
+
+    def score_batch(self, results_list, dsobjs, stacked=None, **kwargs):
+        """
+        scores a whole generation, same output as [plan(results, dsobj, **kwargs), ...]
+        (the batch scorer protocol of utils/scoring.py, stacked as from stack_results)
+        """
+        from alphafold.common import protein
+        pdbs = [protein.to_pdb(results['unrelaxed_protein']) for results in results_list]
+        return self.score_pdbs(pdbs, results_list, dsobjs, stacked=stacked, **kwargs)
+
+    def score_pdb(self, pdb, results, dsobj, **kwargs):
+        """scores an already converted prediction"""
+        return self.score_pdbs([pdb], [results], [dsobj], **kwargs)[0]
+
+    def score_pdbs(self, pdbs, results_list, dsobjs, stacked=None, **kwargs):
+        """scores already converted predictions"""
+        if stacked is None:
+            stacked = stack_results(results_list)
+        return self._score_structures([Structure(pdb) for pdb in pdbs], results_list, dsobjs, kwargs, stacked)
+
+    def _score_structures(self, structures, results_list, dsobjs, kwargs, stacked):
+        """
+        pLDDT terms are gathered from the stacked (B, L) pLDDT array of
+        utils.scoring.stack_results.
+        """
+        kwargs = dict(kwargs)
+        for key, val in self.defaults.items():
+            if kwargs.get(key) is None:
+                kwargs[key] = val
+
+        out = [None]*len(structures)
+        items = list(range(len(structures)))
+        if self.monomer:
+            mono = [i for i in items if len(structures[i].chains) == 1]
+            if mono:
+                mono_stacked = {key: (val[mono] if val is not None else None) for key, val in stacked.items()}
+                scores = self.monomer._score_structures([structures[i] for i in mono], [results_list[i] for i in mono],
+                                                        [dsobjs[i] for i in mono], kwargs, mono_stacked)
+                for i, score in zip(mono, scores):
+                    out[i] = score
+                items = [i for i in items if i not in set(mono)]
+
+        prepared = {}
+        searches = {}
+        for i in items:
+            prepared[i], rows, cols, max_dist = self._prepare(structures[i], dsobjs[i], kwargs)
+            searches[i] = ContactSearch(structures[i], rows, cols, max_dist)
+
+        for j, term in enumerate(self.terms):
+            if term["type"] == "plddt":
+                self._batch_plddt(j, items, structures, results_list, prepared, stacked["plddt"])
+
+        for i in items:
+            out[i] = self._finish(prepared[i], structures[i], searches[i], results_list[i], dsobjs[i], kwargs)
+        return out
+
+    def _batch_plddt(self, j, items, structures, results_list, prepared, stacked_plddt=None):
+        """
+        mean pLDDT of term j for all items, one gather per group of items with the same selected positions,
+        from stacked_plddt (B, L) if the predictions have the same length
+        """
+        groups = {}
+        for i in items:
+            positions = tuple([structures[i].resindices[res] for res in prepared[i][j]["selection"]])
+            groups.setdefault(positions, []).append(i)
+        for positions, members in groups.items():
+            lengths = set([len(results_list[i]['plddt']) for i in members])
+            if len(lengths) > 1 or not positions:
+                continue
+            if stacked_plddt is not None:
+                plddt = stacked_plddt[members]
+            else:
+                plddt = np.stack([np.asarray(results_list[i]['plddt']) for i in members])
+            #cumulative sum adds left to right like the per-item loop, so the values are identical
+            totals = np.cumsum(plddt[:, list(positions)], axis=1)[:, -1]
+            for i, total in zip(members, totals):
+                prepared[i][j]["batch_value"] = total/len(positions)
+
+    def _finish(self, prepared, structure, search, results, dsobj, kwargs):
+        pdb = structure.pdb
+        values = {}
+        score = None
+        for t in prepared:
+            quantities = self._evaluate(t, structure, search, results, dsobj, pdb)
+            contribution = t.get("weight", 1)*quantities["value"]
+            if "divisor" in t:
+                contribution = contribution/t["divisor"]
+            values[t["name"]] = contribution
+            for key, val in quantities.items():
+                values[t["name"] + "." + key] = val
+            score = contribution if score is None else score + contribution
+        values["score"] = score if score is not None else 0
+
+        details = tuple([values[x] for x in self.details])
+        out = []
+        for item in self.returns:
+            if item == "details":
+                out.append(details)
+            elif item == "pdb":
+                out.append(pdb)
+            elif item == "results":
+                out.append(results)
+            elif item.startswith("$"):
+                out.append(_resolve(item, kwargs))
+            else:
+                out.append(values[item])
+        return tuple(out)
+
+def compile_spec(spec):
+    """ScorePlan for a spec dictionary or the path of a spec file"""
+    if isinstance(spec, str):
+        spec = load_spec(spec)
+    return ScorePlan(spec)
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -66,7 +66,8 @@ def getEvoProParser() -> FileArgumentParser:
                         default='',
                         type=str,
                         help='Path and file name of python script containing the score'
-                        ' function used to evaluate fitness of the alphafold predictions. Required.')
+                        ' function used to evaluate fitness of the alphafold predictions, or of a .json/.yaml score spec'
+                        ' (see score_funcs/score_spec.py). Required.')
 
     parser.add_argument('--score_func',
                         default='',
@@ -201,6 +202,165 @@ def getEvoProParser() -> FileArgumentParser:
                         type=str,
                         help='Chain ID permutations to run through individual AF2 runs, separated by commas. Default is None.')
 
+    parser.add_argument('--prediction_server',
+                        default=None,
+                        type=str,
+                        help='Address (socket path) of a running prediction server (run/run_prediction_server.py) to send AF2 jobs to,'
+                        ' instead of starting GPU workers for this run. Default is None.')
+
+
+    parser.add_argument('--mmap_results',
+                         action='store_true',
+                         help='Workers hand large arrays in AF2 results (pae, logits) back through memory-mapped files instead of'
+                         ' pickling them through the result queue. With --prediction_server, the server\'s --mmap_results is used instead.'
+                         ' Default is False.')
+
+    parser.add_argument('--drop_result_keys',
+                        default=None,
+                        type=str,
+                        help='AF2 result keys that the score function never reads, separated by commas, dropped by the workers'
+                        ' before results are sent back. Example: distogram,experimentally_resolved,masked_msa. Default is None.')
+
+
+    parser.add_argument('--score_in_workers',
+                         action='store_true',
+                         help='Run the score function inside each AF2 worker right after prediction, so only scores and'
+                         ' trimmed results come back to the main process. Only for per-prediction score functions'
+                         ' (run_evopro_binder.py). Default is False.')
+
+
+    parser.add_argument('--scoring_cpus',
+                        default='0',
+                        type=int,
+                        help='Number of CPU processes used to score a whole generation of AF2 predictions in parallel.'
+                        ' Default is 0 (score one prediction at a time in the main process).')
+
+
+    parser.add_argument('--surrogate_oversample',
+                        default='1',
+                        type=int,
+                        help='Create this many times more mutation/crossover children than needed and only send the ones a'
+                        ' surrogate model (trained on all sequences scored so far) ranks best to AF2. Default is 1 (off).')
+
+    parser.add_argument('--surrogate_explore',
+                        default='0.1',
+                        type=float,
+                        help='Fraction of the children sent to AF2 that are picked at random instead of by the surrogate'
+                        ' model. Default is 0.1.')
+
+
+    parser.add_argument('--repeat_af2_max',
+                        default='5',
+                        type=int,
+                        help='Maximum number of AF2 predictions of the same sequence when repeating AF2. Default is 5.')
+
+    parser.add_argument('--repeat_af2_confidence',
+                        default=None,
+                        type=float,
+                        help='Stop repeating AF2 on a sequence early once its mean score is above or below the selection cutoff'
+                        ' with this confidence (e.g. 0.9). Default is None (always repeat up to --repeat_af2_max).')
+
+
+    parser.add_argument('--memory_budget',
+                        default=None,
+                        type=float,
+                        help='Memory (in GB) the pdbs and AF2 results of scored sequences may take in the main process. Older'
+                        ' predictions beyond it are written to outputs/spilled_predictions/ and read back when needed.'
+                        ' Default is None (keep everything in memory).')
+
+
+    parser.add_argument('--prediction_cache_size',
+                        default='0',
+                        type=int,
+                        help='Number of AF2 predictions kept across iterations, keyed by the exact chain sequences predicted,'
+                        ' so unchanged states are not predicted again. Only used with --no_repeat_af2. Identical jobs'
+                        ' within an iteration are always predicted once. Default is 0.')
+
+
+    parser.add_argument('--cache_chain_features',
+                         action='store_true',
+                         help='AF2 workers keep the features of each chain sequence (MSA, templates) and only featurize chains'
+                         ' they have not seen, e.g. only the designed chain in binder runs. Chains are featurized unpaired.'
+                         ' Not available with --prediction_server. Default is False.')
+
+
+    parser.add_argument('--cascade',
+                         action='store_true',
+                         help='Predict every sequence cheaply first (one model, --cascade_recycles recycles) and only make full'
+                         ' predictions for the ones that pass --cascade_keep or --cascade_threshold. Sequences with only a cheap'
+                         ' score are always ranked below full-fidelity ones. Both use the normal feature pipeline unless'
+                         ' --cache_chain_features is also given. Not available with --prediction_server. Default is False.')
+
+    parser.add_argument('--cascade_recycles',
+                        default='1',
+                        type=int,
+                        help='Number of recycles of cheap cascade predictions. Default is 1.')
+
+    parser.add_argument('--cascade_keep',
+                        default='0.5',
+                        type=float,
+                        help='Fraction of sequences, by cheap score, that get a full prediction. Default is 0.5.')
+
+    parser.add_argument('--cascade_threshold',
+                        default=None,
+                        type=float,
+                        help='If set, every sequence with a cheap score at or below this value gets a full prediction,'
+                        ' instead of using --cascade_keep. Default is None.')
+
+    parser.add_argument('--jax_cache_dir',
+                        default=None,
+                        type=str,
+                        help='Directory of a persistent JAX compilation cache shared by AF2 workers and runs, so repeat runs'
+                        ' with the same model and lengths skip compilation. Compiled shapes are logged to compile_log.json in the'
+                        ' cache and worker startup timings are written to the input directory. Default is None.')
+
+
+    parser.add_argument('--batch_jobs',
+                        default='1',
+                        type=int,
+                        help='Send up to this many prediction jobs of the same shape to a worker at once, so per-job overhead'
+                        ' is shared. Most useful for short peptide designs. Default is 1.')
+
+
+    parser.add_argument('--fill_gpu_slots',
+                         action='store_true',
+                         help='Top up each generation with spare sequences (or repeat predictions) or trim new ones, based on'
+                         ' predicted job durations, so no GPU sits idle in the last round of predictions. Default is False.')
+
+
+    parser.add_argument('--island_id',
+                        default=None,
+                        type=int,
+                        help='Run as island number island_id (starting at 0) of an island-model campaign that exchanges'
+                        ' sequences through --migration_dir. Default is None (no migration).')
+
+    parser.add_argument('--num_islands',
+                        default='1',
+                        type=int,
+                        help='Number of islands in the campaign. Default is 1.')
+
+    parser.add_argument('--migration_dir',
+                        default=None,
+                        type=str,
+                        help='Directory shared by all islands (e.g. on a network file system) used for migration.'
+                        ' With --prediction_cache_size, the islands also share their predictions through it. Default is None.')
+
+    parser.add_argument('--migration_interval',
+                        default='5',
+                        type=int,
+                        help='Number of iterations between migrations. Default is 5.')
+
+    parser.add_argument('--migration_top_k',
+                        default='2',
+                        type=int,
+                        help='Number of best sequences each island sends per migration. Default is 2.')
+
+    parser.add_argument('--migration_topology',
+                        default='ring',
+                        type=str,
+                        help='Islands each island receives from: ring (the previous island), all, or random (one other'
+                        ' island per migration). Default is ring.')
+
     return parser
 
 if __name__ == "__main__":
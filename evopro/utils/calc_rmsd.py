@@ -21,32 +21,112 @@ def fit_rms(ref_c,c):
     U = np.dot(r1, r2)
     return (c_trans, U, ref_trans)
 
+def fit_rms_batch(ref_c, c):
+    """fit_rms of every c[i] (B,N,3) onto ref_c (N,3), with one batched SVD"""
+    ref_trans = np.average(ref_c, axis=0)
+    c_trans = np.average(c, axis=1)
+    C = np.einsum("bni,nj->bij", c - c_trans[:, None, :], ref_c - ref_trans)
+    (r1, s, r2) = np.linalg.svd(C)
+    # compute sign (remove mirroring)
+    r2[np.linalg.det(C) < 0, 2, :] *= -1.0
+    U = np.matmul(r1, r2)
+    return (c_trans, U, ref_trans)
+
+def name_mask(names, name=None):
+    """boolean mask of the atoms called name (a name or a list of names); all atoms if name is None"""
+    names = np.asarray(names)
+    if name is None:
+        return np.ones(len(names), dtype=bool)
+    if isinstance(name, str):
+        return names == name
+    return np.isin(names, list(name))
+
+def pdb_arrays(pdb):
+    """(N,3) coordinates and atom names of the ATOM records of a pdb string, in file order"""
+    coords = []
+    names = []
+    for line in pdb.split("\n"):
+        if line.startswith('ATOM'):
+            names.append(line[11:16].strip())
+            coords.append((float(line[30:38]), float(line[38:46]), float(line[46:54])))
+    return np.array(coords, dtype=float).reshape(-1, 3), np.array(names, dtype=str)
+
+def write_coords_pdb(pdb, coords, filename=None):
+    """
+    pdb string with the coordinates of its ATOM records (in file order) replaced
+    by coords, e.g. aligned with RMSDcalculator.transform; written to filename if given
+    """
+    lines = pdb.split("\n")
+    i = 0
+    for k, line in enumerate(lines):
+        if line.startswith('ATOM'):
+            x, y, z = coords[i]
+            lines[k] = line[:30] + "%8.3f%8.3f%8.3f" % (x, y, z) + line[54:]
+            i += 1
+    if i != len(coords):
+        raise ValueError("pdb has " + str(i) + " atoms but " + str(len(coords)) + " coordinates were given")
+    out = "\n".join(lines)
+    if filename:
+        with open(filename, "w") as f:
+            f.write(out)
+    return out
+
 class RMSDcalculator:
+    """
+    RMSD after superposition of atoms2 onto atoms1. Takes read_pdb Atom lists,
+    or (N,3) coordinate arrays with their atom names (names1/names2) via from_arrays;
+    name selects the atoms used for the fit (e.g. 'CA').
+    """
+
     def __init__(self, atoms1, atoms2, name=None):
         xyz1 = self.get_xyz(atoms1, name=name)
         xyz2 = self.get_xyz(atoms2, name=name)
         self.set_rmsd(xyz1, xyz2)
 
+    @classmethod
+    def from_arrays(cls, xyz1, xyz2, names1=None, names2=None, name=None):
+        calc = cls.__new__(cls)
+        if name is not None:
+            xyz1 = xyz1[name_mask(names1, name)]
+            xyz2 = xyz2[name_mask(names2, name)]
+        calc.set_rmsd(np.asarray(xyz1, dtype=float), np.asarray(xyz2, dtype=float))
+        return calc
+
     def get_xyz(self, atoms, name=None):
-        xyz = []
-        for atom in atoms:
-            if name:
-                if atom.name != name: continue
-            xyz.append([atom.x, atom.y, atom.z])
-        return np.array(xyz)
+        return np.array([[atom.x, atom.y, atom.z] for atom in atoms if not name or atom.name == name]).reshape(-1, 3)
 
     def set_rmsd(self, c1, c2):
         self.rmsd = 0.0
         self.c_trans, self.U, self.ref_trans = fit_rms(c1, c2)
-        new_c2 = np.dot(c2 - self.c_trans, self.U) + self.ref_trans
+        new_c2 = self.transform(c2)
         self.rmsd = np.sqrt( np.average( np.sum( ( c1 - new_c2 )**2, axis=1 ) ) )
 
+    def transform(self, xyz):
+        """applies the fitted superposition to (N,3) coordinates (e.g. all atoms of the structure) with one matrix multiply"""
+        return np.dot(np.asarray(xyz, dtype=float) - self.c_trans, self.U) + self.ref_trans
+
     def get_aligned_coord(self, atoms, name=None):
-        new_c2 = copy.deepcopy(atoms)
-        for atom in new_c2:
-            atom.x, atom.y, atom.z = np.dot(np.array([atom.x, atom.y, atom.z]) - self.c_trans, self.U) + self.ref_trans
+        new_xyz = self.transform(self.get_xyz(atoms))
+        new_c2 = [copy.copy(atom) for atom in atoms]
+        for atom, (x, y, z) in zip(new_c2, new_xyz):
+            atom.x, atom.y, atom.z = x, y, z
         return new_c2
 
+def superpose_to_reference(ref_xyz, xyz, fit_mask=None):
+    """
+    Superimposes a batch of same-size structures xyz (B,N,3) onto ref_xyz (N,3),
+    fitting on the atoms in fit_mask (e.g. name_mask(names, 'CA')).
+    Returns the RMSDs over the fitted atoms (B,) and all coordinates aligned (B,N,3).
+    """
+    ref_xyz = np.asarray(ref_xyz, dtype=float)
+    xyz = np.asarray(xyz, dtype=float)
+    if fit_mask is None:
+        fit_mask = np.ones(ref_xyz.shape[0], dtype=bool)
+    c_trans, U, ref_trans = fit_rms_batch(ref_xyz[fit_mask], xyz[:, fit_mask])
+    aligned = np.matmul(xyz - c_trans[:, None, :], U) + ref_trans
+    rmsds = np.sqrt(np.average(np.sum((ref_xyz[fit_mask] - aligned[:, fit_mask])**2, axis=2), axis=1))
+    return rmsds, aligned
+
 if __name__ == '__main__':
     pdbf1 = '../tests/pd1_threehelix_run1/sequence_0_model_1_unrelaxed.pdb'; pdbf2 = '../tests/pd1_threehelix_run1/sequence_10_model_1_unrelaxed.pdb'
     with open(pdbf1, "r") as f1:
@@ -0,0 +1,230 @@
+"""
+Successive-halving scheduler for campaigns of many EvoPro runs (the pairN/runM
+directories made by run/create_dirs_largerun.py). Runs are ranked at rungs of
+increasing iteration counts once every run still in the campaign has reached
+the rung, and the bottom ones are stopped so their GPUs go to runs still waiting.
+"""
+
+import os
+import re
+import json
+import math
+import time
+import signal
+import subprocess
+import statistics
+
+#set for runs launched by a campaign, to the GPUs given to the run (same as their CUDA_VISIBLE_DEVICES)
+GPU_ALLOCATION_ENV = "EVOPRO_CAMPAIGN_GPUS"
+
+def campaign_gpus():
+    """GPUs given to this run by a campaign scheduler, or None if it was not launched by one"""
+    gpus = os.environ.get(GPU_ALLOCATION_ENV)
+    if gpus is None:
+        return None
+    return [x for x in gpus.split(",") if x.strip()]
+
+def find_runs(main_dir):
+    """pairN/runM directories under main_dir, replicate 1 of every pair first"""
+    runs = []
+    for pair in os.listdir(main_dir):
+        m = re.fullmatch(r"pair(\d+)", pair)
+        if not m or not os.path.isdir(os.path.join(main_dir, pair)):
+            continue
+        for run in os.listdir(os.path.join(main_dir, pair)):
+            n = re.fullmatch(r"run(\d+)", run)
+            if n and os.path.isdir(os.path.join(main_dir, pair, run)):
+                runs.append((int(n.group(1)), int(m.group(1)), os.path.join(main_dir, pair, run)))
+    return [r[2] for r in sorted(runs)]
+
+def read_progress(run_dir):
+    """overall scores of the sorted pool of each finished iteration, from outputs/runtime_seqs_and_scores.log"""
+    path = os.path.join(run_dir, "outputs", "runtime_seqs_and_scores.log")
+    if not os.path.isfile(path):
+        return []
+    with open(path, "r") as f:
+        text = f.read()
+    iters = []
+    for block in text.split("starting iteration ")[1:]:
+        lines = block.split("\n")[1:]
+        scores = []
+        for lin in lines:
+            l = lin.strip().split("\t")
+            if len(l) < 2:
+                continue
+            first = l[1].strip("()[] ").split(",")[0]
+            try:
+                scores.append(float(first))
+            except ValueError:
+                continue
+        iters.append(scores)
+    #the last iteration may still be being written
+    if iters and not text.endswith("\n"):
+        iters = iters[:-1]
+    return iters
+
+def rung_stats(iters, num_iters):
+    """best score seen in the first num_iters iterations, and median score of the pool at iteration num_iters"""
+    best = min([min(x) for x in iters[:num_iters] if x] + [float("inf")])
+    return best, statistics.median(iters[num_iters-1] or [best])
+
+class SuccessiveHalving:
+    """
+    Successive halving with complete cohorts. Rung r is reached after
+    min_iters*eta**r iterations. Once every run that is still in the campaign
+    at rung r has reached it (or finished without reaching it), the runs that
+    reached it are ranked by the sum of their ranks by best and by median
+    score (lower is better), and only the top 1/eta continue. Runs are never
+    stopped on the results of part of a cohort.
+    """
+
+    def __init__(self, min_iters=10, eta=2):
+        self.min_iters = min_iters
+        self.eta = eta
+        self.results = {}
+        #rung -> runs kept at that rung
+        self.kept = {}
+
+    def rung_iters(self, rung):
+        return self.min_iters*self.eta**rung
+
+    def report(self, run, rung, best, median):
+        self.results.setdefault(rung, {})[run] = (best, median)
+
+    def decide(self, rung, cohort):
+        """
+        runs of cohort kept at rung, or None while some of them have not reported for it.
+        cohort holds the runs still competing at rung that have reached it or may still reach it.
+        """
+        results = self.results.get(rung, {})
+        if any(run not in results for run in cohort):
+            return None
+        by_best = sorted(cohort, key=lambda r: results[r][0])
+        by_median = sorted(cohort, key=lambda r: results[r][1])
+        ranked = sorted(cohort, key=lambda r: by_best.index(r) + by_median.index(r))
+        self.kept[rung] = set(ranked[:math.ceil(len(ranked)/self.eta)])
+        return self.kept[rung]
+
+class LocalBackend:
+    """Runs each job as a local process on its own group of GPUs."""
+
+    def __init__(self, gpus, gpus_per_run=1):
+        self.free = [gpus[i:i+gpus_per_run] for i in range(0, len(gpus) - gpus_per_run + 1, gpus_per_run)]
+        self.procs = {}
+
+    def has_slot(self):
+        return bool(self.free)
+
+    def launch(self, run_dir, command):
+        gpus = self.free.pop(0)
+        env = dict(os.environ)
+        env["CUDA_VISIBLE_DEVICES"] = ",".join([str(x) for x in gpus])
+        env[GPU_ALLOCATION_ENV] = env["CUDA_VISIBLE_DEVICES"]
+        logf = open(os.path.join(run_dir, "campaign_run.log"), "a")
+        proc = subprocess.Popen(command, cwd=run_dir, env=env, stdout=logf, stderr=subprocess.STDOUT,
+                                shell=True, start_new_session=True)
+        self.procs[run_dir] = (proc, logf, gpus)
+
+    def running(self, run_dir):
+        return self.procs[run_dir][0].poll() is None
+
+    def stop(self, run_dir):
+        proc = self.procs[run_dir][0]
+        if proc.poll() is None:
+            #the whole process group, so AF2 workers go too
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+
+    def release(self, run_dir):
+        proc, logf, gpus = self.procs.pop(run_dir)
+        logf.close()
+        self.free.append(gpus)
+        return proc.returncode
+
+class Campaign:
+    """Launches runs as slots free up and stops the ones successive halving drops."""
+
+    def __init__(self, run_dirs, backend, scheduler, command, status_file=None, poll_interval=60):
+        self.queue = list(run_dirs)
+        self.backend = backend
+        self.scheduler = scheduler
+        self.command = command
+        self.status_file = status_file
+        self.poll_interval = poll_interval
+        self.rungs = {}
+        self.decided_rungs = 0
+        self.state = {run: "queued" for run in run_dirs}
+
+    def _report(self, run):
+        """reports every rung run has reached since the last check"""
+        iters = read_progress(run)
+        rung = self.rungs.get(run, 0)
+        while len(iters) >= self.scheduler.rung_iters(rung):
+            best, median = rung_stats(iters, self.scheduler.rung_iters(rung))
+            self.scheduler.report(run, rung, best, median)
+            rung += 1
+            self.rungs[run] = rung
+
+    def _cohort(self, rung):
+        """runs still competing at rung: kept at the rung before, and queued, running, or finished after reaching rung"""
+        if rung == 0:
+            runs = list(self.state)
+        else:
+            runs = [r for r in self.state if r in self.scheduler.kept[rung-1]]
+        reported = self.scheduler.results.get(rung, {})
+        return [r for r in runs if self.state[r] in ("queued", "running") or (self.state[r] == "finished" and r in reported)]
+
+    def _decide(self):
+        """makes the decisions of every rung whose cohort is complete, in rung order, and stops the runs that are dropped"""
+        while True:
+            rung = self.decided_rungs
+            cohort = self._cohort(rung)
+            if not cohort:
+                return
+            kept = self.scheduler.decide(rung, cohort)
+            if kept is None:
+                return
+            for run in cohort:
+                if run not in kept and self.state[run] == "running":
+                    best, median = self.scheduler.results[rung][run]
+                    print("stopping", run, "at rung", rung, "best", best, "median", median)
+                    self.backend.stop(run)
+                    self.backend.release(run)
+                    self.state[run] = "stopped"
+            self.decided_rungs += 1
+
+    def write_status(self):
+        if self.status_file:
+            status = {}
+            for run in self.state:
+                status[run] = {"state": self.state[run], "rung": self.rungs.get(run, 0)}
+                for rung in self.scheduler.results:
+                    if run in self.scheduler.results[rung]:
+                        status[run]["best"], status[run]["median"] = self.scheduler.results[rung][run]
+            with open(self.status_file, "w") as f:
+                json.dump(status, f, indent=1)
+
+    def run(self):
+        while True:
+            for run in [r for r in self.state if self.state[r] == "running"]:
+                done = not self.backend.running(run)
+                self._report(run)
+                if done:
+                    returncode = self.backend.release(run)
+                    self.state[run] = "finished" if returncode == 0 else "failed"
+                    print(run, self.state[run])
+            self._decide()
+
+            while self.queue and self.backend.has_slot():
+                run = self.queue.pop(0)
+                print("launching", run)
+                self.backend.launch(run, self.command)
+                self.state[run] = "running"
+
+            self.write_status()
+            if not self.queue and "running" not in self.state.values():
+                return self.state
+            time.sleep(self.poll_interval)
+
+if __name__=="__main__":
+    print("no main functionality")
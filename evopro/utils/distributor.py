@@ -1,10 +1,148 @@
 import multiprocessing as mp
 import collections
+import dataclasses
+import os
+import shutil
+import tempfile
+import uuid
 from typing import Sequence, Union
 
 from functools import partial
 import numpy as np
 
+class MappedArray:
+    """Small stand-in sent over the queue for an array that a worker
+    wrote to a memory-mapped .npy file."""
+    def __init__(self, path):
+        self.path = path
+
+class PackedDataclass:
+    """Stand-in for a dataclass (e.g. the AF2 Protein) whose array fields
+    were replaced by MappedArrays. Rebuilt on the driver side."""
+    def __init__(self, cls, fields):
+        self.cls = cls
+        self.fields = fields
+
+def pack_result(result, mmap_dir=None, min_bytes=65536, drop_keys=None):
+    """Prepare a worker result for the trip back to the driver. Dictionary
+    entries in drop_keys are removed, and if mmap_dir is given, arrays of at
+    least min_bytes are written to memory-mapped files so only their paths
+    travel through the queue.
+    """
+    if isinstance(result, dict):
+        return {k: pack_result(v, mmap_dir, min_bytes, drop_keys) for k, v in result.items()
+                if not drop_keys or k not in drop_keys}
+    if isinstance(result, list):
+        return [pack_result(v, mmap_dir, min_bytes, drop_keys) for v in result]
+    if isinstance(result, tuple):
+        return tuple(pack_result(v, mmap_dir, min_bytes, drop_keys) for v in result)
+    if dataclasses.is_dataclass(result) and not isinstance(result, type):
+        fields = {f.name: pack_result(getattr(result, f.name), mmap_dir, min_bytes, drop_keys)
+                  for f in dataclasses.fields(result)}
+        return PackedDataclass(type(result), fields)
+    if mmap_dir and hasattr(result, "__array__") and hasattr(result, "nbytes"):
+        if result.nbytes >= min_bytes:
+            path = os.path.join(mmap_dir, uuid.uuid4().hex + ".npy")
+            np.save(path, np.asarray(result))
+            return MappedArray(path)
+    return result
+
+def unpack_result(result):
+    """Inverse of pack_result on the driver side. Mapped arrays are opened
+    copy-on-write without reading them into memory, and their files are
+    unlinked right away (the mapping stays valid until the array is freed).
+    """
+    if isinstance(result, MappedArray):
+        arr = np.load(result.path, mmap_mode="c")
+        os.remove(result.path)
+        return arr.view(np.ndarray)
+    if isinstance(result, PackedDataclass):
+        return result.cls(**{k: unpack_result(v) for k, v in result.fields.items()})
+    if isinstance(result, dict):
+        return {k: unpack_result(v) for k, v in result.items()}
+    if isinstance(result, list):
+        return [unpack_result(v) for v in result]
+    if isinstance(result, tuple):
+        return tuple(unpack_result(v) for v in result)
+    return result
+
+def link_result(result):
+    """Copy of a packed result whose mapped array files are new hard links to
+    the same data, so it can be unpacked by a second receiver (unpack_result
+    unlinks the files it opens).
+    """
+    if isinstance(result, MappedArray):
+        path = os.path.join(os.path.dirname(result.path), uuid.uuid4().hex + ".npy")
+        os.link(result.path, path)
+        return MappedArray(path)
+    if isinstance(result, PackedDataclass):
+        return PackedDataclass(result.cls, {k: link_result(v) for k, v in result.fields.items()})
+    if isinstance(result, dict):
+        return {k: link_result(v) for k, v in result.items()}
+    if isinstance(result, list):
+        return [link_result(v) for v in result]
+    if isinstance(result, tuple):
+        return tuple(link_result(v) for v in result)
+    return result
+
+def discard_result(result):
+    """Removes the mapped array files of a packed result that will not be unpacked."""
+    if isinstance(result, MappedArray):
+        if os.path.exists(result.path):
+            os.remove(result.path)
+    elif isinstance(result, PackedDataclass):
+        discard_result(list(result.fields.values()))
+    elif isinstance(result, dict):
+        discard_result(list(result.values()))
+    elif isinstance(result, (list, tuple)):
+        for v in result:
+            discard_result(v)
+
+class JobBatch:
+    """Several jobs of the same fidelity and shape sent to a worker in one message."""
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+def job_shape(w):
+    """Shape of a work list entry: its sequences replaced by their lengths."""
+    if isinstance(w, str):
+        return len(w)
+    if isinstance(w, (list, tuple)):
+        return tuple(job_shape(x) for x in w)
+    return w
+
+#fidelities of the (fidelity, entry) jobs of fidelity cascades (see genetic_alg/cascade.py)
+FIDELITIES = ("cheap", "full")
+
+def split_job(w):
+    """(fidelity, work list entry) of a job; jobs that are not (fidelity, entry) tuples are full fidelity."""
+    if type(w) is tuple and len(w) == 2 and w[0] in FIDELITIES:
+        return w
+    return "full", w
+
+def pack_batches(work_list, batch_size, n_workers):
+    """
+    Groups the indices of work_list into batches of at most batch_size jobs
+    with the same fidelity and job_shape. Batches are kept small enough that
+    all n_workers get work.
+    """
+    by_shape = collections.OrderedDict()
+    for i, w in enumerate(work_list):
+        fidelity, entry = split_job(w)
+        by_shape.setdefault((fidelity, job_shape(entry)), []).append(i)
+    size = max(1, min(batch_size, -(-len(work_list)//n_workers)))
+    batches = []
+    for inds in by_shape.values():
+        for start in range(0, len(inds), size):
+            batches.append(inds[start:start+size])
+    return batches
+
+def predict_batch(f, jobs):
+    """Runs the worker function on a list of jobs, vectorized if f has a predict_batch method."""
+    if hasattr(f, "predict_batch"):
+        return f.predict_batch(jobs)
+    return [f(w) for w in jobs]
+
 class Distributor:
     """This class will distribute work to sub-processes where
     the same function is run repeatedly with different inputs.
@@ -15,7 +153,8 @@ class Distributor:
     """
 
    
-    def __init__(self, n_workers, f_init, arg_file, lengths):
+    def __init__(self, n_workers, f_init, arg_file, lengths, mmap_results=False, drop_keys=None, min_mmap_bytes=65536,
+                 post_func=None, batch_size=1):
         """
         Construct a Distributor that manages n_workers sub-processes.
         The distributor will give work to its sub-processes in the
@@ -25,9 +164,28 @@ class Distributor:
         be called by each sub-process once as that process gets started.
         It should return the worker function that will do the heavy
         lifting.
+
+        If mmap_results is True, workers write large arrays in their
+        results to memory-mapped files (in /dev/shm when available)
+        instead of pickling them through the result queue. Result
+        dictionary keys listed in drop_keys are removed by the worker.
+
+        post_func, if given, is called by the worker on every output of
+        "f" as post_func(output, *job_args), where job_args are the extra
+        arguments passed to churn for that job (e.g. to score predictions
+        right after they are made).
+
+        With batch_size > 1, churn packs up to batch_size jobs of the
+        same shape into one message, and the worker runs them with
+        predict_batch, so per-job queue and call overhead is shared.
         """
         self.n_workers = n_workers
-        self.lock = mp.Lock()
+        self.batch_size = batch_size
+        self.post_func = post_func
+        self.mmap_dir = None
+        if mmap_results:
+            base_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            self.mmap_dir = tempfile.mkdtemp(prefix="evopro_results_", dir=base_dir)
         self.qs_out = [mp.Queue() for _ in range(n_workers)]
         self.q_in = mp.Queue()
         self.processes = [
@@ -36,11 +194,14 @@ class Distributor:
                 args=(
                     f_init,
                     i,
-                    self.lock,
                     self.qs_out[i],
                     self.q_in,
 		    arg_file,
-		    lengths)
+		    lengths,
+                    self.mmap_dir,
+                    min_mmap_bytes,
+                    drop_keys,
+                    post_func)
             )
             for i in range(n_workers)
         ]
@@ -58,12 +219,44 @@ class Distributor:
             self.qs_out[i].put((False, None))
         for i in range(self.n_workers):
             self.processes[i].join()
+        if self.mmap_dir:
+            shutil.rmtree(self.mmap_dir, ignore_errors=True)
            
 
-    def churn(self, work_list):
+    def submit(self, proc_id, w):
+        """Hand a single job to the worker with the given id. The caller
+        is responsible for only giving work to idle workers.
+        """
+        self.qs_out[proc_id].put((True, w))
+
+    def receive(self, timeout=None, unpack=True):
+        """Block until any worker finishes a job, and return
+        the id of that worker along with the job output. Raises
+        queue.Empty if a timeout is given and no job finished in time.
+        With unpack=False the output is returned as the worker packed
+        it, e.g. to pass its memory-mapped arrays on to another process
+        on the same node, which then calls unpack_result.
+        """
+        proc_id, val = self.q_in.get(timeout=timeout)
+        if not unpack:
+            return proc_id, val
+        return proc_id, unpack_result(val)
+
+    def churn(self, work_list, job_args=None):
         """Process the work in the work list, farming out work
-        to the subprocesses
+        to the subprocesses. job_args is an optional list (same
+        length as work_list) of argument tuples for post_func.
         """
+        batches = None
+        if self.batch_size > 1 and work_list:
+            batches = pack_batches(work_list, self.batch_size, self.n_workers)
+        if self.post_func is not None:
+            if job_args is None:
+                job_args = [() for _ in work_list]
+            work_list = list(zip(work_list, job_args))
+        if batches is not None:
+            jobs = work_list
+            work_list = [JobBatch([jobs[i] for i in inds]) for inds in batches]
         work_queue = collections.deque(work_list)
         n_jobs = len(work_queue)
         job_ind_for_worker = [-1] * self.n_workers
@@ -77,20 +270,20 @@ class Distributor:
         if self.n_workers < n_jobs:
             for i in range(self.n_workers):
                 w = work_queue.popleft()
-                self.qs_out[i].put((True, w))
+                self.submit(i, w)
                 job_ind_for_worker[i] = count_job
                 count_job += 1
         else:
             count = 0
             while len(work_queue) > 0:
                 w = work_queue.popleft()
-                self.qs_out[count].put((True, w))
+                self.submit(count, w)
                 job_ind_for_worker[count] = count_job
                 count += 1
                 count_job += 1
 
         while len(work_queue) > 0:
-            proc_id, val = self.q_in.get()
+            proc_id, val = self.receive()
             count_completed += 1
             #print("work_list loop count completed:", count_completed)
             job_ind = job_ind_for_worker[proc_id]
@@ -98,12 +291,12 @@ class Distributor:
             job_output[job_ind] = val
    
             w = work_queue.popleft()
-            self.qs_out[proc_id].put((True, w))
+            self.submit(proc_id, w)
             job_ind_for_worker[proc_id] = count_job
             count_job += 1
 
         while count_completed < n_jobs:
-            proc_id, val = self.q_in.get()
+            proc_id, val = self.receive()
             #print("wait-for-jobs to finish loop. count completed:", count_completed)
             count_completed += 1
             job_ind = job_ind_for_worker[proc_id]
@@ -111,24 +304,39 @@ class Distributor:
             job_ind_for_worker[proc_id] = -1
             job_output[job_ind] = val
 
+        if batches is not None:
+            batch_output = job_output
+            job_output = [None] * len(jobs)
+            for inds, vals in zip(batches, batch_output):
+                for i, val in zip(inds, vals):
+                    job_output[i] = val
+
         return job_output
 
            
     @staticmethod
-    def _worker_loop(f_init, proc_id, lock, q_in, q_out, arg_file, lengths):
+    def _worker_loop(f_init, proc_id, q_in, q_out, arg_file, lengths, mmap_dir, min_mmap_bytes, drop_keys, post_func):
 
         f = f_init(proc_id, arg_file, lengths)
    
         is_job, val = q_in.get()
         while is_job:
             #print(val)
-            result = f(val)
+            if isinstance(val, JobBatch):
+                if post_func is not None:
+                    outputs = predict_batch(f, [w for w, args in val.jobs])
+                    result = [post_func(output, *args) for output, (w, args) in zip(outputs, val.jobs)]
+                else:
+                    result = predict_batch(f, val.jobs)
+            elif post_func is not None:
+                val, args = val
+                result = post_func(f(val), *args)
+            else:
+                result = f(val)
+            result = pack_result(result, mmap_dir=mmap_dir, min_bytes=min_mmap_bytes, drop_keys=drop_keys)
        
-            lock.acquire()
-            try:
-                q_out.put((proc_id, result))
-            finally:
-                lock.release()
+            #mp.Queue.put is process-safe, no lock needed
+            q_out.put((proc_id, result))
             is_job, val = q_in.get()
         print("spinning down worker", proc_id)
 
@@ -0,0 +1,116 @@
+"""
+Persistent JAX compilation cache shared by all AF2 workers (and runs) on a
+file system, a log of the shapes compiled into it, and per-worker startup
+timing reports. The compile log is only a record for inspecting the cache and
+labelling startup timings; nothing is precompiled from it. Workers compile the
+shapes of their lengths on init, and any other shape (e.g. a vary_length
+variant) the first time it is predicted. Either way a shape compiled before,
+by any worker or run, is loaded from the persistent cache instead of being
+compiled, so warming up more shapes on init would only delay the first
+prediction with loads the run may never need.
+"""
+
+import os
+import json
+import time
+import fcntl
+
+COMPILE_LOG = "compile_log.json"
+
+def init_compilation_cache(cache_root):
+    """
+    Points JAX's persistent compilation cache to a subdirectory of cache_root
+    for the installed jax/jaxlib versions, and returns that directory.
+    Call before the first model is compiled.
+    """
+    import jax
+    import jaxlib
+
+    cache_dir = os.path.join(cache_root, "jax-" + jax.__version__ + "_jaxlib-" + jaxlib.__version__)
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
+    except AttributeError:
+        #older jax versions
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(cache_dir)
+    return cache_dir
+
+def compile_log_key(model_name, lengths, num_recycle):
+    return model_name + "|" + ",".join([str(x) for x in lengths]) + "|" + str(num_recycle)
+
+def read_compile_log(cache_dir):
+    path = os.path.join(cache_dir, COMPILE_LOG)
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def update_compile_log(cache_dir, entries):
+    """adds {compile_log_key: info} entries to the compile log, locked against other workers"""
+    with open(os.path.join(cache_dir, COMPILE_LOG + ".lock"), "w") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        compile_log = read_compile_log(cache_dir)
+        compile_log.update(entries)
+        tmp_path = os.path.join(cache_dir, COMPILE_LOG + "." + str(os.getpid()))
+        with open(tmp_path, "w") as f:
+            json.dump(compile_log, f, indent=1)
+        os.replace(tmp_path, os.path.join(cache_dir, COMPILE_LOG))
+        fcntl.flock(lockf, fcntl.LOCK_UN)
+
+class StartupTimer:
+    """
+    Collects the startup phases of one worker (imports, parameter loading,
+    compilation of each model and shape, first prediction) and writes them to
+    startup_timings_<proc_id>.json in report_dir.
+    """
+
+    def __init__(self, proc_id, report_dir):
+        self.proc_id = proc_id
+        self.path = os.path.join(report_dir, "startup_timings_" + str(proc_id) + ".json")
+        self.start = time.time()
+        self.timings = {"proc_id": proc_id, "import": 0.0, "param_load": 0.0, "compile": 0.0, "compiles": [],
+                        "first_prediction": None, "time_to_first_prediction": None}
+
+    def add(self, phase, seconds):
+        self.timings[phase] += seconds
+
+    def add_compile(self, model_name, lengths, num_recycle, seconds, cached):
+        self.timings["compile"] += seconds
+        self.timings["compiles"].append({"model_name": model_name, "lengths": lengths, "num_recycle": num_recycle,
+                                         "seconds": seconds, "compiled_before": cached})
+
+    def write(self):
+        self.timings["startup"] = time.time() - self.start
+        with open(self.path, "w") as f:
+            json.dump(self.timings, f, indent=1)
+
+class TimedFirstCall:
+    """wraps a worker function and records how long its first call took"""
+
+    def __init__(self, func, timer):
+        self.func = func
+        self.timer = timer
+
+    def __call__(self, *args, **kwargs):
+        return self._timed(self.func, *args, **kwargs)
+
+    def predict_batch(self, jobs):
+        if hasattr(self.func, "predict_batch"):
+            return self._timed(self.func.predict_batch, jobs)
+        return [self._timed(self.func, w) for w in jobs]
+
+    def _timed(self, func, *args, **kwargs):
+        if self.timer is None:
+            return func(*args, **kwargs)
+        t = time.time()
+        val = func(*args, **kwargs)
+        self.timer.timings["first_prediction"] = time.time() - t
+        self.timer.timings["time_to_first_prediction"] = time.time() - self.timer.start
+        self.timer.write()
+        self.timer = None
+        return val
+
+if __name__=="__main__":
+    print("no main functionality")
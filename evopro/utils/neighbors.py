@@ -0,0 +1,157 @@
+"""
+Cell-list neighbor search over the atoms of a parsed Structure, built once per
+prediction and shared by the contact, clash, bonus/penalty and orientation
+terms of the score functions.
+"""
+
+import collections
+import numpy as np
+
+from evopro.utils.structure import Structure
+
+#edge of the cells atoms are hashed into; queries with larger radii look further than the neighboring cells
+CELL_SIZE = 8.0
+
+class NeighborSearch:
+    """
+    Atoms hashed into cubic cells of cell_size. A query for residue sets X and Y
+    only computes distances between atoms of X and atoms of Y in cells within
+    reach of each other. Distances are computed like score_funcs.distance, so
+    cutoffs give the same contacts as the all-atom loops.
+    """
+
+    def __init__(self, structure, cell_size=CELL_SIZE):
+        self.structure = structure
+        self.cell_size = cell_size
+        coords = structure.coords
+        if len(coords):
+            cells = np.floor(coords/cell_size).astype(np.int64)
+            cells = cells - cells.min(axis=0)
+        else:
+            cells = np.zeros((0, 3), dtype=np.int64)
+        self.dims = cells.max(axis=0) + 1 if len(cells) else np.ones(3, dtype=np.int64)
+        self.cells = cells
+        keys = self._keys(cells)
+        self.order = np.argsort(keys, kind="stable")
+        self.sorted_keys = keys[self.order]
+
+        #bounding sphere of every residue, for early exits
+        n_res = len(structure.resids)
+        self.res_center = np.zeros((n_res, 3))
+        self.res_radius = np.zeros(n_res)
+        if len(coords):
+            counts = np.bincount(structure.atom_resindex, minlength=n_res)
+            for axis in range(3):
+                self.res_center[:, axis] = np.bincount(structure.atom_resindex, weights=coords[:, axis], minlength=n_res)/np.maximum(counts, 1)
+            spread = np.sqrt(((coords - self.res_center[structure.atom_resindex])**2).sum(axis=1))
+            np.maximum.at(self.res_radius, structure.atom_resindex, spread)
+
+    def _keys(self, cells):
+        return (cells[:, 0]*self.dims[1] + cells[:, 1])*self.dims[2] + cells[:, 2]
+
+    def _candidates(self, atoms, radius):
+        """(i, j): atoms[i] and every atom j in a cell within radius of its cell"""
+        reach = int(np.ceil(radius/self.cell_size))
+        steps = np.arange(-reach, reach + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing="ij"), axis=-1).reshape(-1, 3)
+        cells = self.cells[atoms][:, None, :] + offsets[None, :, :]
+        valid = np.all((cells >= 0) & (cells < self.dims), axis=-1)
+        src = np.nonzero(valid)[0]
+        keys = self._keys(cells[valid])
+        lo = np.searchsorted(self.sorted_keys, keys, side="left")
+        hi = np.searchsorted(self.sorted_keys, keys, side="right")
+        counts = hi - lo
+        total = counts.sum()
+        i = np.repeat(src, counts)
+        pos = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(total)
+        return i, self.order[pos]
+
+    def min_distances(self, reslist1, reslist2, max_dist):
+        """
+        (len(reslist1), len(reslist2)) minimum atom-atom distances between the
+        residues, np.inf where no atoms are within max_dist. Compute this once
+        at the largest radius to threshold it at several radii.
+        """
+        rows = list(dict.fromkeys(reslist1))
+        cols = list(dict.fromkeys(reslist2))
+        mindist = np.full((len(rows), len(cols)), np.inf)
+        if rows and cols:
+            s = self.structure
+            row_atoms = s.atom_indices(rows)
+            row_of_atom = np.repeat(np.arange(len(rows)), [len(s.atom_indices([res])) for res in rows])
+            col_of_atom = np.full(len(s.coords), -1)
+            for k, res in enumerate(cols):
+                col_of_atom[s.atom_indices([res])] = k
+
+            i, j = self._candidates(row_atoms, max_dist)
+            keep = col_of_atom[j] >= 0
+            i, j = i[keep], j[keep]
+            a = s.coords[row_atoms[i]]
+            b = s.coords[j]
+            d = b - a
+            #summed in the same order as score_funcs.distance so cutoffs behave identically
+            dist = np.sqrt(d[:, 0]**2 + d[:, 1]**2 + d[:, 2]**2)
+            close = dist <= max_dist
+            np.minimum.at(mindist, (row_of_atom[i[close]], col_of_atom[j[close]]), dist[close])
+
+        row_pos = {res: k for k, res in enumerate(rows)}
+        col_pos = {res: k for k, res in enumerate(cols)}
+        return mindist[np.ix_([row_pos[res] for res in reslist1], [col_pos[res] for res in reslist2])]
+
+    def contacts(self, reslist1, reslist2, radii):
+        """{radius: boolean (len(reslist1), len(reslist2)) matrix of residue pairs with atoms within radius}, one search for all radii"""
+        mindist = self.min_distances(reslist1, reslist2, max(radii))
+        return {radius: mindist <= radius for radius in radii}
+
+    def contact_matrix(self, reslist1, reslist2, dist):
+        return self.min_distances(reslist1, reslist2, dist) <= dist
+
+    def any_within(self, res1, res2, dist):
+        """True if any atom of res1 is within dist of any atom of res2"""
+        s = self.structure
+        i1 = s.resindices[res1]
+        i2 = s.resindices[res2]
+        #bounding spheres too far apart: no atom pair can be close enough
+        gap = np.sqrt(((self.res_center[i1] - self.res_center[i2])**2).sum()) - self.res_radius[i1] - self.res_radius[i2]
+        if gap > dist + 1e-6:
+            return False
+        a = s.coords[s.atom_indices([res1])]
+        b = s.coords[s.atom_indices([res2])]
+        d = b[None, :, :] - a[:, None, :]
+        return bool(np.any(np.sqrt(d[:, :, 0]**2 + d[:, :, 1]**2 + d[:, :, 2]**2) <= dist))
+
+def contact_pairs(contact, reslist1, reslist2, cap=None):
+    """
+    pairs (res1, res2) of a contact matrix in the order and with the
+    deduplication of score_contacts: each pair once in either orientation, at most cap
+    """
+    pairs = []
+    accepted = set()
+    for k, l in zip(*np.nonzero(contact)):
+        pair = (reslist1[k], reslist2[l])
+        if pair not in accepted and (pair[1], pair[0]) not in accepted:
+            if cap is not None and len(pairs) >= cap:
+                break
+            pairs.append(pair)
+            accepted.add(pair)
+    return pairs
+
+#searches of the most recently scored predictions, so the terms of one score function share them
+_searches = collections.OrderedDict()
+MAX_SEARCHES = 4
+
+def neighbor_search(pdb):
+    """NeighborSearch of a pdb string or Structure, reused while the same prediction is being scored"""
+    if isinstance(pdb, Structure):
+        return pdb._cached("neighbor_search", lambda: NeighborSearch(pdb))
+    if pdb in _searches:
+        _searches.move_to_end(pdb)
+        return _searches[pdb]
+    search = NeighborSearch(Structure(pdb))
+    _searches[pdb] = search
+    while len(_searches) > MAX_SEARCHES:
+        _searches.popitem(last=False)
+    return search
+
+if __name__=="__main__":
+    print("no main functionality")
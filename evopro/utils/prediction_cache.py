@@ -0,0 +1,97 @@
+"""
+Deduplication of AF2 jobs by the exact chain sequences they predict, so
+states shared between sequences (e.g. an unchanged binder chain) are only
+predicted once.
+"""
+
+import os
+import hashlib
+import collections
+
+from evopro.utils.prediction_server import job_key
+from evopro.utils.utils import compressed_pickle, decompress_pickle
+
+class PredictionCache:
+    """Least recently used cache of predictions keyed by job_key of the work list entry."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, val):
+        self.entries[key] = val
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+class SharedPredictionCache(PredictionCache):
+    """
+    PredictionCache whose entries are also written to cache_dir, so runs
+    sharing the directory (e.g. the islands of an island-model campaign)
+    reuse each other's predictions. Keeps the max_entries most recently
+    used predictions in memory; files in cache_dir are not evicted.
+    """
+
+    def __init__(self, cache_dir, max_entries):
+        super().__init__(max_entries)
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def __contains__(self, key):
+        return key in self.entries or os.path.isfile(self._path(key) + ".pbz2")
+
+    def get(self, key):
+        if key not in self.entries:
+            super().put(key, decompress_pickle(self._path(key) + ".pbz2"))
+        return super().get(key)
+
+    def put(self, key, val):
+        super().put(key, val)
+        path = self._path(key)
+        if not os.path.isfile(path + ".pbz2"):
+            #written under a private name first, so other runs never read a partial file
+            tmp_path = path + "_" + str(os.getpid())
+            compressed_pickle(tmp_path, val)
+            os.replace(tmp_path + ".pbz2", path + ".pbz2")
+
+def churn_deduplicated(dist, work_list, cache=None):
+    """
+    Same as dist.churn(work_list), but identical jobs in work_list are only
+    predicted once, and jobs already in cache are not predicted at all.
+    Returns the outputs in work_list order and the number of jobs predicted.
+    """
+    keys = [job_key(w) for w in work_list]
+    run_index = {}
+    to_run = []
+    for w, key in zip(work_list, keys):
+        if key in run_index or (cache is not None and key in cache):
+            continue
+        run_index[key] = len(to_run)
+        to_run.append(w)
+
+    results = dist.churn(to_run) if to_run else []
+
+    outputs = []
+    for key in keys:
+        if key in run_index:
+            outputs.append(results[run_index[key]])
+        else:
+            outputs.append(cache.get(key))
+    if cache is not None:
+        for key in run_index:
+            cache.put(key, results[run_index[key]])
+    return outputs, len(to_run)
+
+if __name__=="__main__":
+    print("no main functionality")
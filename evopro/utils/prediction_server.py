@@ -0,0 +1,195 @@
+import os
+import queue
+import threading
+import collections
+from multiprocessing.connection import Listener, Client
+
+from evopro.utils.distributor import Distributor, unpack_result, link_result, discard_result
+
+def job_key(w):
+    """returns a hashable key for a work list entry, e.g. [["SEQA", "SEQB"]]"""
+    if isinstance(w, (list, tuple)):
+        return tuple(job_key(x) for x in w)
+    return w
+
+class _Request:
+    """One churn call from a client, waiting for all of its jobs to finish."""
+
+    def __init__(self, n_jobs):
+        self.outputs = [None] * n_jobs
+        self.remaining = n_jobs
+        self.done = threading.Event()
+        if n_jobs == 0:
+            self.done.set()
+
+    def set_output(self, job_ind, val):
+        self.outputs[job_ind] = val
+        self.remaining -= 1
+        if self.remaining == 0:
+            self.done.set()
+
+class PredictionServer:
+    """Long-lived prediction server that owns the GPU workers of a node.
+    Several GA runs connect to it through a local socket and send the
+    same work lists they would otherwise give to their own Distributor.
+    Jobs from different runs are handed out to idle workers round-robin
+    over the connected runs (fair-share), and identical jobs that are
+    pending or running at the same time are only predicted once.
+    With mmap_results, outputs are forwarded still packed, so clients map
+    the workers' array files themselves instead of receiving the arrays
+    over the socket (clients must run as the same user on the same node).
+    """
+
+    def __init__(self, address, n_workers, f_init, arg_file, lengths, authkey=None, mmap_results=False, drop_keys=None):
+        self.address = address
+        self.dist = Distributor(n_workers, f_init, arg_file, lengths, mmap_results=mmap_results, drop_keys=drop_keys)
+        if os.path.exists(address):
+            os.remove(address)
+        self.listener = Listener(address, family="AF_UNIX", authkey=authkey)
+
+        self.cond = threading.Condition()
+        #per-client queues of (key, job) not yet handed to a worker
+        self.pending = {}
+        #round-robin order of clients with pending jobs
+        self.client_order = collections.deque()
+        #job key -> list of (request, job index) waiting on that prediction
+        self.waiters = {}
+        self.worker_key = [None] * n_workers
+        self.num_clients = 0
+        self.num_predictions = 0
+        self.num_deduplicated = 0
+        self._stop = False
+
+    def _submit(self, client_id, work_list):
+        request = _Request(len(work_list))
+        with self.cond:
+            for job_ind, w in enumerate(work_list):
+                key = job_key(w)
+                if key in self.waiters:
+                    #same job already queued or running for this or another run
+                    self.waiters[key].append((request, job_ind))
+                    self.num_deduplicated += 1
+                    continue
+                self.waiters[key] = [(request, job_ind)]
+                if client_id not in self.pending:
+                    self.pending[client_id] = collections.deque()
+                if not self.pending[client_id]:
+                    self.client_order.append(client_id)
+                self.pending[client_id].append((key, w))
+            self.cond.notify_all()
+        return request
+
+    def _dispatch(self):
+        """hand pending jobs to idle workers, one client at a time. Call with self.cond held."""
+        for proc_id in range(self.dist.n_workers):
+            if not self.client_order:
+                break
+            if self.worker_key[proc_id] is not None:
+                continue
+            client_id = self.client_order.popleft()
+            key, w = self.pending[client_id].popleft()
+            if self.pending[client_id]:
+                self.client_order.append(client_id)
+            self.dist.submit(proc_id, w)
+            self.worker_key[proc_id] = key
+            self.num_predictions += 1
+
+    def _handle_client(self, conn, client_id):
+        try:
+            while True:
+                cmd, payload = conn.recv()
+                if cmd == "churn":
+                    request = self._submit(client_id, payload)
+                    request.done.wait()
+                    try:
+                        conn.send(request.outputs)
+                    except OSError:
+                        #the client is gone and will not unpack these outputs
+                        discard_result(request.outputs)
+                        raise EOFError
+                elif cmd == "close":
+                    break
+                elif cmd == "shutdown":
+                    with self.cond:
+                        self._stop = True
+                        self.cond.notify_all()
+                    break
+        except EOFError:
+            #jobs already queued by this client still run and are shared with other runs
+            print("client", client_id, "disconnected")
+        finally:
+            conn.close()
+
+    def _accept_loop(self):
+        while not self._stop:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                break
+            client_id = self.num_clients
+            self.num_clients += 1
+            print("client", client_id, "connected")
+            t = threading.Thread(target=self._handle_client, args=(conn, client_id), daemon=True)
+            t.start()
+
+    def serve_forever(self):
+        """Accept clients and keep the workers busy until a client asks for shutdown."""
+        accept_thread = threading.Thread(target=self._accept_loop, daemon=True)
+        accept_thread.start()
+
+        while True:
+            with self.cond:
+                self._dispatch()
+                busy = any(k is not None for k in self.worker_key)
+                if not busy:
+                    if self._stop:
+                        break
+                    self.cond.wait(timeout=1.0)
+                    continue
+            try:
+                #time out now and then so new clients' jobs reach idle workers
+                #left packed, clients unpack (and unlink) mapped arrays themselves
+                proc_id, val = self.dist.receive(timeout=0.1, unpack=False)
+            except queue.Empty:
+                continue
+            with self.cond:
+                key = self.worker_key[proc_id]
+                self.worker_key[proc_id] = None
+                waiters = self.waiters.pop(key)
+                #every receiver of a shared prediction gets its own links to the array files
+                vals = [val] + [link_result(val) for _ in waiters[1:]]
+                for (request, job_ind), v in zip(waiters, vals):
+                    request.set_output(job_ind, v)
+
+        self.spin_down()
+
+    def spin_down(self):
+        print("Number of predictions:", self.num_predictions, "deduplicated jobs:", self.num_deduplicated)
+        self.listener.close()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.dist.spin_down()
+
+class PredictionClient:
+    """Stand-in for a Distributor inside a GA run that sends its work
+    lists to a shared PredictionServer instead of owning GPU workers.
+    """
+
+    def __init__(self, address, authkey=None):
+        self.conn = Client(address, family="AF_UNIX", authkey=authkey)
+
+    def churn(self, work_list):
+        self.conn.send(("churn", list(work_list)))
+        return unpack_result(self.conn.recv())
+
+    def spin_down(self):
+        """only disconnects this run; the server keeps its workers"""
+        self.conn.send(("close", None))
+        self.conn.close()
+
+    def shutdown_server(self):
+        self.conn.send(("shutdown", None))
+        self.conn.close()
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -0,0 +1,137 @@
+"""
+Helpers for running score functions away from the driver process, and for
+scoring a whole generation at once with batch scorers.
+"""
+
+import multiprocessing as mp
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+#keys of an AF2 result still read after scoring (logging, MPNN refill, confidence plots, compressed output)
+COMPACT_RESULT_KEYS = ("unrelaxed_protein", "plddt", "pae_output", "ptm", "iptm")
+
+def compact_result(result, keep_keys=COMPACT_RESULT_KEYS):
+    """returns a copy of an AF2 result dictionary with only keep_keys"""
+    if not isinstance(result, dict):
+        return result
+    return {k: v for k, v in result.items() if k in keep_keys}
+
+def score_in_worker(result, dsobj, score_func=None, contacts=None, distance_cutoffs=None, keep_keys=COMPACT_RESULT_KEYS):
+    """
+    Scores one prediction right after it was made, inside a Distributor worker
+    (pass as post_func). Returns the score tuple, with the trailing AF2 result
+    dictionary (if any) trimmed to keep_keys so less data goes back to the driver.
+    """
+    while type(result) is list:
+        result = result[0]
+    if contacts is not None:
+        score = score_func(result, dsobj, contacts=contacts, distance_cutoffs=distance_cutoffs)
+    else:
+        score = score_func(result, dsobj)
+
+    if isinstance(score, tuple) and len(score) > 0 and score[-1] is result:
+        score = score[:-1] + (compact_result(result, keep_keys),)
+    return score
+
+#batch versions of score functions, registered with register_batch_scorer
+BATCH_SCORERS = {}
+
+def register_batch_scorer(score_func):
+    """
+    Decorator that registers a batch version of score_func. The batch version
+    is called as batch(results_list, dsobjs, stacked=..., **kwargs), where stacked
+    is stack_results(results_list), and returns the list of score tuples
+    score_func would return, or None to fall back to per-item calls.
+    Objects can also provide the batch version as a score_batch method (see
+    score_spec.ScorePlan).
+    """
+    def register(batch_func):
+        BATCH_SCORERS[score_func] = batch_func
+        return batch_func
+    return register
+
+def get_batch_scorer(score_func):
+    """batch version of score_func, or None if it only scores one prediction at a time"""
+    batch_func = getattr(score_func, "score_batch", None)
+    if batch_func is None:
+        try:
+            batch_func = BATCH_SCORERS.get(score_func)
+        except TypeError:
+            return None
+    return batch_func
+
+def stack_results(results_list):
+    """
+    stacked pLDDT (B, L) and PAE (B, L, L) arrays of a list of AF2 results,
+    each None if the results are missing it or differ in length
+    """
+    stacked = {}
+    for key, name, get in (("plddt", "plddt", lambda r: r["plddt"]), ("pae_output", "pae", lambda r: r["pae_output"][0])):
+        try:
+            arrays = [np.asarray(get(r)) for r in results_list]
+        except (KeyError, TypeError, IndexError):
+            arrays = []
+        if arrays and len(set([a.shape for a in arrays])) == 1:
+            stacked[name] = np.stack(arrays)
+        else:
+            stacked[name] = None
+    return stacked
+
+def score_generation(score_func, results, dsobjs, **kwargs):
+    """
+    returns [score_func(result, dsobj, **kwargs) for result, dsobj in zip(results, dsobjs)],
+    with one call of the batch version of score_func if it has one. The pLDDT and
+    PAE arrays of the generation are stacked once and handed to it.
+    """
+    results = list(results)
+    dsobjs = list(dsobjs)
+    batch_func = get_batch_scorer(score_func)
+    if batch_func is not None and results:
+        scores = batch_func(results, dsobjs, stacked=stack_results(results), **kwargs)
+        if scores is not None:
+            return list(scores)
+    return [score_func(result, dsobj, **kwargs) for result, dsobj in zip(results, dsobjs)]
+
+def _call_score_func(item, score_func=None, kwargs=None):
+    result, dsobj = item
+    return score_func(result, dsobj, **kwargs)
+
+def _call_score_generation(chunk, score_func=None, kwargs=None):
+    return score_generation(score_func, [x[0] for x in chunk], [x[1] for x in chunk], **kwargs)
+
+class ParallelScorer:
+    """
+    CPU process pool that scores a whole generation at once. Workers are forked
+    from the driver, so score functions imported from --score_file are available
+    in them, and each worker keeps its own cache of parsed reference structures
+    (see structure.load_reference) across generations.
+    """
+
+    def __init__(self, n_workers):
+        self.n_workers = n_workers
+        self.executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context("fork"))
+
+    def score(self, score_func, results, dsobjs, **kwargs):
+        """
+        returns [score_func(result, dsobj, **kwargs) for result, dsobj in zip(results, dsobjs)],
+        computed in parallel. results can also be packs of results (multistate).
+        """
+        items = list(zip(results, dsobjs))
+        if not items:
+            return []
+        if get_batch_scorer(score_func) is not None:
+            #one batch per worker
+            size = -(-len(items)//self.n_workers)
+            chunks = [items[i:i+size] for i in range(0, len(items), size)]
+            f = partial(_call_score_generation, score_func=score_func, kwargs=kwargs)
+            return [score for scores in self.executor.map(f, chunks) for score in scores]
+        chunksize = max(1, len(items)//(4*self.n_workers))
+        f = partial(_call_score_func, score_func=score_func, kwargs=kwargs)
+        return list(self.executor.map(f, items, chunksize=chunksize))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+if __name__=="__main__":
+    print("no main functionality")
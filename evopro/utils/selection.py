@@ -0,0 +1,120 @@
+"""
+Residue selections as vectorized queries over a residue index: chain and
+residue-number lookup arrays plus one CA coordinate array. Used to resolve the
+designable-residue specs of the json generators (ranges, chains, spheres
+around cluster centers, interface shells) without re-parsing structures.
+"""
+
+import re
+import numpy as np
+
+class ResidueIndex:
+    """
+    Residues in model order with their chain, number and CA coordinates (NaN
+    for residues without a CA, or when built without coordinates). Every query
+    returns a boolean mask over the residues; keys(mask) and tuples(mask) turn
+    it into residue ids ("A12") or (chain, number) tuples.
+    """
+
+    def __init__(self, chains, nums, ca=None):
+        self.chains = np.array(chains, dtype=str)
+        self.nums = np.array(nums, dtype=int)
+        if ca is None:
+            ca = np.full((len(self.nums), 3), np.nan)
+        self.ca = np.array(ca, dtype=float).reshape(-1, 3)
+        self.lookup = {}
+        for i, key in enumerate(zip(self.chains.tolist(), self.nums.tolist())):
+            self.lookup.setdefault(key, i)
+
+    @classmethod
+    def from_resids(cls, resids):
+        """index of residue ids like "A12" (no coordinates)"""
+        chains = []
+        nums = []
+        for resid in resids:
+            split = re.split(r'(\d+)', resid)
+            chains.append(split[0])
+            nums.append(int(split[1]))
+        return cls(chains, nums)
+
+    @classmethod
+    def from_pdb(cls, pdb, fil=False):
+        """index of the residues of the first model of a pdb string (or file if fil), read from the fixed PDB columns"""
+        if fil:
+            with open(pdb, "r") as f:
+                pdb = f.read()
+        chains = []
+        nums = []
+        ca = []
+        seen = {}
+        for lin in pdb.split("\n"):
+            if lin.startswith("ENDMDL"):
+                break
+            if not (lin.startswith("ATOM") or lin.startswith("HETATM")):
+                continue
+            key = (lin[21], lin[22:27])
+            if key not in seen:
+                seen[key] = len(nums)
+                chains.append(lin[21])
+                nums.append(int(lin[22:26]))
+                ca.append((np.nan, np.nan, np.nan))
+            if lin[12:16].strip() == "CA":
+                ca[seen[key]] = (float(lin[30:38]), float(lin[38:46]), float(lin[46:54]))
+        return cls(chains, nums, ca)
+
+    def __len__(self):
+        return len(self.nums)
+
+    def chain(self, chains):
+        """residues of the given chain(s)"""
+        if isinstance(chains, str):
+            chains = [chains]
+        return np.isin(self.chains, list(chains))
+
+    def range(self, chain, start=None, end=None):
+        """residues of chain numbered from start to end (inclusive); None leaves that side open"""
+        mask = self.chains == chain
+        if start is not None:
+            mask = mask & (self.nums >= start)
+        if end is not None:
+            mask = mask & (self.nums <= end)
+        return mask
+
+    def index_of(self, residue):
+        """position of a residue given as (chain, number) or "A12" """
+        if isinstance(residue, str):
+            split = re.split(r'(\d+)', residue)
+            residue = (split[0], int(split[1]))
+        if tuple(residue) not in self.lookup:
+            raise ValueError(f'Residue {residue[0]}{residue[1]} not found.')
+        return self.lookup[tuple(residue)]
+
+    def sphere(self, centers, radius):
+        """residues whose CA is within radius of the CA of any of the centers"""
+        inds = [self.index_of(c) for c in centers]
+        center_ca = self.ca[inds]
+        if np.isnan(center_ca).any():
+            raise ValueError('Cluster centers need a CA atom.')
+        dist = np.sqrt(((self.ca[:, None, :] - center_ca[None, :, :])**2).sum(axis=-1) + 1e-12)
+        return np.any(dist <= radius, axis=1)
+
+    def interface_shell(self, chains1, chains2, radius):
+        """residues of chains1 whose CA is within radius of a CA of chains2"""
+        mask1 = self.chain(chains1)
+        mask2 = self.chain(chains2) & ~np.isnan(self.ca).any(axis=1)
+        mask = np.zeros(len(self), dtype=bool)
+        if mask1.any() and mask2.any():
+            dist = np.sqrt(((self.ca[mask1][:, None, :] - self.ca[mask2][None, :, :])**2).sum(axis=-1))
+            mask[mask1] = np.any(dist <= radius, axis=1)
+        return mask
+
+    def keys(self, mask):
+        """residue ids ("A12") of the residues in mask, in model order"""
+        return [c + str(n) for c, n in zip(self.chains[mask].tolist(), self.nums[mask].tolist())]
+
+    def tuples(self, mask):
+        """(chain, number) of the residues in mask, in model order"""
+        return list(zip(self.chains[mask].tolist(), self.nums[mask].tolist()))
+
+if __name__=="__main__":
+    print("no main functionality")
@@ -0,0 +1,238 @@
+"""
+PDB structures parsed once into numpy arrays, and a per-process registry of
+reference structures (starting scaffolds etc.) that score functions compare
+every prediction against.
+"""
+
+import os
+import math
+import collections
+import numpy as np
+
+BACKBONE_ATOMS = ("N", "CA", "C", "O")
+
+#atomic masses used for the mass-weighted descriptors (other elements get mass 0)
+ATOM_MASSES = {"C": 12.0107, "O": 15.9994, "N": 14.0067, "S": 32.065}
+
+#CA-CA distance of residues counted as in contact (contact order, neighbor counts, interfaces)
+CA_CONTACT_DIST = 8.0
+CA_NEIGHBOR_DIST = 10.0
+
+class Structure:
+    """
+    A PDB string parsed into arrays. Residues are identified the same way as in
+    pdb_parser.get_coordinates_pdb (chain + residue number, e.g. "B12") and keep
+    the order they first appear in.
+    """
+
+    def __init__(self, pdb):
+        self.pdb = pdb
+        self.chains = []
+        self.resids = []
+        self.resnames = []
+        self.resindices = {}
+        atom_names = []
+        elements = []
+        coords = []
+        atom_resindex = []
+
+        for lin in pdb.split("\n"):
+            l = lin.strip().split()
+            if not l:
+                continue
+            if 'ATOM' in l[0] or 'HETATM' in l[0]:
+                resid = l[4]+l[5]
+                if l[4] not in self.chains:
+                    self.chains.append(l[4])
+                if resid not in self.resindices:
+                    self.resindices[resid] = len(self.resids)
+                    self.resids.append(resid)
+                    self.resnames.append(l[3])
+                atom_names.append(l[2])
+                element = lin[76:78].strip()
+                elements.append(element if element else l[-1])
+                coords.append((float(lin[30:38]), float(lin[38:46]), float(lin[46:54])))
+                atom_resindex.append(self.resindices[resid])
+
+        self.atom_names = np.array(atom_names, dtype=str)
+        self.elements = np.array(elements, dtype=str)
+        self.coords = np.array(coords, dtype=float).reshape(-1, 3)
+        self.atom_resindex = np.array(atom_resindex, dtype=int)
+
+        #atoms of residue i are self.atom_order[res_start[i]:res_stop[i]]
+        n_res = len(self.resids)
+        self.atom_order = np.argsort(self.atom_resindex, kind="stable")
+        sorted_resindex = self.atom_resindex[self.atom_order]
+        self.res_start = np.searchsorted(sorted_resindex, np.arange(n_res), side="left")
+        self.res_stop = np.searchsorted(sorted_resindex, np.arange(n_res), side="right")
+
+        is_ca = self.atom_names == "CA"
+        self.ca_index = np.full(n_res, -1, dtype=int)
+        self.ca_index[self.atom_resindex[is_ca][::-1]] = np.nonzero(is_ca)[0][::-1]
+        self.ca_coords = self.coords[self.ca_index[self.ca_index >= 0]]
+        self.backbone_coords = self.coords[np.isin(self.atom_names, BACKBONE_ATOMS)]
+        self.centroid = self.coords.mean(axis=0) if len(self.coords) else np.zeros(3)
+        self.ca_centroid = self.ca_coords.mean(axis=0) if len(self.ca_coords) else np.zeros(3)
+
+        self._selections = {}
+        self._coordinates_pdb = None
+        self._descriptors = {}
+
+    def atom_indices(self, reslist, ca_only=False):
+        """indices of the atoms of the residues in reslist, in the order of reslist"""
+        key = (tuple(reslist), ca_only)
+        if key not in self._selections:
+            if ca_only:
+                inds = [self.ca_index[self.resindices[res]] for res in reslist]
+                inds = np.array([i for i in inds if i >= 0], dtype=int)
+            else:
+                inds = [self.atom_order[self.res_start[self.resindices[res]]:self.res_stop[self.resindices[res]]] for res in reslist]
+                inds = np.concatenate(inds) if inds else np.zeros(0, dtype=int)
+            self._selections[key] = inds
+        return self._selections[key]
+
+    def get_coords(self, reslist=None, ca_only=False):
+        """(N,3) coordinates of the residues in reslist (all residues if None)"""
+        if reslist is None:
+            reslist = self.resids
+        return self.coords[self.atom_indices(reslist, ca_only=ca_only)]
+
+    def get_coordinates_pdb(self):
+        """same output as pdb_parser.get_coordinates_pdb(self.pdb), computed once"""
+        if self._coordinates_pdb is None:
+            from evopro.utils.pdb_parser import get_coordinates_pdb
+            self._coordinates_pdb = get_coordinates_pdb(self.pdb)
+        return self._coordinates_pdb
+
+    #geometry descriptors, each computed from the arrays the first time it is used
+
+    def _cached(self, name, compute):
+        if name not in self._descriptors:
+            self._descriptors[name] = compute()
+        return self._descriptors[name]
+
+    def _mass_moments(self):
+        masses = np.array([ATOM_MASSES.get(e, 0.0) for e in self.elements], dtype=float)
+        total = masses.sum()
+        if total == 0:
+            return masses, np.zeros(3), 0.0, np.zeros((3, 3))
+        com = (masses[:, None]*self.coords).sum(axis=0)/total
+        centered = self.coords - com
+        rg2 = (masses*(centered**2).sum(axis=1)).sum()/total
+        inertia = np.eye(3)*(masses*(centered**2).sum(axis=1)).sum() - np.einsum("i,ij,ik->jk", masses, centered, centered)
+        return masses, com, math.sqrt(max(rg2, 0.0)), inertia
+
+    @property
+    def masses(self):
+        """(N,) atomic masses"""
+        return self._cached("mass_moments", self._mass_moments)[0]
+
+    @property
+    def center_of_mass(self):
+        return self._cached("mass_moments", self._mass_moments)[1]
+
+    @property
+    def radius_of_gyration(self):
+        """mass-weighted radius of gyration of all atoms"""
+        return self._cached("mass_moments", self._mass_moments)[2]
+
+    @property
+    def inertia_tensor(self):
+        """(3,3) mass-weighted inertia tensor about the center of mass"""
+        return self._cached("mass_moments", self._mass_moments)[3]
+
+    @property
+    def principal_moments(self):
+        """eigenvalues of the inertia tensor, smallest first"""
+        return self._cached("principal_moments", lambda: np.linalg.eigvalsh(self.inertia_tensor))
+
+    @property
+    def chain_centroids(self):
+        """{chain: (3,) centroid of its atoms}"""
+        def compute():
+            chain_of_atom = np.array([res[0:1] for res in self.resids], dtype=str)[self.atom_resindex]
+            return {chain: self.coords[chain_of_atom == chain].mean(axis=0) for chain in self.chains}
+        return self._cached("chain_centroids", compute)
+
+    @property
+    def ca_residues(self):
+        """indices of the residues that have a CA atom, in the order of ca_coords"""
+        return self._cached("ca_residues", lambda: np.nonzero(self.ca_index >= 0)[0])
+
+    @property
+    def ca_distances(self):
+        """CA-CA distance matrix of the residues in ca_residues"""
+        def compute():
+            d = self.ca_coords[:, None, :] - self.ca_coords[None, :, :]
+            return np.sqrt((d**2).sum(axis=-1))
+        return self._cached("ca_distances", compute)
+
+    @property
+    def residue_chains(self):
+        """chain of every residue in ca_residues"""
+        return self._cached("residue_chains", lambda: np.array([self.resids[i][0:1] for i in self.ca_residues], dtype=str))
+
+    @property
+    def neighbor_counts(self):
+        """
+        number of other CA atoms within CA_NEIGHBOR_DIST of the CA of every residue
+        in ca_residues, a burial (inverse SASA) proxy: exposed residues have few neighbors
+        """
+        return self._cached("neighbor_counts", lambda: (self.ca_distances <= CA_NEIGHBOR_DIST).sum(axis=1) - 1)
+
+    @property
+    def interface_sasa_proxy(self):
+        """
+        {(chain1, chain2): neighbor count of chain1 residues contributed by chain2},
+        the burial of chain1 by chain2, which grows with the SASA buried at their interface
+        """
+        def compute():
+            close = self.ca_distances <= CA_NEIGHBOR_DIST
+            proxy = {}
+            for c1 in self.chains:
+                for c2 in self.chains:
+                    if c1 != c2:
+                        proxy[(c1, c2)] = int(close[np.ix_(self.residue_chains == c1, self.residue_chains == c2)].sum())
+            return proxy
+        return self._cached("interface_sasa_proxy", compute)
+
+    @property
+    def contact_order(self):
+        """
+        relative contact order: mean sequence separation of residues of the same
+        chain with CAs within CA_CONTACT_DIST (at least 3 apart), divided by the chain length
+        """
+        def compute():
+            same_chain = self.residue_chains[:, None] == self.residue_chains[None, :]
+            sep = np.abs(self.ca_residues[:, None] - self.ca_residues[None, :])
+            contacts = np.triu(same_chain & (sep >= 3) & (self.ca_distances <= CA_CONTACT_DIST))
+            if not contacts.any():
+                return 0.0
+            lengths = {chain: (self.residue_chains == chain).sum() for chain in self.chains}
+            chain_length = np.array([lengths[c] for c in self.residue_chains])[:, None]
+            return float((sep/chain_length)[contacts].mean())
+        return self._cached("contact_order", compute)
+
+#reference structures loaded by this process, keyed by (path, mtime), least recently used first
+_references = collections.OrderedDict()
+MAX_REFERENCES = 32
+
+def load_reference(path):
+    """
+    Returns the Structure for a reference pdb file. Each file is read and parsed
+    once per process and reloaded only if it changes on disk.
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key in _references:
+        _references.move_to_end(key)
+        return _references[key]
+
+    with open(path, "r") as f:
+        structure = Structure(f.read())
+    _references[key] = structure
+    while len(_references) > MAX_REFERENCES:
+        _references.popitem(last=False)
+    return structure
+
+if __name__ == "__main__":
+    print("no main functionality")